@@ -1,3 +1,4 @@
-from .app import app
-
-from . import models
+'''
+Metacorps web application. Importing it neither reads the config nor
+connects to MongoDB; see app.app.create_app.
+'''
@@ -1,60 +1,110 @@
 import json
+import math
 
-from flask import Flask, render_template, redirect, url_for, jsonify, request
-from flask_mongoengine import MongoEngine
+from bson.errors import InvalidId
+from flask import (
+    Blueprint, Flask, abort, current_app, render_template, redirect, url_for,
+    jsonify, request
+)
 from flask_security import (
-    MongoEngineUserDatastore, Security, login_required, logout_user,
-    current_user
+    MongoEngineUserDatastore, login_required, logout_user, current_user
 )
 from flask_wtf import FlaskForm
+from mongoengine import ValidationError
 from wtforms import validators
 from wtforms import TextField, TextAreaField, BooleanField, RadioField
 
-app = Flask(__name__)
+from . import models
+from .cache import ResponseCache
+from .extensions import db, security, set_default_app
+from .instance_window import DEFAULT_WINDOW_SIZE, InstanceWindowCache
+
 
-app.config.from_envvar('CONFIG_FILE')
+views = Blueprint('metacorps', __name__)
 
-db = MongoEngine(app)
 
-from . import models
+def create_app(config_file=None):
+    '''
+    Make the metacorps app. Nothing is configured or connected until this is
+    called, so importing the app or its models is cheap.
 
+    Arguments:
+        config_file (str): Flask config file, by default the one named by
+            the CONFIG_FILE environment variable
 
-def previously_used_cm():
-    facets = [facet
-              for project in models.Project.objects
-              for facet in project.facets]
+    Returns:
+        (flask.Flask): configured app connected to its MongoDB database
+    '''
+    app = Flask(__name__)
 
-    instances = [instance for facet in facets for instance in facet.instances]
+    if config_file is None:
+        app.config.from_envvar('CONFIG_FILE')
+    else:
+        app.config.from_pyfile(config_file)
 
-    conceptual_metaphors = list(set(
-        i['conceptual_metaphor'].lower().strip() for i in instances
-        if i['conceptual_metaphor'] != ''
-    ))
+    db.init_app(app)
+    security.init_app(
+        app, MongoEngineUserDatastore(db, models.User, models.Role)
+    )
 
-    return conceptual_metaphors
+    app.extensions['instance_windows'] = InstanceWindowCache(
+        app.config.get('INSTANCE_WINDOW_SIZE', DEFAULT_WINDOW_SIZE)
+    )
+
+    app.extensions['response_cache'] = ResponseCache.from_config(app.config)
 
+    app.register_blueprint(views)
+    app.cli.command('rebuild-cm-vocabulary')(rebuild_cm_vocabulary)
 
-PREVIOUSLY_USED_CM = previously_used_cm()
+    set_default_app(app)
+
+    return app
 
-user_datastore = MongoEngineUserDatastore(db, models.User, models.Role)
-security = Security(app, user_datastore)
 
 DOWNLOAD_BASE_URL = 'https://archive.org/download/'
 
+# Number of most recent log entries on the home page.
+LOG_TAIL_LENGTH = 10
+
+# Instances shown per page of the facet view by default and at most.
+FACET_PAGE_SIZE = 100
+MAX_FACET_PAGE_SIZE = 1000
 
-@app.route('/logout')
+# Most changes accepted by one bulk annotation request.
+MAX_BULK_CHANGES = 5000
+
+# Transcript lines sent on each side of an instance by default and at most.
+TRANSCRIPT_CONTEXT_LINES = 5
+MAX_TRANSCRIPT_CONTEXT_LINES = 100
+
+
+@views.route('/logout')
 @login_required
 def logout():
     logout_user()
     return redirect('/')
 
 
-@app.route('/', methods=['GET', 'POST'])
+@views.route('/', methods=['GET', 'POST'])
 @login_required
 def hello():
-    projects = models.Project.objects
-    log = list(models.Log.objects)[-10:]
-    log.reverse()
+    cache = _response_cache()
+
+    projects = cache.get_or_set('projects', (), lambda: [
+        {'id': str(project.pk), 'name': project.name}
+        for project in models.Project.objects.only('name')
+    ])
+
+    log = cache.get_or_set('log', (LOG_TAIL_LENGTH,), lambda: [
+        {
+            'time_posted': entry.time_posted,
+            'user_email': entry.user_email,
+            'message': entry.message
+        }
+        for entry in models.Log.objects.order_by(
+            '-time_posted'
+        ).limit(LOG_TAIL_LENGTH)
+    ])
 
     form = LogForm()
 
@@ -64,6 +114,7 @@ def hello():
         new_log.message = form.message.data
 
         new_log.save()
+        cache.invalidate('log')
 
         return redirect('/')
 
@@ -74,82 +125,312 @@ class LogForm(FlaskForm):
     message = TextAreaField(u'Log Entry:', [validators.DataRequired()])
 
 
-@app.route('/projects/<project_id>')
+@views.route('/projects/<project_id>')
 @login_required
 def project(project_id):
 
-    project = models.Project.objects.get(pk=project_id)
-    facets = project.facets
+    def render():
+        project = models.Project.objects.only('name').get(pk=project_id)
 
-    return render_template('project.html',
-                           facets=facets,
-                           project=project)
+        facet_ids = project.facet_ids()
+        facets = sorted(
+            models.Facet.objects(pk__in=facet_ids).only(
+                'word', 'total_count', 'number_reviewed'
+            ),
+            key=lambda facet: facet_ids.index(facet.pk)
+        )
 
+        return render_template('project.html',
+                               facets=facets,
+                               project=project)
 
-@app.route('/projects/<project_id>/facets/<facet_word>')
+    return _response_cache().get_or_set(
+        'project:' + project_id, ('page',), render
+    )
+
+
+@views.route('/projects/<project_id>/facets/<facet_word>')
 @login_required
 def facet(project_id, facet_word):
+    '''
+    One page of a facet's instances with the metadata of their source
+    documents. Set the page and number of instances per page with the page
+    and per_page query parameters.
+    '''
+    project = models.Project.objects.only('name').get(pk=project_id)
+    facet = project.get_facet(facet_word, load_instances=False)
+
+    # Keyed on last_modified too, so edits made through other workers are
+    # never served stale.
+    return _response_cache().get_or_set(
+        'facet:{}'.format(facet.pk),
+        (facet.last_modified, request.args.get('page'),
+         request.args.get('per_page')),
+        lambda: _render_facet(project, facet)
+    )
 
-    project = models.Project.objects.get(pk=project_id)
-    facet = [f for f in project.facets if facet_word == f['word']][0]
+
+def _render_facet(project, facet):
+
+    n_instances = facet.count_instances()
+
+    per_page = min(
+        max(request.args.get('per_page', FACET_PAGE_SIZE, type=int), 1),
+        MAX_FACET_PAGE_SIZE
+    )
+    n_pages = max(int(math.ceil(n_instances / per_page)), 1)
+    page = min(max(request.args.get('page', 1, type=int), 1), n_pages)
+
+    start = (page - 1) * per_page
+    instances = facet.get_instances(start, start + per_page)
+
+    # One metadata-only query for all source documents on the page.
+    source_docs = models.IatvDocument.objects(
+        pk__in=list(set(instance.source_id for instance in instances))
+    ).only('program_name', 'network', 'start_localtime', 'iatv_url')
+
+    docs_by_id = dict((doc.pk, doc) for doc in source_docs)
     iatv_documents = [
-        models.IatvDocument.objects.get(pk=instance.source_id)
-        for instance in facet.instances
+        docs_by_id.get(instance.source_id) for instance in instances
     ]
 
     return render_template('facet.html',
                            project=project, facet=facet,
-                           iatv_documents=iatv_documents)
+                           instances=instances, start=start,
+                           iatv_documents=iatv_documents,
+                           page=page, n_pages=n_pages, per_page=per_page,
+                           n_instances=n_instances)
 
 
-@app.route('/api/projects/<project_id>/facets/<facet_word>/instances/<int:instance_idx>',
+@views.route('/api/projects/<project_id>/facets/<facet_word>/instances/<int:instance_idx>',
            methods=['GET', 'POST'])
 @login_required
 def api_update_instance(project_id, facet_word, instance_idx):
 
-    project = models.Project.objects.get(pk=project_id)
-    facet = [f for f in project.facets if facet_word == f['word']][0]
-
-    instance = facet.instances[instance_idx]
+    project = models.Project.objects.only('name').get(pk=project_id)
+    facet = project.get_facet(facet_word, load_instances=False)
 
     if request.method == 'POST':
+        return _set_instance_fields(facet.pk, instance_idx, _request_data())
 
-        data = request.form
+    instance = facet.get_instance(instance_idx)
+
+    return jsonify(json.loads(instance.to_json()))
 
-        try:
-            instance.figurative = data['figurative'] == 'True'
-            instance.include = data['include'] == 'True'
-            instance.spoken_by = data['spoken_by']
-            instance.conceptual_metaphor = data['conceptual_metaphor']
-            instance.objects = data['objects']
-            instance.subjects = data['subjects']
-            instance.description = data['description']
-            instance.tense = data['tense']
-            instance.active_passive = data['active_passive']
-            instance.repeat = data['repeat'] == 'True'
-            ri = data['repeat_index']
-            if ri != '' and ri is not None:
-                instance.repeat_index = int(ri)
-            instance.rerun = data['rerun'] == 'True'
-            instance.save()
-
-        except Exception as e:
-            print(e)
+
+@views.route('/api/facets/<facet_id>/instances/<int:instance_idx>',
+           methods=['GET', 'POST'])
+@login_required
+def api_facet_instance(facet_id, instance_idx):
+    '''
+    GET the instance, or POST annotation fields, as a form or JSON, to set
+    them in one atomic write. If the POST includes the version of the
+    instance that was edited and the instance has changed since, nothing is
+    written and the response is 409 with the current instance.
+    '''
+    if request.method == 'POST':
+        return _set_instance_fields(facet_id, instance_idx, _request_data())
+
+    try:
+        facet = models.Facet.objects.exclude('instances').get(pk=facet_id)
+        instance = facet.get_instance(instance_idx)
+    except (models.Facet.DoesNotExist, IndexError, ValidationError):
+        abort(404)
 
     return jsonify(json.loads(instance.to_json()))
 
 
-@app.route('/projects/<project_id>/facets/<facet_word>/instances/<int:instance_idx>', methods=['GET', 'POST'])
+@views.route('/api/instances/bulk', methods=['POST'])
+@login_required
+def api_bulk_update_instances():
+    '''
+    Apply a JSON list of annotation changes, or {"changes": [...]}, each
+    with the facet id, instance index, fields to set, and optionally the
+    expected instance version, in one bulk write. The response has a
+    result for each change; see Facet.set_many_instance_fields.
+    '''
+    data = request.get_json(silent=True)
+    changes = data.get('changes') if isinstance(data, dict) else data
+
+    if not isinstance(changes, list) or \
+            not all(isinstance(change, dict) for change in changes):
+        return jsonify({'error': 'Expected a JSON list of changes'}), 400
+
+    if len(changes) > MAX_BULK_CHANGES:
+        return jsonify({
+            'error': 'At most {} changes per request'.format(
+                MAX_BULK_CHANGES
+            )
+        }), 400
+
+    results = models.Facet.set_many_instance_fields(changes)
+
+    _facet_edited(*set(
+        change['facet'] for change, result in zip(changes, results)
+        if result['ok']
+    ))
+
+    return jsonify({
+        'results': results,
+        'n_updated': sum(1 for result in results if result['ok'])
+    })
+
+
+@views.route('/api/facets/<facet_id>/instances/<int:instance_idx>/context')
+@login_required
+def api_instance_context(facet_id, instance_idx):
+    '''
+    Transcript lines around the instance with their caption start times,
+    ?lines= on each side, instead of the whole transcript. See
+    IatvDocument.transcript_context.
+    '''
+    n_lines = min(
+        max(request.args.get(
+            'lines',
+            current_app.config.get(
+                'TRANSCRIPT_CONTEXT_LINES', TRANSCRIPT_CONTEXT_LINES
+            ),
+            type=int
+        ), 0),
+        MAX_TRANSCRIPT_CONTEXT_LINES
+    )
+
+    try:
+        facet = models.Facet.objects.exclude('instances').get(pk=facet_id)
+        instance, source_doc, _ = _instance_windows().get(
+            current_user.get_id(), facet, instance_idx
+        )
+    except (models.Facet.DoesNotExist, IndexError, ValidationError):
+        abort(404)
+
+    if source_doc is None:
+        abort(404)
+
+    context = source_doc.transcript_context(instance.text, n_lines)
+    context.update(
+        document_id=str(source_doc.pk), iatv_url=source_doc.iatv_url
+    )
+
+    return jsonify(context)
+
+
+def _request_data():
+
+    return request.get_json(silent=True) or request.form
+
+
+def _set_instance_fields(facet_id, instance_idx, data):
+    '''
+    Response for an annotation update: the updated fields with the new
+    version, 400 for bad values, 404 if there is no such instance, or 409
+    on a version conflict.
+    '''
+    try:
+        fields, version = _annotation_updates(data)
+        updated = models.Facet.set_instance_fields(
+            facet_id, instance_idx, fields, expected_version=version
+        )
+        _instance_edited(facet_id, instance_idx, fields, updated)
+
+    except models.InstanceVersionConflict as e:
+        return jsonify({
+            'error': str(e), 'current': json.loads(e.current.to_json())
+        }), 409
+
+    except (models.Facet.DoesNotExist, IndexError, InvalidId):
+        abort(404)
+
+    except (ValueError, ValidationError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(updated)
+
+
+def _instance_windows():
+
+    return current_app.extensions['instance_windows']
+
+
+def _response_cache():
+
+    return current_app.extensions['response_cache']
+
+
+def _instance_edited(facet_id, instance_idx, fields, updated):
+    '''
+    Keep what this process has cached about the facet current after the
+    user saved fields to one instance; updated is what
+    Facet.set_instance_fields returned.
+    '''
+    _instance_windows().record_edit(
+        current_user.get_id(), facet_id, instance_idx, fields,
+        updated['version']
+    )
+    _facet_edited(facet_id)
+
+
+def _facet_edited(*facet_ids):
+    '''
+    Drop what this process has cached about the facets' pages after their
+    instances were edited. Project pages only show facet words and counts,
+    which instance edits don't change, so they are kept.
+    '''
+    _response_cache().invalidate(
+        *('facet:{}'.format(facet_id) for facet_id in facet_ids)
+    )
+
+
+# Sent as 'True' or 'False' by the edit forms.
+BOOLEAN_ANNOTATION_FIELDS = (
+    'figurative', 'include', 'repeat', 'rerun', 'reviewed'
+)
+
+
+def _annotation_updates(data):
+    '''
+    Annotation fields and the expected instance version, or None, from
+    request data. An empty repeat_index is ignored.
+    '''
+    fields = {}
+
+    for name in models.ANNOTATION_FIELDS:
+
+        if name not in data:
+            continue
+
+        value = data[name]
+
+        if name in BOOLEAN_ANNOTATION_FIELDS:
+            if not isinstance(value, bool):
+                value = value == 'True'
+
+        elif name == 'repeat_index':
+            if value == '' or value is None:
+                continue
+            value = int(value)
+
+        fields[name] = value
+
+    version = data.get('version')
+    if version == '' or version is None:
+        version = None
+    else:
+        version = int(version)
+
+    return fields, version
+
+
+@views.route('/projects/<project_id>/facets/<facet_word>/instances/<int:instance_idx>', methods=['GET', 'POST'])
 @login_required
 def edit_instance(project_id, facet_word, instance_idx):
 
     project = models.Project.objects.get(pk=project_id)
-    facet = [f for f in project.facets if facet_word == f['word']][0]
-
-    instance = facet.instances[instance_idx]
-    total_instances = len(facet.instances)
+    facet = project.get_facet(facet_word, load_instances=False)
 
-    source_doc = models.IatvDocument.objects.get(pk=instance.source_id)
+    # Served from the coder's prefetched window of upcoming instances.
+    instance, source_doc, total_instances = _instance_windows().get(
+        current_user.get_id(), facet, instance_idx
+    )
 
     form = EditInstanceForm(
         figurative=instance['figurative'],
@@ -175,49 +456,76 @@ def edit_instance(project_id, facet_word, instance_idx):
         ap = form.active_passive.data
         desc = form.description.data
 
-        instance['spoken_by'] = sp_by
-        instance['conceptual_metaphor'] = cm
-        instance['figurative'] = fig
-        instance['include'] = inc
-        instance['objects'] = obj
-        instance['subjects'] = subj
-
         try:
             t = form.tense.data
-            instance['tense'] = t
         except:
-            instance['tense'] = ''
-
-        instance['active_passive'] = ap
-        instance['description'] = desc
-
-        instance.save()
-
-        if cm not in PREVIOUSLY_USED_CM:
-            PREVIOUSLY_USED_CM.append(cm)
+            t = ''
+
+        fields = {
+            'spoken_by': sp_by,
+            'conceptual_metaphor': cm,
+            'figurative': fig,
+            'include': inc,
+            'objects': obj,
+            'subjects': subj,
+            'tense': t,
+            'active_passive': ap,
+            'description': desc
+        }
+        updated = models.Facet.set_instance_fields(
+            facet.pk, instance_idx, fields
+        )
+        _instance_edited(facet.pk, instance_idx, fields, updated)
 
         next_url = url_for(
-               'edit_instance', project_id=project_id, facet_word=facet_word,
+               '.edit_instance', project_id=project_id, facet_word=facet_word,
                 instance_idx=instance_idx+1
             )
 
         return redirect(next_url)
 
+    # source_doc only has metadata; the transcript around the instance is
+    # fetched from context_url.
+    context_url = url_for(
+        '.api_instance_context', facet_id=facet.pk, instance_idx=instance_idx
+    )
+
     return render_template('edit_instance.html', form=form,
                            project=project, facet=facet,
                            instance_idx=instance_idx, instance=instance,
-                           source_doc=source_doc,
+                           source_doc=source_doc, context_url=context_url,
                            total_instances=total_instances)
 
 
-@app.route('/all_conceptual_metaphors', methods=['GET'])
+@views.route('/all_conceptual_metaphors', methods=['GET'])
 def get_conceptual_metaphors():
     '''
-    Get conceptual metaphors used across all projects. Can set up separate
-    route later for more refined requests if necessary.
+    Conceptual metaphors used across all projects, most used first. Pass
+    ?prefix= to only get those starting with it. Responses carry an ETag, so
+    clients revalidating an unchanged vocabulary get an empty 304.
     '''
+    prefix = request.args.get('prefix', '')
+    etag = models.ConceptualMetaphor.etag(prefix)
+
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify({
+            'conceptual_metaphors':
+                models.ConceptualMetaphor.vocabulary(prefix)
+        })
+
+    response.set_etag(etag)
+
+    return response
 
-    return jsonify({'conceptual_metaphors': PREVIOUSLY_USED_CM})
+
+def rebuild_cm_vocabulary():
+    '''
+    Recount the conceptual metaphor vocabulary from all facets.
+    '''
+    n_metaphors = models.ConceptualMetaphor.rebuild()
+    print('{} conceptual metaphors in use'.format(n_metaphors))
 
 
 class EditInstanceForm(FlaskForm):
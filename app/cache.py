@@ -0,0 +1,197 @@
+'''
+Cache for the rendered pages and query results of the read-only views.
+
+Entries are grouped in namespaces, such as one per facet. Every key
+includes its namespace's generation, so invalidate(namespace) makes all of
+the namespace's entries stale at once by giving it a new generation. This
+only needs get and set from the backend, so any werkzeug.contrib.cache
+client works as a backend, e.g. with
+
+    RESPONSE_CACHE_BACKEND = 'werkzeug.contrib.cache.RedisCache'
+    RESPONSE_CACHE_OPTIONS = {'host': 'localhost'}
+
+in the app config. The default MemoryBackend is per process: with several
+workers, an edit made through one is only seen by the others once their
+entries time out, unless the view keys its entries on something that
+changes with the data, as the facet view does with Facet.last_modified.
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import importlib
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class MemoryBackend:
+    '''
+    In-process backend with the werkzeug.contrib.cache interface. A timeout
+    of 0 never expires; the least recently used entries are dropped when
+    there are more than max_entries.
+    '''
+    def __init__(self, default_timeout=DEFAULT_TIMEOUT,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+
+        self.default_timeout = default_timeout
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key, value, timeout=None):
+
+        if timeout is None:
+            timeout = self.default_timeout
+
+        expires = time.time() + timeout if timeout else None
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return True
+
+    def delete(self, key):
+
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+        return True
+
+
+class NullBackend:
+    '''
+    Backend that caches nothing, set RESPONSE_CACHE_BACKEND to
+    'app.cache.NullBackend' to turn the cache off.
+    '''
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        return True
+
+    def delete(self, key):
+        return False
+
+    def clear(self):
+        return True
+
+
+class ResponseCache:
+    '''
+    Namespaced get_or_set over a backend, see module docstring.
+    '''
+    def __init__(self, backend=None, timeout=DEFAULT_TIMEOUT,
+                 key_prefix='metacorps:'):
+
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Cache set up from RESPONSE_CACHE_BACKEND, the dotted path of a
+        backend class, RESPONSE_CACHE_OPTIONS, its keyword arguments, and
+        RESPONSE_CACHE_TIMEOUT in seconds.
+        '''
+        backend_path = config.get('RESPONSE_CACHE_BACKEND')
+        options = config.get('RESPONSE_CACHE_OPTIONS', {})
+
+        if backend_path:
+            module_name, _, class_name = backend_path.rpartition('.')
+            backend_class = getattr(
+                importlib.import_module(module_name), class_name
+            )
+            backend = backend_class(**options)
+        else:
+            backend = MemoryBackend(**options)
+
+        return cls(
+            backend, timeout=config.get('RESPONSE_CACHE_TIMEOUT',
+                                        DEFAULT_TIMEOUT)
+        )
+
+    def _generation_key(self, namespace):
+        return '{}generation:{}'.format(self.key_prefix, namespace)
+
+    def _generation(self, namespace):
+
+        generation = self.backend.get(self._generation_key(namespace))
+
+        if generation is None:
+            generation = self._new_generation(namespace)
+
+        return generation
+
+    def _new_generation(self, namespace):
+
+        generation = uuid.uuid4().hex
+        self.backend.set(self._generation_key(namespace), generation, 0)
+
+        return generation
+
+    def key(self, namespace, *parts):
+        '''
+        Backend key of the entry identified by parts in namespace.
+        '''
+        return '{}{}:{}:{}'.format(
+            self.key_prefix, namespace, self._generation(namespace),
+            ':'.join(str(part) for part in parts)
+        )
+
+    def get_or_set(self, namespace, parts, make, timeout=None):
+        '''
+        Cached value of the entry identified by namespace and the sequence
+        parts, or the value returned by calling make, which is cached for
+        timeout seconds. None is never cached.
+        '''
+        key = self.key(namespace, *parts)
+
+        value = self.backend.get(key)
+
+        if value is None:
+            value = make()
+            if value is not None:
+                self.backend.set(
+                    key, value, self.timeout if timeout is None else timeout
+                )
+
+        return value
+
+    def invalidate(self, *namespaces):
+        '''
+        Make every entry in namespaces stale.
+        '''
+        for namespace in namespaces:
+            self._new_generation(namespace)
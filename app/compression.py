@@ -0,0 +1,104 @@
+'''
+Compressed storage format for long text fields, used for IatvDocument
+transcripts. Compressed values are stored as BSON binary:
+
+    b'MCZ' + one byte codec id + compressed UTF-8 text
+
+so they can be told apart from plain strings and decoded without knowing
+which codec was configured when they were written. zlib is always
+available; zstd requires the zstandard package.
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import zlib
+
+
+MAGIC = b'MCZ'
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            'zstd transcript compression requires the zstandard package'
+        )
+
+    return zstandard
+
+
+def _zlib_compress(data):
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def _zstd_compress(data):
+    return _zstd().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _zstd_decompress(data):
+    return _zstd().ZstdDecompressor().decompress(data)
+
+
+# codec name: (id byte, compress, decompress)
+CODECS = {
+    'zlib': (b'z', _zlib_compress, zlib.decompress),
+    'zstd': (b's', _zstd_compress, _zstd_decompress),
+}
+
+_CODEC_NAMES = dict((codec_id, name) for name, (codec_id, _, _) in
+                    CODECS.items())
+
+
+def compress_text(text, codec='zlib'):
+    '''
+    Arguments:
+        text (str): text to compress
+        codec (str): one of CODECS
+
+    Returns:
+        (bytes) MAGIC, codec id, and compressed text
+    '''
+    if codec not in CODECS:
+        raise ValueError(
+            'Unknown compression codec {}, choose from {}'.format(
+                codec, ', '.join(sorted(CODECS))
+            )
+        )
+
+    codec_id, compress, _ = CODECS[codec]
+
+    return MAGIC + codec_id + compress(text.encode('utf-8'))
+
+
+def decompress_text(data):
+    '''
+    Inverse of compress_text.
+    '''
+    codec = codec_of(data)
+    if codec is None:
+        raise ValueError('Value is not compressed text')
+
+    _, _, decompress = CODECS[codec]
+
+    return decompress(bytes(data[len(MAGIC) + 1:])).decode('utf-8')
+
+
+def is_compressed(value):
+
+    return (
+        isinstance(value, bytes) and value[:len(MAGIC)] == MAGIC and
+        value[len(MAGIC):len(MAGIC) + 1] in _CODEC_NAMES
+    )
+
+
+def codec_of(value):
+    '''
+    Codec name of a compressed value, or None for plain text.
+    '''
+    if not is_compressed(value):
+        return None
+
+    return _CODEC_NAMES[value[len(MAGIC):len(MAGIC) + 1]]
@@ -0,0 +1,121 @@
+'''
+Concurrent, resumable file downloads, used to fetch the one-minute video
+segments of IatvDocuments. Downloads share one requests.Session, so
+connections to the server are reused, and stream to a temporary file that
+is renamed into place when complete. Files that already exist are skipped,
+so an interrupted download picks up where it stopped.
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import os
+import time
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_RETRIES = 3
+# Seconds before the first retry, doubled for each one after.
+DEFAULT_BACKOFF = 1.0
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 60
+
+
+def make_session(n_workers=DEFAULT_WORKERS):
+    '''
+    Session keeping up to n_workers connections per host open for reuse.
+    '''
+    session = requests.Session()
+
+    adapter = HTTPAdapter(pool_connections=n_workers, pool_maxsize=n_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def download_files(jobs, n_workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES,
+                   backoff=DEFAULT_BACKOFF, session=None):
+    '''
+    Download each (url, path) in jobs with n_workers threads. Paths that
+    already exist are skipped.
+
+    Arguments:
+        jobs (list): (url, path) pairs
+        n_workers (int): number of downloads at once
+        retries (int): retries of a download that fails with a connection
+            error or a server error status
+        backoff (float): seconds before the first retry, doubled for each
+            one after
+        session (requests.Session): defaults to make_session(n_workers)
+
+    Returns:
+        (list) for each job, in order, True if it was downloaded or False
+            if it was skipped
+
+    Raises:
+        requests.RequestException: of the first download that still failed
+            after retrying, once the others have finished
+    '''
+    if session is None:
+        session = make_session(n_workers)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                download_file, url, path, retries, backoff, session
+            )
+            for url, path in jobs
+        ]
+
+    return [future.result() for future in futures]
+
+
+def download_file(url, path, retries=DEFAULT_RETRIES,
+                  backoff=DEFAULT_BACKOFF, session=None):
+    '''
+    Stream url to path unless path exists.
+
+    Returns:
+        (bool) True if downloaded, False if path already existed
+    '''
+    if os.path.exists(path):
+        return False
+
+    if session is None:
+        session = requests.Session()
+
+    tmp_path = path + '.part'
+
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url, stream=True, timeout=TIMEOUT)
+            try:
+                response.raise_for_status()
+
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+            finally:
+                response.close()
+
+            os.replace(tmp_path, path)
+
+            return True
+
+        except requests.RequestException as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+            # client errors won't go away by retrying
+            client_error = (
+                e.response is not None and e.response.status_code < 500
+            )
+            if attempt == retries or client_error:
+                raise
+
+            time.sleep(backoff * 2 ** attempt)
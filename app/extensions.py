@@ -0,0 +1,46 @@
+'''
+Flask extensions shared by the app and its models, and the default app that
+scripts using the models outside of a request get their config and database
+connection from. Nothing here imports the models, so app.models can import
+it while app.app imports app.models.
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import threading
+
+from flask_mongoengine import MongoEngine
+from flask_security import Security
+
+
+db = MongoEngine()
+security = Security()
+
+_default_app = None
+_default_app_lock = threading.RLock()
+
+
+def set_default_app(app):
+    '''
+    Make app the one get_app returns, unless there already is one.
+    '''
+    global _default_app
+
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = app
+
+
+def get_app():
+    '''
+    The first app made by create_app, making one from CONFIG_FILE if there
+    is none yet. Scripts and analysis code using app.models outside of a
+    request get their database connection and config from it.
+    '''
+    if _default_app is None:
+        with _default_app_lock:
+            if _default_app is None:
+                # app.app imports the models, which import this module
+                from .app import create_app
+                create_app()
+
+    return _default_app
@@ -0,0 +1,197 @@
+'''
+Per-coder cache of the instances just ahead in the facet being coded, for
+edit_instance. Coders step through a facet one instance at a time, so
+instead of loading one instance and its source document per page, a window
+of the next instances and their documents' metadata is loaded in two
+queries and the following pages are served from memory.
+
+Edits the coder saves are applied to their window in place through
+record_edit. When the facet's last_modified has moved on from the one the
+window was loaded or last checked at, the window's instance versions and
+the facet's instance count are compared with the stored ones, and the
+window is only rebuilt if another writer changed them.
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import threading
+
+from bson import ObjectId
+from collections import OrderedDict
+
+from .models import IatvDocument
+
+
+DEFAULT_WINDOW_SIZE = 50
+DEFAULT_MAX_WINDOWS = 1000
+
+# IatvDocument fields cached with each window. Transcripts are left out and
+# load on first access as usual.
+DOCUMENT_FIELDS = (
+    'iatv_id', 'iatv_url', 'network', 'program_name', 'start_localtime',
+    'start_time', 'stop_time'
+)
+
+
+class InstanceWindow:
+    '''
+    Instances start to start + window_size of a facet, with the metadata of
+    their source documents, as of the facet's last_modified.
+    '''
+    def __init__(self, facet, start, window_size):
+
+        self.facet_id = facet.pk
+        self.last_modified = facet.last_modified
+        self.start = start
+
+        self.instances = facet.get_instances(start, start + window_size)
+        self.total_instances = facet.count_instances()
+
+        documents = IatvDocument.objects(
+            pk__in=list(set(i.source_id for i in self.instances))
+        ).only(*DOCUMENT_FIELDS)
+
+        self.documents = dict((doc.pk, doc) for doc in documents)
+
+    @property
+    def stop(self):
+        return self.start + len(self.instances)
+
+    def covers(self, facet, idx):
+
+        return facet.pk == self.facet_id and self.start <= idx < self.stop
+
+    def is_current(self, facet):
+        '''
+        Whether the window's instances are still the stored ones. Only
+        queries the facet if its last_modified has changed since the window
+        was loaded or last checked.
+        '''
+        if facet.last_modified == self.last_modified:
+            return True
+
+        versions = [instance.version or 0 for instance in self.instances]
+        if facet.count_instances() != self.total_instances or \
+                facet.instance_versions(self.start, self.stop) != versions:
+            return False
+
+        self.last_modified = facet.last_modified
+
+        return True
+
+    def get(self, idx):
+
+        instance = self.instances[idx - self.start]
+
+        return instance, self.documents.get(instance.source_id)
+
+    def record_edit(self, idx, fields, version):
+        '''
+        Apply fields, just saved to instance idx, which is now at version.
+        Returns False if the instance was also changed by another writer,
+        so the window no longer matches it.
+        '''
+        instance = self.instances[idx - self.start]
+
+        if version != (instance.version or 0) + 1:
+            return False
+
+        for name, value in fields.items():
+            instance[name] = value
+        instance.version = version
+
+        return True
+
+
+class InstanceWindowCache:
+    '''
+    The current InstanceWindow of each (session, facet), least recently used
+    dropped first once there are more than max_windows.
+    '''
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE,
+                 max_windows=DEFAULT_MAX_WINDOWS):
+
+        self.window_size = window_size
+        self.max_windows = max_windows
+
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_key, facet, idx):
+        '''
+        Instance idx of facet with its source document, from the session's
+        window if it covers idx, otherwise from a new window starting at
+        idx. The facet only needs to be loaded without its instances.
+
+        Returns:
+            (Instance, IatvDocument, int): the instance, its source document
+                with metadata only, and the facet's number of instances
+
+        Raises:
+            IndexError: if the facet has no instance idx
+        '''
+        key = (session_key, facet.pk)
+
+        with self._lock:
+            window = self._windows.get(key)
+
+        if window is not None and window.covers(facet, idx) and \
+                window.is_current(facet):
+            with self._lock:
+                if key in self._windows:
+                    self._windows.move_to_end(key)
+            instance, document = window.get(idx)
+            return instance, document, window.total_instances
+
+        if idx < 0:
+            raise IndexError(
+                'Facet {} has no instance {}'.format(facet.word, idx)
+            )
+
+        window = InstanceWindow(facet, idx, self.window_size)
+        if not window.instances:
+            raise IndexError(
+                'Facet {} has no instance {}'.format(facet.word, idx)
+            )
+
+        with self._lock:
+            self._windows[key] = window
+            self._windows.move_to_end(key)
+
+            while len(self._windows) > self.max_windows:
+                self._windows.popitem(last=False)
+
+        instance, document = window.get(idx)
+
+        return instance, document, window.total_instances
+
+    def record_edit(self, session_key, facet_id, idx, fields, version):
+        '''
+        Apply an edit the session saved with Facet.set_instance_fields to
+        its window of the facet, so the window stays current. fields are
+        the fields set and version the instance's new version. Windows of
+        other sessions see the new version and are rebuilt when next used.
+        '''
+        key = (session_key, ObjectId(facet_id))
+
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or not window.start <= idx < window.stop:
+                return
+
+            if not window.record_edit(idx, fields, version):
+                del self._windows[key]
+
+    def invalidate(self, facet_id):
+        '''
+        Drop every session's window of the facet with id facet_id.
+        '''
+        facet_id = ObjectId(facet_id)
+
+        with self._lock:
+            for key in [key for key in self._windows if key[1] == facet_id]:
+                del self._windows[key]
+
+    def clear(self):
+
+        with self._lock:
+            self._windows.clear()
@@ -1,16 +1,49 @@
+import bisect
+import hashlib
 import json
 import numpy as np
 import os
-import requests
 
+from collections import Counter
 from datetime import datetime
+from flask import current_app, has_app_context
+from flask_mongoengine import BaseQuerySet
 from flask_security import UserMixin, RoleMixin
+from mongoengine import NotUniqueError, ValidationError
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, UpdateOne
 
-from .app import db
+from .compression import compress_text, decompress_text, is_compressed
+from .download import DEFAULT_RETRIES, DEFAULT_WORKERS, download_files
+from .extensions import db, get_app
+from .transcripts import line_hash, line_offsets, line_times, parse_srt
 
 DOWNLOAD_BASE_URL = 'https://archive.org/download/'
 
 
+def _config():
+    '''
+    Config of the app handling the current request, or of the default app
+    otherwise.
+    '''
+    return (current_app if has_app_context() else get_app()).config
+
+
+class BaseDocument(db.Document):
+    '''
+    Base of the metacorps documents. The database connection is only made
+    when a document class first uses it, so scripts importing the models
+    don't pay for it on import.
+    '''
+    meta = {'abstract': True}
+
+    @classmethod
+    def _get_db(cls):
+        get_app()
+        return super()._get_db()
+
+
 class Instance(db.EmbeddedDocument):
 
     text = db.StringField(required=True)
@@ -40,16 +73,669 @@ class Instance(db.EmbeddedDocument):
 
     reference_url = db.URLField()
 
+    # When the instance was last edited; None if never edited.
+    last_modified = db.DateTimeField()
+
+    # Incremented by every Facet.set_instance_fields; documents saved before
+    # this field existed count as version 0.
+    version = db.IntField(default=0)
+
+
+# Instance fields coders can change with Facet.set_instance_fields.
+ANNOTATION_FIELDS = (
+    'figurative', 'include', 'conceptual_metaphor', 'objects', 'subjects',
+    'active_passive', 'tense', 'description', 'spoken_by', 'repeat',
+    'repeat_index', 'rerun', 'reviewed'
+)
+
+
+class InstanceVersionConflict(Exception):
+    '''
+    Raised by Facet.set_instance_fields when the instance was changed since
+    the expected version was read.
 
-class Facet(db.Document):
+    Attributes:
+        current (Instance): the instance as it is now stored
+    '''
+    def __init__(self, current):
+        super().__init__(
+            'Instance is at version {}'.format(current.version)
+        )
+        self.current = current
+
+
+# Where a Facet keeps its instances: in the facet document's instances list,
+# or as one InstanceRecord per instance.
+EMBEDDED_STORAGE = 'embedded'
+COLLECTION_STORAGE = 'collection'
+INSTANCE_STORAGE_MODES = (EMBEDDED_STORAGE, COLLECTION_STORAGE)
 
+
+class Facet(BaseDocument):
+    '''
+    Instances of a word in a project. With the default embedded storage the
+    instances are kept in the instances list. With collection storage, for
+    facets too large to rewrite on every edit or to fit in one document,
+    they are InstanceRecords and the instances list is empty. Use
+    get_instance, get_instances, iter_instances, count_instances, and
+    update_instance to work with either; move_instances switches storage.
+    '''
     instances = db.ListField(db.EmbeddedDocumentField(Instance))
     word = db.StringField()
     total_count = db.IntField(default=0)
     number_reviewed = db.IntField(default=0)
 
+    instance_storage = db.StringField(
+        choices=INSTANCE_STORAGE_MODES, default=EMBEDDED_STORAGE
+    )
+
+    # Set by save, and along with Instance.last_modified whenever one of
+    # the instances is edited; used for incremental project exports and to
+    # tell when cached pages are stale. None for facets stored before the
+    # field existed and not edited since, so it is the same on every load.
+    last_modified = db.DateTimeField()
+
+    def save(self, *args, **kwargs):
+        self.last_modified = datetime.now()
+        return super().save(*args, **kwargs)
+
+    def touch(self, instance):
+        '''
+        Mark instance, one of this facet's instances, and the facet itself
+        as modified now. Takes effect on the next save.
+        '''
+        now = datetime.now()
+        instance.last_modified = now
+        self.last_modified = now
+
+    def count_instances(self):
+        '''
+        Number of instances, counted by the database so they aren't loaded.
+        '''
+        if self.instance_storage == COLLECTION_STORAGE:
+            return InstanceRecord.objects(facet=self.pk).count()
+
+        result = list(self._get_collection().aggregate([
+            {'$match': {'_id': self.pk}},
+            {'$project': {'n': {'$size': {'$ifNull': ['$instances', []]}}}}
+        ]))
+
+        return result[0]['n'] if result else 0
+
+    def instance_versions(self, start=0, stop=None):
+        '''
+        Versions of the instances with indices start up to stop, read
+        without loading the instances. Instances from before versions were
+        added count as version 0.
+        '''
+        if self.instance_storage == COLLECTION_STORAGE:
+            query = {'facet': self.pk, 'index': {'$gte': start}}
+            if stop is not None:
+                query['index']['$lt'] = stop
+
+            records = InstanceRecord._get_collection().find(
+                query, {'instance.version': True}
+            ).sort('index')
+
+            return [
+                record.get('instance', {}).get('version') or 0
+                for record in records
+            ]
+
+        # Each instance comes back as {'version': ...}, or {} if it has
+        # none, so positions are kept.
+        raw_facet = self._get_collection().find_one(
+            {'_id': self.pk}, {'instances.version': True}
+        ) or {}
+
+        return [
+            son.get('version') or 0
+            for son in raw_facet.get('instances', [])[start:stop]
+        ]
+
+    def get_instances(self, start=0, stop=None):
+        '''
+        Instances with indices start up to stop, loaded without loading the
+        rest of the facet's instances.
+        '''
+        if self.instance_storage == COLLECTION_STORAGE:
+            records = InstanceRecord.objects(facet=self.pk, index__gte=start)
+            if stop is not None:
+                records = records.filter(index__lt=stop)
+
+            return [record.instance for record in records.order_by('index')]
+
+        if stop is None:
+            stop = self.count_instances()
+
+        if stop <= start:
+            return []
+
+        raw_facet = self._get_collection().find_one(
+            {'_id': self.pk},
+            {'instances': {'$slice': [start, stop - start]}}
+        )
+
+        return [
+            Instance._from_son(son) for son in raw_facet.get('instances', [])
+        ]
+
+    def get_instance(self, idx):
+        '''
+        Instance with index idx. Raises IndexError if there isn't one.
+        '''
+        instances = self.get_instances(idx, idx + 1) if idx >= 0 else []
+
+        if not instances:
+            raise IndexError(
+                'Facet {} has no instance {}'.format(self.word, idx)
+            )
+
+        return instances[0]
+
+    def iter_instances(self):
+        '''
+        All instances in order. With embedded storage these are the loaded
+        instances list, so the facet must have been loaded with it.
+        '''
+        if self.instance_storage == COLLECTION_STORAGE:
+            records = InstanceRecord.objects(facet=self.pk).order_by('index')
+            return (record.instance for record in records)
+
+        return iter(self.instances)
+
+    def update_instance(self, idx, instance):
+        '''
+        Save edits to instance idx, writing only that instance rather than
+        the whole facet. Marks the instance and the facet modified.
+        '''
+        self.touch(instance)
+        instance.version = (instance.version or 0) + 1
+
+        if self.instance_storage == COLLECTION_STORAGE:
+
+            record = InstanceRecord._get_collection().find_one_and_update(
+                {'facet': self.pk, 'index': idx},
+                {'$set': {'instance': instance.to_mongo()}},
+                projection={'instance.conceptual_metaphor': True}
+            )
+            previous = record['instance'] if record is not None else None
+
+            if previous is not None:
+                self._get_collection().update_one(
+                    {'_id': self.pk},
+                    {'$set': {'last_modified': self.last_modified}}
+                )
+
+        else:
+
+            key = 'instances.{}'.format(idx)
+            raw_facet = self._get_collection().find_one_and_update(
+                {'_id': self.pk, key: {'$exists': True}},
+                {'$set': {
+                    key: instance.to_mongo(),
+                    'last_modified': self.last_modified
+                }},
+                projection={'instances': {'$slice': [idx, 1]}}
+            )
+            previous = raw_facet['instances'][0] \
+                if raw_facet is not None else None
+
+        if previous is None:
+            raise IndexError(
+                'Facet {} has no instance {}'.format(self.word, idx)
+            )
+
+        ConceptualMetaphor.record_change(
+            previous.get('conceptual_metaphor'), instance.conceptual_metaphor
+        )
+
+    @classmethod
+    def set_instance_fields(cls, facet_id, idx, fields, expected_version=None):
+        '''
+        Atomically set annotation fields of instance idx of the facet with
+        id facet_id, without loading the facet. The instance version is
+        incremented and the instance and facet last_modified are set in the
+        same write for embedded storage. Conceptual metaphor changes are
+        counted in the ConceptualMetaphor vocabulary.
+
+        Arguments:
+            facet_id (bson.ObjectId): facet id
+            idx (int): instance index
+            fields (dict): new values of any of ANNOTATION_FIELDS
+            expected_version (int): if given, only update if the instance is
+                still at this version, otherwise raise InstanceVersionConflict
+
+        Returns:
+            (dict) the updated fields with version and last_modified, as
+                stored
+        '''
+        values = _annotation_values(fields)
+
+        now = datetime.now()
+
+        def _update(prefix):
+            update = {
+                '$set': dict(
+                    (prefix + name, value) for name, value in values.items()
+                ),
+                '$inc': {prefix + 'version': 1}
+            }
+            update['$set'][prefix + 'last_modified'] = now
+            return update
+
+        def _version_filter(prefix):
+            if expected_version is None:
+                return {}
+            return _version_query(prefix + 'version', expected_version)
+
+        facet_id = ObjectId(facet_id)
+        key = 'instances.{}'.format(idx)
+
+        query = {
+            '_id': facet_id,
+            'instance_storage': {'$ne': COLLECTION_STORAGE},
+            key: {'$exists': True}
+        }
+        query.update(_version_filter(key + '.'))
+
+        update = _update(key + '.')
+        update['$set']['last_modified'] = now
+
+        raw_facet = cls._get_collection().find_one_and_update(
+            query, update,
+            projection={'instances': {'$slice': [idx, 1]}}
+        )
+
+        if raw_facet is not None:
+            return _after_instance_update(
+                raw_facet['instances'][0], values, now
+            )
 
-class Project(db.Document):
+        raw_facet = cls._get_collection().find_one(
+            {'_id': facet_id}, {'instance_storage': True}
+        )
+        if raw_facet is None:
+            raise cls.DoesNotExist('No Facet with id {}'.format(facet_id))
+
+        if raw_facet.get('instance_storage') == COLLECTION_STORAGE:
+
+            query = {'facet': facet_id, 'index': idx}
+            query.update(_version_filter('instance.'))
+
+            record = InstanceRecord._get_collection().find_one_and_update(
+                query, _update('instance.'),
+                projection={'instance': True}
+            )
+
+            if record is not None:
+                cls._get_collection().update_one(
+                    {'_id': facet_id}, {'$set': {'last_modified': now}}
+                )
+                return _after_instance_update(
+                    record['instance'], values, now
+                )
+
+        # Either there is no such instance or it is at another version.
+        storage = raw_facet.get('instance_storage', EMBEDDED_STORAGE)
+        current = cls(id=facet_id, instance_storage=storage).get_instance(idx)
+
+        raise InstanceVersionConflict(current)
+
+    @classmethod
+    def set_many_instance_fields(cls, changes):
+        '''
+        Facet.set_instance_fields for many instances of any facets, written
+        with one ordered bulk write to the facets and one to the instance
+        records. Each change is validated and checked against the current
+        instance version on its own, so one bad change doesn't stop the
+        others.
+
+        Arguments:
+            changes (list): dicts with the facet id, the instance index,
+                fields, a dict of new annotation values, and optionally
+                version, the expected instance version
+
+        Returns:
+            (list) for each change, in order, {'ok': True, 'version': new
+                version} or {'ok': False, 'error': message}, with
+                'conflict': True and the current version if the instance is
+                not at the expected version
+        '''
+        results = [None] * len(changes)
+        parsed = []
+
+        for change_idx, change in enumerate(changes):
+            try:
+                facet_id = ObjectId(change['facet'])
+                idx = int(change['index'])
+                values = _annotation_values(change.get('fields') or {})
+
+                expected = change.get('version')
+                if expected is not None:
+                    expected = int(expected)
+
+            except KeyError as e:
+                results[change_idx] = _failed('Missing ' + str(e))
+                continue
+
+            except (TypeError, ValueError, InvalidId,
+                    ValidationError) as e:
+                results[change_idx] = _failed(str(e))
+                continue
+
+            parsed.append((change_idx, facet_id, idx, values, expected))
+
+        storage = dict(
+            (raw['_id'], raw.get('instance_storage', EMBEDDED_STORAGE))
+            for raw in cls._get_collection().find(
+                {'_id': {'$in': list(set(p[1] for p in parsed))}},
+                {'instance_storage': True}
+            )
+        )
+
+        # Version and conceptual metaphor of each instance to be changed.
+        current = {}
+
+        embedded_ids = [
+            facet_id for facet_id, mode in storage.items()
+            if mode != COLLECTION_STORAGE
+        ]
+        for raw_facet in cls._get_collection().find(
+                {'_id': {'$in': embedded_ids}},
+                {'instances.version': True,
+                 'instances.conceptual_metaphor': True}):
+            for idx, son in enumerate(raw_facet.get('instances', [])):
+                current[(raw_facet['_id'], idx)] = son
+
+        record_keys = set(
+            (facet_id, idx) for _, facet_id, idx, _, _ in parsed
+            if storage.get(facet_id) == COLLECTION_STORAGE
+        )
+        if record_keys:
+            for record in InstanceRecord._get_collection().find(
+                    {'$or': [{'facet': facet_id, 'index': idx}
+                             for facet_id, idx in record_keys]},
+                    {'facet': True, 'index': True,
+                     'instance.version': True,
+                     'instance.conceptual_metaphor': True}):
+                current[(record['facet'], record['index'])] = \
+                    record['instance']
+
+        # Stored datetimes are truncated to the millisecond; so is now, so
+        # written instances can be recognized by it below.
+        now = datetime.now()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+        facet_operations = []
+        record_operations = []
+        touched_facets = set()
+        written = []
+
+        for change_idx, facet_id, idx, values, expected in parsed:
+
+            if facet_id not in storage:
+                results[change_idx] = _failed(
+                    'No Facet with id {}'.format(facet_id)
+                )
+                continue
+
+            son = current.get((facet_id, idx))
+            if son is None:
+                results[change_idx] = _failed(
+                    'Facet {} has no instance {}'.format(facet_id, idx)
+                )
+                continue
+
+            version = son.get('version') or 0
+            if expected is not None and expected != version:
+                results[change_idx] = _failed(
+                    'Instance is at version {}'.format(version),
+                    conflict=True, version=version
+                )
+                continue
+
+            if storage[facet_id] == COLLECTION_STORAGE:
+                prefix = 'instance.'
+                query = {'facet': facet_id, 'index': idx}
+                operations = record_operations
+                touched_facets.add(facet_id)
+            else:
+                prefix = 'instances.{}.'.format(idx)
+                query = {'_id': facet_id}
+                operations = facet_operations
+
+            # Only written if nothing else changed the instance since it
+            # was read above.
+            query.update(_version_query(prefix + 'version', version))
+
+            update = {
+                '$set': dict(
+                    (prefix + name, value) for name, value in values.items()
+                ),
+                '$inc': {prefix + 'version': 1}
+            }
+            update['$set'][prefix + 'last_modified'] = now
+            if operations is facet_operations:
+                update['$set']['last_modified'] = now
+
+            operations.append(UpdateOne(query, update))
+
+            written.append((
+                change_idx, facet_id, idx, son.get('conceptual_metaphor'),
+                values, version + 1
+            ))
+
+            # later changes to the same instance build on this one
+            current[(facet_id, idx)] = dict(
+                son, version=version + 1,
+                conceptual_metaphor=values.get(
+                    'conceptual_metaphor', son.get('conceptual_metaphor')
+                )
+            )
+
+        facet_operations.extend(
+            UpdateOne({'_id': facet_id}, {'$set': {'last_modified': now}})
+            for facet_id in touched_facets
+        )
+
+        facets_complete = records_complete = True
+
+        if facet_operations:
+            result = cls._get_collection().bulk_write(facet_operations)
+            facets_complete = result.matched_count == len(facet_operations)
+
+        if record_operations:
+            result = InstanceRecord._get_collection().bulk_write(
+                record_operations
+            )
+            records_complete = \
+                result.matched_count == len(record_operations)
+
+        # Unmatched writes lost a race with another edit; find them by
+        # whether the instance has this write's last_modified.
+        unmatched = set()
+        for _, facet_id, idx, _, _, _ in written:
+
+            if storage[facet_id] == COLLECTION_STORAGE:
+                complete = records_complete
+            else:
+                complete = facets_complete
+
+            if complete:
+                continue
+
+            instance = cls(
+                id=facet_id, instance_storage=storage[facet_id]
+            ).get_instance(idx)
+
+            if instance.last_modified != now:
+                unmatched.add((facet_id, idx))
+
+        for change_idx, facet_id, idx, old_cm, values, version in written:
+
+            if (facet_id, idx) in unmatched:
+                results[change_idx] = _failed(
+                    'Instance was changed by another edit', conflict=True
+                )
+                continue
+
+            if 'conceptual_metaphor' in values:
+                ConceptualMetaphor.record_change(
+                    old_cm, values['conceptual_metaphor']
+                )
+
+            results[change_idx] = {'ok': True, 'version': version}
+
+        return results
+
+    def move_instances(self, storage, batch_size=1000):
+        '''
+        Move the instances to the given storage, one of
+        INSTANCE_STORAGE_MODES. Instance order and indices are kept. Readers
+        see the old storage until the facet is switched over in one update.
+        '''
+        if storage not in INSTANCE_STORAGE_MODES:
+            raise ValueError('Unknown instance storage ' + storage)
+
+        if storage == self.instance_storage:
+            return
+
+        collection = self._get_collection()
+
+        if storage == COLLECTION_STORAGE:
+
+            # Clear records left by an earlier, interrupted move.
+            InstanceRecord.objects(facet=self.pk).delete()
+
+            raw_facet = collection.find_one(
+                {'_id': self.pk}, {'instances': True}
+            )
+            raw_instances = raw_facet.get('instances', [])
+
+            for batch_start in range(0, len(raw_instances), batch_size):
+                InstanceRecord._get_collection().insert_many([
+                    {'facet': self.pk, 'index': idx, 'instance': son}
+                    for idx, son in enumerate(
+                        raw_instances[batch_start:batch_start + batch_size],
+                        batch_start
+                    )
+                ])
+
+            collection.update_one({'_id': self.pk}, {
+                '$set': {'instance_storage': COLLECTION_STORAGE},
+                '$unset': {'instances': ''}
+            })
+
+            self.instances = []
+
+        else:
+
+            raw_instances = [
+                raw['instance'] for raw in
+                InstanceRecord._get_collection().find(
+                    {'facet': self.pk}, {'instance': True}
+                ).sort('index', 1)
+            ]
+
+            collection.update_one({'_id': self.pk}, {
+                '$set': {
+                    'instance_storage': EMBEDDED_STORAGE,
+                    'instances': raw_instances
+                }
+            })
+
+            InstanceRecord.objects(facet=self.pk).delete()
+
+            self.instances = [
+                Instance._from_son(son) for son in raw_instances
+            ]
+
+        self.instance_storage = storage
+        self._clear_changed_fields()
+
+
+def _version_query(key, version):
+    '''
+    Query for an instance version stored at key. Instances from before
+    versions were added have none, which counts as version 0.
+    '''
+    if version == 0:
+        return {key: {'$in': [0, None]}}
+
+    return {key: version}
+
+
+def _failed(error, **details):
+
+    result = {'ok': False, 'error': error}
+    result.update(details)
+
+    return result
+
+
+def _annotation_values(fields):
+    '''
+    Validated annotation fields converted for storage. Raises ValueError
+    for fields that aren't in ANNOTATION_FIELDS and ValidationError for bad
+    values.
+    '''
+    unknown = set(fields) - set(ANNOTATION_FIELDS)
+    if unknown:
+        raise ValueError(
+            'Not annotation fields: ' + ', '.join(sorted(unknown))
+        )
+
+    values = {}
+    for name, value in fields.items():
+        field = Instance._fields[name]
+        if value is not None:
+            field.validate(value)
+            value = field.to_mongo(value)
+        values[name] = value
+
+    return values
+
+
+def _after_instance_update(previous, values, now):
+    '''
+    Count a conceptual metaphor change made by Facet.set_instance_fields and
+    return the fields it set, as JSON, given the instance as it was before.
+    '''
+    ConceptualMetaphor.record_change(
+        previous.get('conceptual_metaphor'),
+        values.get('conceptual_metaphor', previous.get('conceptual_metaphor'))
+    )
+
+    updated = dict(previous)
+    updated.update(values)
+    updated['version'] = (previous.get('version') or 0) + 1
+    updated['last_modified'] = now
+
+    instance = json.loads(Instance._from_son(updated).to_json())
+
+    return dict(
+        (name, instance.get(name))
+        for name in list(values) + ['version', 'last_modified']
+    )
+
+
+class InstanceRecord(BaseDocument):
+    '''
+    One instance of a facet with collection instance storage, see Facet.
+    '''
+    facet = db.ReferenceField(Facet, required=True)
+    index = db.IntField(required=True)
+    instance = db.EmbeddedDocumentField(Instance, required=True)
+
+    meta = {
+        'indexes': [
+            {'fields': ('facet', 'index'), 'unique': True}
+        ]
+    }
+
+
+class Project(BaseDocument):
 
     name = db.StringField(required=True)
 
@@ -58,13 +744,58 @@ class Project(db.Document):
     created = db.DateTimeField(default=datetime.now)
     last_modified = db.DateTimeField(default=datetime.now)
 
+    def save(self, *args, **kwargs):
+        self.last_modified = datetime.now()
+        return super().save(*args, **kwargs)
+
+    def facet_ids(self):
+        '''
+        Ids of the project's facets, read without dereferencing the facets.
+        '''
+        raw_project = self._get_collection().find_one(
+            {'_id': self.pk}, {'facets': True}
+        )
+
+        return [
+            getattr(ref, 'id', ref) for ref in raw_project.get('facets', [])
+        ]
+
+    def get_facet(self, word, load_instances=True):
+        '''
+        The project's first facet for word, fetched on its own instead of
+        dereferencing every facet of the project.
+
+        Arguments:
+            word (str): facet word
+            load_instances (bool): if False, leave the instances in the
+                database; use Facet.get_instances to page through them. A
+                facet loaded this way must not be saved.
+
+        Returns:
+            (Facet)
+        '''
+        facet_ids = self.facet_ids()
+
+        facets = Facet.objects(pk__in=facet_ids, word=word)
+        if not load_instances:
+            facets = facets.exclude('instances')
+
+        facets = list(facets)
+        if not facets:
+            raise Facet.DoesNotExist(
+                'No facet {} in project {}'.format(word, self.name)
+            )
+
+        return min(facets, key=lambda facet: facet_ids.index(facet.pk))
+
     def add_facet_from_search_results(self, facet_label, search_results):
 
         instances = []
         for res in search_results:
 
-            doc = IatvDocument.from_search_result(res)
-            doc.save()
+            doc = IatvDocument.from_search_result(res).upsert(
+                overwrite=False
+            )
             new_instance = Instance(doc.document_data, doc.id)
             # new_instance.save()
             instances.append(new_instance)
@@ -93,8 +824,9 @@ class Project(db.Document):
 
             instances = []
             for res in search_results:
-                doc = IatvDocument.from_search_result(res)
-                doc.save()
+                doc = IatvDocument.from_search_result(res).upsert(
+                    overwrite=False
+                )
                 new_instance = Instance(doc.document_data, doc.id)
                 # new_instance.save()
                 instances.append(new_instance)
@@ -108,11 +840,101 @@ class Project(db.Document):
         return cls(project_name, facets)
 
 
-class IatvDocument(db.Document):
+class DeferredStringField(db.StringField):
+    '''
+    StringField that a document can leave unloaded, see IatvDocument. The
+    value is fetched from the database the first time it is read.
+    '''
+    def __get__(self, instance, owner):
+
+        if instance is not None and self.name in instance._deferred:
+            instance._load_deferred()
+
+        return super().__get__(instance, owner)
+
+    def __set__(self, instance, value):
+
+        if self.name in instance._deferred:
+            instance._deferred = instance._deferred - {self.name}
+
+        super().__set__(instance, value)
+
+
+class CompressedTextField(DeferredStringField):
+    '''
+    DeferredStringField written compressed with the codec named by
+    TRANSCRIPT_COMPRESSION in the app config, if it is set. Compressed and
+    plain stored values are both read back as str, see app.compression.
+    '''
+    def to_python(self, value):
+
+        if is_compressed(value):
+            return decompress_text(value)
+
+        return super().to_python(value)
+
+    def to_mongo(self, value, *args, **kwargs):
+
+        value = super().to_mongo(value, *args, **kwargs)
+
+        codec = _config().get('TRANSCRIPT_COMPRESSION')
+        if codec and isinstance(value, str):
+            return compress_text(value, codec)
+
+        return value
 
-    document_data = db.StringField(required=True)
-    raw_srt = db.StringField()
-    iatv_id = db.StringField(required=True)
+
+# Transcript fields left out of IatvDocument.objects queries.
+TRANSCRIPT_FIELDS = ('document_data', 'raw_srt')
+
+
+class IatvDocumentQuerySet(BaseQuerySet):
+    '''
+    QuerySet marking the transcript fields its projection leaves out as
+    deferred on the IatvDocuments it returns. Fields a stored document
+    doesn't have aren't deferred if the query loaded them, so reading them
+    makes no query.
+    '''
+    def _deferred_fields(self):
+
+        loaded = self._loaded_fields
+        if not loaded:
+            return frozenset()
+
+        # excluded fields, or those not among the only fields
+        return frozenset(
+            name for name in TRANSCRIPT_FIELDS
+            if (self._document._fields[name].db_field in loaded.fields) ==
+            (loaded.value == loaded.EXCLUDE)
+        )
+
+    def _with_deferred(self, doc):
+
+        if isinstance(doc, self._document):
+            doc._deferred = self._deferred_fields()
+
+        return doc
+
+    def __next__(self):
+        return self._with_deferred(super().__next__())
+
+    def __getitem__(self, key):
+        return self._with_deferred(super().__getitem__(key))
+
+
+class IatvDocument(BaseDocument):
+    '''
+    A show transcript from the Internet Archive TV News Archive.
+
+    IatvDocument.objects only loads metadata. The transcript fields,
+    document_data and raw_srt, are fetched together with one query when
+    either is first read. Use IatvDocument.with_transcripts to load them
+    up front, e.g. when iterating over many documents' transcripts.
+    '''
+    document_data = CompressedTextField(required=True)
+    raw_srt = CompressedTextField()
+    # unique, so existence checks use the index and ingests can upsert
+    iatv_id = db.StringField(required=True, unique=True)
     iatv_url = db.URLField(required=True)
 
     network = db.StringField()
@@ -125,7 +947,152 @@ class IatvDocument(db.Document):
     runtime_seconds = db.FloatField()
     utc_offset = db.StringField()
 
-    datetime_added = db.DateTimeField(default=datetime.now())
+    datetime_added = db.DateTimeField(default=datetime.now)
+    # Set by save and upsert; used for incremental project exports.
+    last_modified = db.DateTimeField(default=datetime.now)
+
+    meta = {
+        # Supports the date-range, network, and program filters and groupings
+        # in projects.common.corpus_stats.
+        'indexes': [
+            ('start_localtime', 'network', 'program_name'),
+            ('program_name', 'start_localtime'),
+            'last_modified'
+        ],
+        'queryset_class': IatvDocumentQuerySet
+    }
+
+    # Names of DeferredStringFields not loaded yet, see IatvDocumentQuerySet.
+    _deferred = frozenset()
+
+    @db.queryset_manager
+    def objects(doc_cls, queryset):
+        return queryset.exclude(*TRANSCRIPT_FIELDS)
+
+    @db.queryset_manager
+    def with_transcripts(doc_cls, queryset):
+        return queryset
+
+    def _load_deferred(self):
+
+        deferred = [self._fields[name] for name in self._deferred]
+        self._deferred = frozenset()
+
+        if not deferred or self.pk is None:
+            return
+
+        son = self._get_collection().find_one(
+            {'_id': self.pk},
+            dict((field.db_field, True) for field in deferred)
+        ) or {}
+
+        # Set _data directly so loading doesn't mark the fields as changed.
+        for field in deferred:
+            value = son.get(field.db_field)
+            self._data[field.name] = (
+                field.to_python(value) if value is not None else None
+            )
+
+    def validate(self, clean=True):
+
+        # Required transcript fields are only known to be present if loaded.
+        self._load_deferred()
+
+        return super().validate(clean=clean)
+
+    def save(self, *args, **kwargs):
+        self.last_modified = datetime.now()
+        return super().save(*args, **kwargs)
+
+    def upsert(self, overwrite=True):
+        '''
+        Insert this document, or replace the stored document with the same
+        iatv_id, keeping its id and datetime_added. Replacing drops the
+        stored transcript, compressed or not, and its TranscriptIndex, and
+        unsets fields this document doesn't have. Safe to repeat and to run
+        concurrently with other ingests.
+
+        Arguments:
+            overwrite (bool): if False, leave a stored document as it is,
+                e.g. so a search result snippet doesn't replace an
+                ingested transcript
+
+        Returns:
+            (IatvDocument) self, with id and datetime_added of the stored
+                document
+        '''
+        stored = self._get_collection().find_one_and_update(
+            {'iatv_id': self.iatv_id},
+            self._upsert_update(overwrite),
+            projection={'datetime_added': True},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        if overwrite:
+            # line offsets of the old transcript no longer apply
+            TranscriptIndex.objects(iatv_id=self.iatv_id).delete()
+
+        self.id = stored['_id']
+        self.datetime_added = stored['datetime_added']
+
+        # now in the database; a later save() updates rather than inserts
+        self._created = False
+        self._clear_changed_fields()
+
+        return self
+
+    @classmethod
+    def upsert_many(cls, documents, ordered=False):
+        '''
+        Bulk version of IatvDocument.upsert for unsaved documents, always
+        replacing stored documents.
+
+        Returns:
+            (pymongo.results.BulkWriteResult) upserted_count is the number
+                of new documents, matched_count the number already stored
+        '''
+        operations = [
+            UpdateOne(
+                {'iatv_id': doc.iatv_id}, doc._upsert_update(), upsert=True
+            )
+            for doc in documents
+        ]
+
+        TranscriptIndex.objects(
+            iatv_id__in=[doc.iatv_id for doc in documents]
+        ).delete()
+
+        return cls._get_collection().bulk_write(operations, ordered=ordered)
+
+    def _upsert_update(self, overwrite=True):
+
+        self.last_modified = datetime.now()
+        self.validate()
+
+        son = self.to_mongo()
+        son.pop('_id', None)
+        datetime_added = son.pop('datetime_added', None) or datetime.now()
+
+        if not overwrite:
+            son['datetime_added'] = datetime_added
+            return {'$setOnInsert': son}
+
+        update = {
+            '$set': son,
+            '$setOnInsert': {'datetime_added': datetime_added}
+        }
+
+        # fields left over from the stored version
+        unset = dict(
+            (field.db_field, '') for field in self._fields.values()
+            if field.db_field not in son and
+            field.db_field not in ('_id', 'datetime_added')
+        )
+        if unset:
+            update['$unset'] = unset
+
+        return update
 
     @classmethod
     def from_search_result(cls, search_result):
@@ -164,38 +1131,232 @@ class IatvDocument(db.Document):
                    network=network, program_name=program_name,
                    start_localtime=start_localtime)
 
-    def download_video(self, download_dir):
+    def download_video(self, download_dir, n_workers=DEFAULT_WORKERS,
+                       retries=DEFAULT_RETRIES, base_url=DOWNLOAD_BASE_URL):
+        '''
+        Download the show as one-minute mp4 segments named
+        <iatv_id>_<minute>.mp4 into download_dir, n_workers at a time.
+        Segments already in download_dir are skipped, so running this again
+        resumes an interrupted download. See app.download.download_files.
 
+        Returns:
+            (list) paths of all the segments, in order
+        '''
         segments = int(np.ceil(self.runtime_seconds / 60.0))
 
+        jobs = []
         for i in range(segments):
             start_time = i * 60
             stop_time = (i + 1) * 60
-            download_url = DOWNLOAD_BASE_URL + self.iatv_id + '/' +\
+            download_url = base_url + self.iatv_id + '/' +\
                 self.iatv_id + '.mp4?t=' + str(start_time) + '/' +\
                 str(stop_time) + '&exact=1&ignore=x.mp4'
 
-            res = requests.get(download_url)
-
             download_path = os.path.join(
                 download_dir, '{}_{}.mp4'.format(self.iatv_id, i))
 
-            with open(download_path, 'wb') as handle:
-                handle.write(res.content)
+            jobs.append((download_url, download_path))
+
+        download_files(jobs, n_workers=n_workers, retries=retries)
+
+        return [path for _, path in jobs]
+
+    def transcript_context(self, text, n_lines=5):
+        '''
+        The transcript lines around the first line matching text, using the
+        document's TranscriptIndex so only those lines are read.
+
+        Arguments:
+            text (str): instance text, normally a whole transcript line
+            n_lines (int): number of lines to include before and after
+
+        Returns:
+            (dict) line, the index of the matching line or None if text
+                isn't in the transcript, and lines, a list of dicts with
+                the line index, text, and caption start time in seconds
+        '''
+        if not text.strip():
+            return {'line': None, 'lines': []}
+
+        index = TranscriptIndex.for_document(self)
+
+        line = index.find_line(text)
+
+        if line is None:
+            # e.g. search result snippets, which span lines
+            offset = (self.document_data or '').find(text.strip())
+            if offset == -1:
+                return {'line': None, 'lines': []}
+
+            line = bisect.bisect_right(index.line_offsets, offset) - 1
+
+        start = max(line - n_lines, 0)
+        stop = min(line + n_lines + 1, index.n_lines)
+
+        offsets = index.line_offsets
+        transcript = self.transcript_slice(offsets[start], offsets[stop])
+
+        return {
+            'line': line,
+            'lines': [
+                {
+                    'line': idx,
+                    'text': transcript[
+                        offsets[idx] - offsets[start]:
+                        offsets[idx + 1] - offsets[start]
+                    ].rstrip('\n'),
+                    'time': index.line_times[idx]
+                }
+                for idx in range(start, stop)
+            ]
+        }
+
+    def transcript_slice(self, start, stop):
+        '''
+        Characters start to stop of document_data. Unless the transcript is
+        already loaded, only that part is read from the database, or all of
+        it if it is stored compressed.
+        '''
+        if 'document_data' not in self._deferred or self.pk is None:
+            return (self.document_data or '')[start:stop]
+
+        field = '$' + self._fields['document_data'].db_field
+
+        result = list(self._get_collection().aggregate([
+            {'$match': {'_id': self.pk}},
+            {'$project': {'text': {'$cond': [
+                {'$eq': [{'$type': field}, 'string']},
+                {'$substrCP': [field, start, stop - start]},
+                field
+            ]}}}
+        ]))
+
+        value = result[0].get('text') if result else None
+
+        if is_compressed(value):
+            return decompress_text(value)[start:stop]
+
+        return value or ''
+
+
+class TranscriptIndex(BaseDocument):
+    '''
+    Line offsets, line hashes, and caption start times of the transcript of
+    the IatvDocument with iatv_id, see app.transcripts. Built the first time
+    it is needed and dropped when the document is upserted again.
+    '''
+    iatv_id = db.StringField(required=True, unique=True)
+
+    # line i of the transcript is document_data[line_offsets[i]:
+    # line_offsets[i + 1]]
+    line_offsets = db.ListField(db.IntField())
+    line_hashes = db.ListField(db.IntField())
+    # seconds from the start of the show, or None
+    line_times = db.ListField()
+
+    @property
+    def n_lines(self):
+        return len(self.line_offsets) - 1
+
+    @classmethod
+    def for_document(cls, document):
+        '''
+        Index of document, built and stored if there isn't one.
+        '''
+        index = cls.objects(iatv_id=document.iatv_id).first()
+
+        if index is None:
+            index = cls.build(document)
+            try:
+                index.save()
+            except NotUniqueError:
+                # built by another request in the meantime
+                pass
+
+        return index
+
+    @classmethod
+    def build(cls, document):
+
+        text = document.document_data or ''
+
+        offsets = line_offsets(text)
+        lines = [text[a:b] for a, b in zip(offsets, offsets[1:])]
+
+        cues = parse_srt(document.raw_srt) if document.raw_srt else []
+
+        return cls(
+            iatv_id=document.iatv_id,
+            line_offsets=offsets,
+            line_hashes=[line_hash(line) for line in lines],
+            line_times=line_times(lines, cues)
+        )
+
+    def find_line(self, text):
+        '''
+        Index of the first line equal to text, ignoring case and whitespace
+        differences, or None.
+        '''
+        try:
+            return self.line_hashes.index(line_hash(text))
+        except ValueError:
+            return None
 
 
-class IatvCorpus(db.Document):
+class IatvCorpus(BaseDocument):
 
     name = db.StringField()
     documents = db.ListField(db.ReferenceField(IatvDocument))
 
+    # Deduplicated {'date', 'network', 'program_name'} shows in the corpus,
+    # see projects.common.analysis.corpus_shows_index. shows_index_key
+    # identifies the documents the index was built from; the index is
+    # cleared whenever documents is changed through save().
+    shows_index = db.ListField(db.DictField())
+    shows_index_key = db.StringField()
 
-class Role(db.Document, RoleMixin):
+    def document_ids(self):
+        '''
+        Ids of the corpus documents, read without dereferencing them.
+        '''
+        changed = any(
+            field.split('.')[0] == 'documents'
+            for field in self._get_changed_fields()
+        )
+
+        if self.pk is None or changed:
+            refs = self._data.get('documents') or []
+        else:
+            refs = IatvCorpus._get_collection().find_one(
+                {'_id': self.pk}, {'documents': True}
+            ).get('documents', [])
+
+        return [getattr(ref, 'pk', getattr(ref, 'id', ref)) for ref in refs]
+
+    def membership_key(self):
+        '''
+        Hash of the corpus document ids, independent of their order.
+        '''
+        ids = sorted(str(doc_id) for doc_id in self.document_ids())
+
+        return hashlib.sha1(','.join(ids).encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+
+        if any(field.split('.')[0] == 'documents'
+               for field in self._get_changed_fields()):
+            self.shows_index = []
+            self.shows_index_key = None
+
+        return super().save(*args, **kwargs)
+
+
+class Role(BaseDocument, RoleMixin):
     name = db.StringField(max_length=80, unique=True)
     description = db.StringField(max_length=255)
 
 
-class User(db.Document, UserMixin):
+class User(BaseDocument, UserMixin):
     email = db.StringField(max_length=255)
     password = db.StringField(max_length=255)
     active = db.BooleanField(default=True)
@@ -203,7 +1364,121 @@ class User(db.Document, UserMixin):
     roles = db.ListField(db.ReferenceField(Role), default=[])
 
 
-class Log(db.Document):
+class ConceptualMetaphor(BaseDocument):
+    '''
+    Vocabulary of conceptual metaphors coders have used, with the number of
+    instances currently using each. Kept up to date by Facet.update_instance
+    and Facet.set_instance_fields; rebuild recounts it from every facet.
+    '''
+    name = db.StringField(required=True, unique=True)
+    count = db.IntField(default=0)
+    updated = db.DateTimeField(default=datetime.now)
+
+    meta = {
+        'indexes': ['-updated', ('-count', 'name')]
+    }
+
+    @staticmethod
+    def normalize(name):
+        return (name or '').lower().strip()
+
+    @classmethod
+    def record_change(cls, old_name, new_name):
+        '''
+        Move one use from old_name to new_name; either may be empty.
+        '''
+        old_name = cls.normalize(old_name)
+        new_name = cls.normalize(new_name)
+
+        if old_name == new_name:
+            return
+
+        collection = cls._get_collection()
+        now = datetime.now()
+
+        if old_name:
+            collection.update_one(
+                {'name': old_name},
+                {'$inc': {'count': -1}, '$set': {'updated': now}}
+            )
+
+        if new_name:
+            collection.update_one(
+                {'name': new_name},
+                {'$inc': {'count': 1}, '$set': {'updated': now}},
+                upsert=True
+            )
+
+    @classmethod
+    def vocabulary(cls, prefix=''):
+        '''
+        Names in use starting with prefix, most used first.
+        '''
+        names = cls.objects(count__gt=0)
+
+        prefix = cls.normalize(prefix)
+        if prefix:
+            names = names.filter(name__startswith=prefix)
+
+        return list(names.order_by('-count', 'name').scalar('name'))
+
+    @classmethod
+    def etag(cls, prefix=''):
+        '''
+        Changes whenever the vocabulary, or the list for prefix, may have.
+        '''
+        latest = cls.objects.order_by('-updated').only('updated').first()
+
+        state = '{}|{}|{}'.format(
+            cls.objects.count(),
+            latest.updated.isoformat() if latest is not None else '',
+            cls.normalize(prefix)
+        )
+
+        return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def rebuild(cls):
+        '''
+        Recount the vocabulary from the instances of every facet.
+
+        Returns:
+            (int) number of distinct conceptual metaphors
+        '''
+        counts = Counter()
+
+        for raw_facet in Facet._get_collection().find(
+                {}, {'instances.conceptual_metaphor': True}):
+            counts.update(
+                cls.normalize(raw.get('conceptual_metaphor'))
+                for raw in raw_facet.get('instances', [])
+            )
+
+        for record in InstanceRecord._get_collection().find(
+                {}, {'instance.conceptual_metaphor': True}):
+            counts[cls.normalize(
+                record['instance'].get('conceptual_metaphor')
+            )] += 1
+
+        del counts['']
+
+        now = datetime.now()
+        cls.objects.delete()
+        if counts:
+            cls._get_collection().insert_many([
+                {'name': name, 'count': count, 'updated': now}
+                for name, count in counts.items()
+            ])
+
+        return len(counts)
+
+
+class Log(BaseDocument):
     time_posted = db.DateTimeField(default=datetime.now)
     user_email = db.StringField()
     message = db.StringField()
+
+    # for the latest entries shown on the home page
+    meta = {
+        'indexes': ['-time_posted']
+    }
@@ -5,14 +5,26 @@
  */
 
 
+// Version of each instance when it was opened for editing. It is sent back
+// with the changes so another coder's edits made in the meantime are not
+// overwritten.
+var instanceVersions = {};
+
+
+function instanceRoute(instanceIndex) {
+  return '/api/facets/' + facetId + '/instances/' + instanceIndex;
+}
+
+
 function editInstance(instanceIndex) {
 
-  var apiRoute =  '/api' + window.location.pathname +
-    '/instances/' + instanceIndex;
+  var apiRoute = instanceRoute(instanceIndex);
 
   $.get(apiRoute).done(
     (instanceData) => {
 
+      instanceVersions[instanceIndex] = instanceData["version"] || 0;
+
       var fig_checked =  instanceData["figurative"] ? 'checked' : '';
       var incl_checked =  instanceData["include"] ? 'checked' : '';
       var repeat_checked =  instanceData["repeat"] ? 'checked' : '';
@@ -89,8 +101,7 @@ function editInstance(instanceIndex) {
  */
 function freezeSaveUpdates(instanceIndex) {
 
-  var apiRoute =  '/api' + window.location.pathname +
-    '/instances/' + instanceIndex;
+  var apiRoute = instanceRoute(instanceIndex);
 
   var figChecked = $('#figurative').prop('checked');
   var inclChecked = $('#include').prop('checked');
@@ -114,10 +125,20 @@ function freezeSaveUpdates(instanceIndex) {
     rerun: rerun,
     tense: $('#tense').val(),
     description: $('#description').val(),
-    active_passive: $('#active_passive').val()
+    active_passive: $('#active_passive').val(),
+    version: instanceVersions[instanceIndex]
   };
 
-  $.post(apiRoute, updatedData, (instanceData) => {
+  $.post(apiRoute, updatedData).fail((xhr) => {
+
+    if (xhr.status === 409) {
+      alert('Instance ' + (instanceIndex + 1) + ' was changed by someone ' +
+            'else while you were editing it. Your changes were not saved; ' +
+            'click Edit again to see the current version.');
+    }
+  }).done((instanceData) => {
+
+    instanceVersions[instanceIndex] = instanceData["version"];
 
     var figurativeStr = instanceData['figurative'].toString();
     figurativeStr = figurativeStr.charAt(0).toUpperCase() + figurativeStr.slice(1);
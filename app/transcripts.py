@@ -0,0 +1,122 @@
+'''
+Line and caption timing index of IatvDocument transcripts, used to serve a
+few lines of context around an instance instead of the whole transcript.
+
+IATV transcripts have about one line per closed caption cue. Each line is
+given the start time of the cue it came from, found by matching cue text in
+order, or of the line before it if no cue matches. A line and a cue match
+if either's words appear, in order and whole, in the other's, so that e.g.
+"Line 1" doesn't match "LINE 10".
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import re
+import zlib
+
+
+_TIMESTAMP = r'(\d+):(\d{2}):(\d{2})[,.](\d{3})'
+
+_CUE_TIMING = re.compile(_TIMESTAMP + r'\s*-->\s*' + _TIMESTAMP)
+
+_WHITESPACE = re.compile(r'\s+')
+
+# Cues past the last matched one that are tried for the next line.
+MAX_CUE_LOOKAHEAD = 20
+
+
+def _seconds(hours, minutes, seconds, millis):
+
+    return (
+        3600 * int(hours) + 60 * int(minutes) + int(seconds) +
+        int(millis) / 1000.0
+    )
+
+
+def parse_srt(raw_srt):
+    '''
+    Arguments:
+        raw_srt (str): SubRip captions
+
+    Returns:
+        (list) (start seconds, stop seconds, text) of each cue, in order
+    '''
+    cues = []
+
+    for block in re.split(r'\n\s*\n', raw_srt.replace('\r\n', '\n')):
+
+        lines = block.strip().split('\n')
+
+        for idx, line in enumerate(lines):
+            timing = _CUE_TIMING.search(line)
+            if timing is not None:
+                groups = timing.groups()
+                cues.append((
+                    _seconds(*groups[:4]), _seconds(*groups[4:]),
+                    ' '.join(lines[idx + 1:])
+                ))
+                break
+
+    return cues
+
+
+def normalize(text):
+
+    return _WHITESPACE.sub(' ', text).strip().upper()
+
+
+def line_hash(line):
+    '''
+    Short hash of a line, ignoring case and whitespace differences.
+    '''
+    return zlib.crc32(normalize(line).encode('utf-8'))
+
+
+def line_offsets(text):
+    '''
+    Offset of the start of each line of text, followed by len(text), so
+    line i is text[offsets[i]:offsets[i + 1]].
+    '''
+    offsets = [0]
+    offsets.extend(
+        match.end() for match in re.finditer('\n', text)
+        if match.end() < len(text)
+    )
+    offsets.append(len(text))
+
+    return offsets
+
+
+def _contains_words(text, part):
+    '''
+    Whether normalized part appears in normalized text as whole words.
+    '''
+    return ' ' + part + ' ' in ' ' + text + ' '
+
+
+def line_times(lines, cues):
+    '''
+    Start time in seconds of the cue each line came from, see module
+    docstring; None before the first matched line.
+    '''
+    times = []
+    time = None
+    next_cue = 0
+
+    for line in lines:
+
+        line = normalize(line)
+
+        if line:
+            for cue_idx in range(next_cue,
+                                 min(next_cue + MAX_CUE_LOOKAHEAD,
+                                     len(cues))):
+                cue_text = normalize(cues[cue_idx][2])
+                if cue_text and (_contains_words(line, cue_text) or
+                                 _contains_words(cue_text, line)):
+                    time = cues[cue_idx][0]
+                    next_cue = cue_idx + 1
+                    break
+
+        times.append(time)
+
+    return times
@@ -0,0 +1,130 @@
+'''
+Time how long it takes to import the app and the modules scripts start from,
+each in a fresh interpreter so nothing is already in sys.modules. Nothing
+should read the config, connect to MongoDB, or start R on import, so every
+module should only take as long as importing pandas, scipy, and Flask.
+
+Example:
+    ./benchmark_import_time.py 10 app.app projects.viomet.vis
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+
+DEFAULT_MODULES = [
+    'app.app',
+    'app.models',
+    'insert_iatv_docs',
+    'compress_transcripts',
+    'migrate_instances',
+    'projects.common.export_project',
+    'projects.viomet.analysis',
+    'projects.viomet.vis',
+]
+
+# Import time each module should stay under, in seconds. Importing pandas
+# and scipy takes up to about two seconds on its own; starting R or waiting
+# on a MongoDB server takes far longer.
+BUDGET_SECONDS = 3.0
+
+_TIMER = '''
+import time
+t0 = time.perf_counter()
+import {}
+print(time.perf_counter() - t0)
+'''
+
+
+def import_seconds(module, n_runs=5):
+    '''
+    Arguments:
+        module (str): dotted module name, importable from this directory
+        n_runs (int): number of fresh interpreters to time the import in
+
+    Returns:
+        (list) seconds each import took, excluding interpreter startup
+
+    Raises:
+        ImportError: with the last line of the traceback if the module
+            failed to import
+    '''
+    env = dict(os.environ)
+    # Importing must not need a config; make sure none is found.
+    env.pop('CONFIG_FILE', None)
+
+    seconds = []
+    for _ in range(n_runs):
+        process = subprocess.run(
+            [sys.executable, '-c', _TIMER.format(module)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        if process.returncode != 0:
+            error = process.stderr.strip().split('\n')[-1]
+            raise ImportError('{}: {}'.format(module, error))
+
+        seconds.append(float(process.stdout.split()[-1]))
+
+    return seconds
+
+
+def main(modules=DEFAULT_MODULES, n_runs=5):
+    '''
+    Print median and worst import time of each module, or why it failed to
+    import.
+
+    Returns:
+        (list) modules that failed to import or whose median import time is
+            over BUDGET_SECONDS
+    '''
+    over_budget = []
+
+    for module in modules:
+        try:
+            seconds = import_seconds(module, n_runs)
+        except ImportError as e:
+            over_budget.append(module)
+            print('{:<35} FAILED {}'.format(module, e))
+            continue
+
+        median = np.median(seconds)
+
+        if median > BUDGET_SECONDS:
+            over_budget.append(module)
+
+        print('{:<35} {:>8.1f} ms median {:>8.1f} ms max{}'.format(
+            module, 1000 * median, 1000 * max(seconds),
+            '  OVER BUDGET' if median > BUDGET_SECONDS else ''
+        ))
+
+    return over_budget
+
+
+if __name__ == '__main__':
+
+    help_msg = '''
+./benchmark_import_time.py [n_runs] [module ...]
+
+Times importing each module, by default the app, its models, and the
+scripts and analysis modules, in n_runs (default 5) fresh interpreters.
+Exits with an error if any module fails to import or its median import
+time is over {} s.
+
+Example:
+    ./benchmark_import_time.py 10 app.app projects.viomet.vis
+'''.format(BUDGET_SECONDS)
+
+    if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+        sys.exit(help_msg)
+
+    n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    modules = sys.argv[2:] or DEFAULT_MODULES
+
+    if main(modules, n_runs):
+        sys.exit(1)
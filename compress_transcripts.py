@@ -0,0 +1,190 @@
+'''
+Migrate the transcripts of existing IatvDocuments to or from compressed
+storage, reporting collection size and transcript read latency before and
+after. Set TRANSCRIPT_COMPRESSION in the Flask config to the same codec so
+that new documents are written compressed too.
+
+Example:
+    CONFIG_FILE=conf/default.cfg ./compress_transcripts.py zlib
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import sys
+import time
+
+import numpy as np
+
+from pymongo import UpdateOne
+
+from app.compression import (
+    CODECS, codec_of, compress_text, decompress_text, is_compressed
+)
+from app.models import IatvDocument, TRANSCRIPT_FIELDS
+
+
+def migrate(codec, batch_size=500, progress=None):
+    '''
+    Rewrite stored transcript fields with codec, decoding values stored
+    with another codec or as plain text first.
+
+    Arguments:
+        codec (str or None): one of app.compression.CODECS, or None to store
+            plain text again
+        batch_size (int): documents per bulk write
+        progress (callable): called with the number of documents rewritten
+            after each batch
+
+    Returns:
+        (int) number of documents rewritten
+    '''
+    if codec is not None and codec not in CODECS:
+        raise ValueError('Unknown compression codec ' + codec)
+
+    collection = IatvDocument._get_collection()
+    db_fields = [
+        IatvDocument._fields[name].db_field for name in TRANSCRIPT_FIELDS
+    ]
+
+    cursor = collection.find(
+        {}, dict((field, True) for field in db_fields)
+    ).batch_size(batch_size)
+
+    n_rewritten = 0
+    operations = []
+
+    for raw in cursor:
+
+        update = {}
+        for field in db_fields:
+
+            value = raw.get(field)
+            if value is None or codec_of(value) == codec:
+                continue
+
+            text = decompress_text(value) if is_compressed(value) else value
+            update[field] = (
+                compress_text(text, codec) if codec is not None else text
+            )
+
+        if update:
+            operations.append(
+                UpdateOne({'_id': raw['_id']}, {'$set': update})
+            )
+
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            n_rewritten += len(operations)
+            operations = []
+
+            if progress is not None:
+                progress(n_rewritten)
+
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+        n_rewritten += len(operations)
+
+        if progress is not None:
+            progress(n_rewritten)
+
+    return n_rewritten
+
+
+def benchmark(sample_size=200):
+    '''
+    Size of the iatv_document collection and time to load and decode the
+    transcripts of a random sample of documents.
+
+    Returns:
+        (dict) with keys documents, data_bytes (uncompressed BSON size),
+            storage_bytes (size on disk), and mean_read_ms and
+            median_read_ms per document
+    '''
+    collection = IatvDocument._get_collection()
+    stats = IatvDocument._get_db().command('collstats', collection.name)
+
+    sample_ids = [
+        raw['_id'] for raw in collection.aggregate([
+            {'$sample': {'size': sample_size}},
+            {'$project': {'_id': True}}
+        ])
+    ]
+
+    read_seconds = []
+    for _id in sample_ids:
+
+        t0 = time.perf_counter()
+
+        # transcripts are decoded as the document is loaded
+        IatvDocument.with_transcripts.get(pk=_id)
+
+        read_seconds.append(time.perf_counter() - t0)
+
+    read_ms = 1000 * np.array(read_seconds or [np.nan])
+
+    return {
+        'documents': stats['count'],
+        'data_bytes': stats['size'],
+        'storage_bytes': stats['storageSize'],
+        'mean_read_ms': np.mean(read_ms),
+        'median_read_ms': np.median(read_ms)
+    }
+
+
+def _print_benchmark(label, result):
+
+    print(
+        '{:>7}: {:,} documents, {:,} data bytes, {:,} storage bytes, '
+        'reads {:.2f} ms mean, {:.2f} ms median'.format(
+            label, result['documents'], result['data_bytes'],
+            result['storage_bytes'], result['mean_read_ms'],
+            result['median_read_ms']
+        )
+    )
+
+
+def main(codec, sample_size=200):
+
+    before = benchmark(sample_size)
+    _print_benchmark('before', before)
+
+    def progress(n_rewritten):
+        sys.stderr.write('\rrewrote {} documents'.format(n_rewritten))
+        sys.stderr.flush()
+
+    n_rewritten = migrate(codec, progress=progress)
+    sys.stderr.write('\rrewrote {} documents\n'.format(n_rewritten))
+
+    after = benchmark(sample_size)
+    _print_benchmark('after', after)
+
+    # WiredTiger reuses freed space rather than returning it to the OS.
+    print(
+        'storage bytes only shrink after running '
+        'db.runCommand({{compact: "{}"}})'.format(
+            IatvDocument._get_collection_name()
+        )
+    )
+
+
+if __name__ == '__main__':
+
+    help_msg = '''
+./compress_transcripts.py <zlib|zstd|none> [sample_size]
+
+Rewrites all IatvDocument transcripts with the given codec, or as plain
+text for none, and reports collection size and read latency of
+sample_size random documents before and after.
+
+Example:
+    ./compress_transcripts.py zlib 500
+'''
+    if len(sys.argv) not in (2, 3) or \
+            sys.argv[1] not in list(CODECS) + ['none']:
+        sys.exit(help_msg)
+
+    codec = None if sys.argv[1] == 'none' else sys.argv[1]
+
+    if len(sys.argv) == 3:
+        main(codec, int(sys.argv[2]))
+    else:
+        main(codec)
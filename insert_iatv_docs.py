@@ -9,17 +9,23 @@ After the documents are inserted then various corpora can be made from
 those documents either interactively or with another script/function
 '''
 import json
+import multiprocessing
+import os
+import re
+import time
 
 from collections import Counter
 from datetime import datetime
 from glob import glob
-from nltk.corpus import stopwords
 from os.path import join as opjoin
+from pymongo.errors import BulkWriteError
 
 from app.models import IatvDocument, IatvCorpus, Instance, Facet, Project
+from projects.common.corpus_stats import documents
 
 
-STOPWORDS = set(stopwords.words('english'))
+# Checkpoint file written to the ingested folder by insert_iatv_docs.
+DEFAULT_MANIFEST_NAME = '.ingest-manifest'
 
 
 DEFAULT_VIOLENCE_LIST = [
@@ -55,17 +61,11 @@ def build_iatv_corpus(start_datetime, stop_datetime,
     Returns:
         (IatvCorpus): Newly created corpus
     '''
-    if program_names is None:
-        corpus_docs = IatvDocument.objects(
-            start_localtime__gte=start_datetime,
-            start_localtime__lte=stop_datetime
-        )
-    else:
-        corpus_docs = IatvDocument.objects(
-            program_name__in=program_names,
-            start_localtime__gte=start_datetime,
-            start_localtime__lte=stop_datetime
-        )
+    # Only the references are needed, so leave transcripts on the server.
+    corpus_docs = documents(
+        start_datetime=start_datetime, stop_datetime=stop_datetime,
+        program_names=program_names
+    ).only('id')
 
     corpus = IatvCorpus(name=corpus_name, documents=corpus_docs)
 
@@ -97,28 +97,34 @@ def make_project(project_name, documents, word_regex_pairs):
 
     project = Project(name=project_name)
 
-    for wr_pair in word_regex_pairs:
+    facets = [Facet(word=word) for word, _ in word_regex_pairs]
+    patterns = [pattern for _, pattern in word_regex_pairs]
+
+    matcher = _multi_pattern_matcher(patterns)
 
-        facet = Facet(word=wr_pair[0])
-        # regex = re.compile(wr_pair[1])
+    processed_prog_dates = set()
 
-        processed_prog_dates = []
+    # Each transcript is scanned once for all patterns, and only lines with
+    # at least one hit are checked against the individual patterns.
+    for doc in documents:
 
-        for doc in documents:
+        prog_date = (doc.program_name, doc.start_localtime.date())
 
-            prog_date = (doc.program_name, doc.start_localtime.date())
+        if prog_date not in processed_prog_dates:
 
-            if prog_date not in processed_prog_dates:
+            processed_prog_dates.add(prog_date)
 
-                processed_prog_dates.append(prog_date)
-                for line in doc.document_data.split('\n'):
+            for line in _matching_lines(matcher, doc.document_data):
+                for facet, pattern in zip(facets, patterns):
 
-                    if wr_pair[1] in line:
+                    if pattern in line:
                         facet.instances.append(
                             Instance(text=line, source_id=doc.id,
                                      reference_url=doc.iatv_url)
                         )
 
+    for facet in facets:
+
         facet.total_count = len(facet.instances)
         facet.save()
 
@@ -127,76 +133,281 @@ def make_project(project_name, documents, word_regex_pairs):
     return project
 
 
-def insert_iatv_docs(folder):
+def _multi_pattern_matcher(patterns):
+    '''
+    Single compiled alternation matching any of the literal patterns. It is
+    only used to find lines with hits; overlapping patterns on a hit line
+    are found by make_project checking each pattern against the line.
+    '''
+    return re.compile('|'.join(
+        re.escape(pattern)
+        for pattern in sorted(set(patterns), key=len, reverse=True)
+    ))
 
-    g = glob(folder + '/*')
 
-    for _dir in g:
+def _matching_lines(matcher, text):
+    '''
+    Generate the lines of text containing a match, in order, each once.
+    '''
+    match = matcher.search(text)
 
-        try:
-            _import_iatv_blob(_dir)
+    while match is not None:
 
-        except Exception as e:
-            print('Error importing from directory(?) ' + _dir)
-            try:
-                print('Exception:\n' + e.message)
-            except:
-                pass
+        line_start = text.rfind('\n', 0, match.start()) + 1
+        line_end = text.find('\n', match.start())
+        if line_end == -1:
+            yield text[line_start:]
+            return
 
+        yield text[line_start:line_end]
 
-def _import_iatv_blob(_dir):
+        match = matcher.search(text, line_end + 1)
 
-    # read as much information as possible from metadata
-    md_str = open(opjoin(_dir, 'metadata.json')).read()
-    metadata = json.loads(md_str)
 
-    iatv_id = metadata['identifier']
+class IngestReport:
+    '''
+    Running totals for insert_iatv_docs.
+    '''
+    def __init__(self, n_pending, n_resumed=0):
+
+        self.n_pending = n_pending
+        self.n_resumed = n_resumed
+        self.n_inserted = 0
+        self.n_existing = 0
+        self.failures = []
+        self.start_time = time.time()
+
+    @property
+    def n_processed(self):
+        return self.n_inserted + self.n_existing + len(self.failures)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    @property
+    def throughput(self):
+        '''
+        Show directories processed per second.
+        '''
+        elapsed = self.elapsed
+        return self.n_processed / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (
+            '{}/{} directories: {} inserted, {} already present, {} failed, '
+            '{} done in earlier runs ({:.1f} directories/s)'
+        ).format(
+            self.n_processed, self.n_pending, self.n_inserted,
+            self.n_existing, len(self.failures), self.n_resumed,
+            self.throughput
+        )
 
-    if len(IatvDocument.objects(iatv_id=iatv_id)) == 0:
-        iatv_url = metadata['identifier-access'][0]
 
-        try:
-            start_localtime = _mdtime_to_datetime(metadata['start_localtime'][0])
-            start_time = _mdtime_to_datetime(metadata['start_time'][0])
-            stop_time = _mdtime_to_datetime(metadata['stop_time'][0])
+def insert_iatv_docs(folder, n_workers=None, batch_size=500,
+                     manifest_path=None, progress=None):
+    '''
+    Insert the IATV show directories in folder into the iatv_documents
+    collection. Directories are parsed by a pool of n_workers processes and
+    written in unordered bulk upserts keyed on iatv_id, see
+    IatvDocument.upsert_many, so documents already in the database are
+    updated in place rather than duplicated.
+
+    Every directory that is written is appended to a manifest, by default
+    .ingest-manifest in folder, by its name in folder. Directories in the
+    manifest are skipped, so an interrupted ingest picks up where it
+    stopped. Failed directories are
+    not added and are retried on the next run; they are listed with their
+    errors in the report's failures rather than printed.
+
+    Arguments:
+        folder (str): directory containing one directory per show
+        n_workers (int): number of parsing processes, defaults to the number
+            of CPUs
+        batch_size (int): number of documents per bulk write
+        manifest_path (str): checkpoint manifest location; may be outside
+            folder, e.g. if folder is read-only
+        progress (callable): called with the IngestReport after each batch
 
-            runtime_seconds = (stop_time - start_time).seconds
-            utc_offset = metadata['utc_offset'][0]
+    Returns:
+        (IngestReport): counts, failures, and throughput of the ingest
+    '''
+    if manifest_path is None:
+        manifest_path = opjoin(folder, DEFAULT_MANIFEST_NAME)
+
+    completed = _read_manifest(manifest_path)
+
+    dirs = sorted(glob(opjoin(folder, '*')))
+    pending = [_dir for _dir in dirs if _manifest_key(_dir) not in completed]
+
+    report = IngestReport(len(pending), n_resumed=len(dirs) - len(pending))
+
+    batch = []
+
+    with open(manifest_path, 'a') as manifest, \
+            multiprocessing.Pool(n_workers) as pool:
+
+        for _dir, fields, error in pool.imap_unordered(
+                _read_iatv_blob_or_error, pending, chunksize=8):
+
+            if error is not None:
+                _report_failure(report, _dir, error)
+            else:
+                batch.append((_dir, fields))
+
+            if len(batch) >= batch_size:
+                _write_batch(batch, report, manifest)
+                batch = []
+
+                if progress is not None:
+                    progress(report)
+
+        if batch:
+            _write_batch(batch, report, manifest)
+
+            if progress is not None:
+                progress(report)
+
+    return report
+
+
+def _write_batch(batch, report, manifest):
+    '''
+    Upsert a batch of (directory, document fields) pairs, then record the
+    written directories in the manifest.
+    '''
+    docs = []
+    written = []
 
+    for _dir, fields in batch:
+        try:
+            doc = IatvDocument(**fields)
+            doc.validate()
         except Exception as e:
-            print('Error accessing dates for directory ' + _dir)
-            print('Exception:\n' + e.message)
+            _report_failure(report, _dir, repr(e))
+            continue
+
+        docs.append(doc)
+        written.append(_dir)
+
+    if not docs:
+        return
+
+    failed = {}
+    try:
+        n_upserted = IatvDocument.upsert_many(docs).upserted_count
+
+    except BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            failed[error['index']] = error['errmsg']
+        n_upserted = e.details['nUpserted']
+
+    report.n_inserted += n_upserted
+    report.n_existing += len(docs) - len(failed) - n_upserted
+
+    for idx, _dir in enumerate(written):
+        if idx in failed:
+            _report_failure(report, _dir, failed[idx])
+        else:
+            manifest.write(_manifest_key(_dir) + '\n')
+
+    manifest.flush()
+    os.fsync(manifest.fileno())
+
+
+def _report_failure(report, _dir, error):
+
+    report.failures.append((_dir, error))
+
+
+def _read_manifest(manifest_path):
+
+    if not os.path.exists(manifest_path):
+        return set()
+
+    with open(manifest_path) as f:
+        return set(
+            _manifest_key(line.rstrip('\n')) for line in f if line.strip()
+        )
+
+
+def _manifest_key(_dir):
+    '''
+    Manifest entry of a show directory: its name in the ingested folder, so
+    the folder can be given with or without a trailing slash, relative or
+    absolute, or be moved between runs. Manifests from before, which have
+    the directory paths, read the same.
+    '''
+    return os.path.basename(os.path.normpath(_dir))
+
+
+def _read_iatv_blob_or_error(_dir):
+    '''
+    Worker wrapper for _read_iatv_blob returning (_dir, fields, error) so
+    one bad directory doesn't stop the pool.
+    '''
+    try:
+        return _dir, _read_iatv_blob(_dir), None
+    except Exception as e:
+        return _dir, None, repr(e)
+
+
+def _read_iatv_blob(_dir):
+    '''
+    Read the metadata, transcript, and SRT files of one show directory.
 
-        title = metadata['title']
-        tspl = title.split(':')
+    Returns:
+        (dict) IatvDocument fields
+    '''
+    # read as much information as possible from metadata
+    with open(opjoin(_dir, 'metadata.json')) as f:
+        metadata = json.load(f)
+
+    iatv_id = metadata['identifier']
+    iatv_url = metadata['identifier-access'][0]
 
-        program_name = tspl[0].strip()
-        network = tspl[1].strip()
+    start_localtime = _mdtime_to_datetime(metadata['start_localtime'][0])
+    start_time = _mdtime_to_datetime(metadata['start_time'][0])
+    stop_time = _mdtime_to_datetime(metadata['stop_time'][0])
 
-        # now read text and SRT files
-        text = open(opjoin(_dir, 'transcript.txt')).read()
+    runtime_seconds = (stop_time - start_time).seconds
+    utc_offset = metadata['utc_offset'][0]
 
-        srt_path = opjoin(_dir, iatv_id + '.cc5.srt')
-        raw_srt = open(srt_path, 'r').read()
-        doc = IatvDocument(document_data=text, raw_srt=raw_srt,
-                           iatv_id=iatv_id, iatv_url=iatv_url,
-                           start_localtime=start_localtime,
-                           start_time=start_time,
-                           stop_time=stop_time,
-                           runtime_seconds=runtime_seconds,
-                           utc_offset=utc_offset,
-                           program_name=program_name,
-                           network=network)
+    title = metadata['title']
+    tspl = title.split(':')
 
-        doc.save()
+    program_name = tspl[0].strip()
+    network = tspl[1].strip()
+
+    # now read text and SRT files
+    with open(opjoin(_dir, 'transcript.txt')) as f:
+        text = f.read()
+
+    srt_path = opjoin(_dir, iatv_id + '.cc5.srt')
+    with open(srt_path, 'r') as f:
+        raw_srt = f.read()
+
+    return dict(document_data=text, raw_srt=raw_srt,
+                iatv_id=iatv_id, iatv_url=iatv_url,
+                start_localtime=start_localtime,
+                start_time=start_time,
+                stop_time=stop_time,
+                runtime_seconds=runtime_seconds,
+                utc_offset=utc_offset,
+                program_name=program_name,
+                network=network)
 
 
 def calculate_counts(docs):
     '''
     Make word count for list of documents
     '''
+    # nltk is slow to import and only needed here
+    from nltk.corpus import stopwords
+    stop_words = set(stopwords.words('english'))
+
     texts = [[word for word in doc['document_data'].lower().split()
-              if word.isalpha() and word not in STOPWORDS]
+              if word.isalpha() and word not in stop_words]
              for doc in docs]
 
     c = Counter([])
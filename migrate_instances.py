@@ -0,0 +1,78 @@
+'''
+Move facet instances between embedded storage, a list in the facet
+document, and collection storage, one InstanceRecord document per instance.
+See app.models.Facet. Instance indices, and so the instance URLs in the
+web app, are the same in both.
+
+Example:
+    CONFIG_FILE=conf/default.cfg ./migrate_instances.py collection \
+        'Viomet Sep-Nov 2016'
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import sys
+
+from app.models import Facet, Project, INSTANCE_STORAGE_MODES
+
+
+def migrate(storage, project_name=None, min_instances=0):
+    '''
+    Move the instances of facets to storage.
+
+    Arguments:
+        storage (str): one of app.models.INSTANCE_STORAGE_MODES
+        project_name (str): only migrate this project's facets; all facets
+            if None
+        min_instances (int): only migrate facets with at least this many
+            instances
+
+    Returns:
+        (int) number of facets migrated
+    '''
+    if project_name is None:
+        facet_ids = list(Facet.objects.scalar('id'))
+    else:
+        facet_ids = Project.objects.get(name=project_name).facet_ids()
+
+    n_migrated = 0
+    for facet_id in facet_ids:
+
+        facet = Facet.objects.exclude('instances').get(pk=facet_id)
+
+        if facet.instance_storage == storage or \
+                facet.count_instances() < min_instances:
+            continue
+
+        facet.move_instances(storage)
+        n_migrated += 1
+
+        print('moved {} instances of facet {} ({}) to {} storage'.format(
+            facet.count_instances(), facet.word, facet.pk, storage
+        ))
+
+    return n_migrated
+
+
+if __name__ == '__main__':
+
+    help_msg = '''
+./migrate_instances.py <embedded|collection> [project_name] [min_instances]
+
+Moves the instances of every facet, or only those of project_name, to the
+given storage. With min_instances, only facets with at least that many
+instances are moved.
+
+Example:
+    ./migrate_instances.py collection 'Viomet Sep-Nov 2016' 1000
+'''
+    if len(sys.argv) not in (2, 3, 4) or \
+            sys.argv[1] not in INSTANCE_STORAGE_MODES:
+        sys.exit(help_msg)
+
+    storage = sys.argv[1]
+    project_name = sys.argv[2] if len(sys.argv) > 2 else None
+    min_instances = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    n_migrated = migrate(storage, project_name, min_instances)
+
+    print('migrated {} facets'.format(n_migrated))
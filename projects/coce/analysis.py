@@ -54,9 +54,9 @@ def _fill_repeat(analyzer_df,
     repeat_of = repeat_of.apply(int) - 1
 
     # need to read info from database since adf doesn't have proper indices
-    project = next(p for p in Project.objects if p.name == 'test epa proj')
-    facet = next(f for f in project.facets if f.word == facet_word)
-    instances = facet.instances
+    project = Project.objects(name='test epa proj').first()
+    facet = project.get_facet(facet_word)
+    instances = list(facet.iter_instances())
 
     replacements = pd.DataFrame(
         data=[inst.to_mongo() for inst in instances]
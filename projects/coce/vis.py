@@ -1,18 +1,11 @@
 '''
 20 June 2017
 '''
-import matplotlib.dates as dates
-import matplotlib.pyplot as plt
-import seaborn as sns
-
 from datetime import date
-from matplotlib import font_manager
 
 from fyr_analysis import relative_likelihood
 
 
-CUR_PAL = sns.color_palette()
-
 def plot_three_speakers(speaker_counts_df):
 
     _plot_one(speaker_counts_df, ['Ted Cruz'])
@@ -25,6 +18,10 @@ def _plot_one(speaker_counts, speakers, stacked=False):
     Arguments:
         columns (list): names of speakers to include in graph.
     '''
+    # deferred so importing this module doesn't pay for matplotlib
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     sns.set(font_scale=1.0)
     sns.set_style('whitegrid')
     sns.set_style('ticks')
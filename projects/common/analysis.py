@@ -1,13 +1,13 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 import pandas as pd
 
-from collections import OrderedDict, Counter
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import datetime, timedelta
-from urllib.parse import urlparse
 
+from .corpus_stats import distinct_shows
+from .data_cache import default_cache, is_url
 from .export_project import ProjectExporter
 from app.models import IatvCorpus
 
@@ -26,7 +26,7 @@ DEFAULT_FACET_WORDS = [
 ]
 
 
-def get_project_data_frame(project_name):
+def get_project_data_frame(project_name, snapshot_path=None, cache=True):
     '''
     Convenience method for creating a newly initialized instance of the
     Analyzer class. Currently the only argument is year since the projects all
@@ -37,15 +37,28 @@ def get_project_data_frame(project_name):
     Arguments:
         project_name (str): name of project to be exported to an Analyzer
             with DataFrame representation included as an attribute
+        snapshot_path (str): if given, export incrementally, only
+            re-reading facets changed since the snapshot stored at this
+            path; see ProjectExporter.export_incremental
+        cache (bool or DataFrameCache): cache for CSV URLs and paths; True
+            uses the shared default cache, False always downloads and parses
     '''
     if type(project_name) is int:
         project_name = str('Viomet Sep-Nov ' + str(project_name))
 
-    def is_url(s): return urlparse(project_name).hostname is not None
     if is_url(project_name) or os.path.exists(project_name):
-        ret = pd.read_csv(project_name, na_values='',
-                          parse_dates=['start_localtime'])
-        return ret
+        read_csv_kwargs = dict(na_values='', parse_dates=['start_localtime'])
+
+        if cache is True:
+            cache = default_cache()
+
+        if cache:
+            return cache.read_csv(project_name, **read_csv_kwargs)
+
+        return pd.read_csv(project_name, **read_csv_kwargs)
+
+    if snapshot_path is not None:
+        return ProjectExporter(project_name).export_incremental(snapshot_path)
 
     return ProjectExporter(project_name).export_dataframe()
 
@@ -139,6 +152,63 @@ def _count_by_start_localtime(df,
     return ret_df
 
 
+# Shows index frames already loaded in this process, by membership key.
+_SHOWS_INDEX_FRAMES = {}
+
+
+def corpus_shows_index(iatv_corpus):
+    '''
+    Deduplicated shows in a corpus, one row per program_name, network, and
+    airing date. The index is built with an aggregation over document
+    metadata the first time it is needed, saved with the corpus, and rebuilt
+    when the corpus documents change.
+
+    Arguments:
+        iatv_corpus (app.models.IatvCorpus or str): corpus or corpus name
+
+    Returns:
+        (pandas.DataFrame) with columns date, network, and program_name
+    '''
+    if type(iatv_corpus) is str:
+        iatv_corpus = IatvCorpus.objects(name=iatv_corpus)[0]
+
+    key = iatv_corpus.membership_key()
+
+    if key in _SHOWS_INDEX_FRAMES:
+        return _SHOWS_INDEX_FRAMES[key]
+
+    if iatv_corpus.shows_index_key == key:
+        shows = iatv_corpus.shows_index
+
+    else:
+        # Deduplicated on the server; only the show keys are sent back.
+        shows = [
+            {
+                'date': row.date.to_pydatetime(),
+                'network': row.network,
+                'program_name': row.program_name
+            }
+            for row in distinct_shows(
+                document_ids=iatv_corpus.document_ids()
+            ).itertuples()
+        ]
+
+        iatv_corpus.shows_index = shows
+        iatv_corpus.shows_index_key = key
+
+        if iatv_corpus.pk is not None:
+            IatvCorpus.objects(pk=iatv_corpus.pk).update_one(
+                set__shows_index=shows, set__shows_index_key=key
+            )
+
+    frame = pd.DataFrame(shows, columns=['date', 'network', 'program_name'])
+    frame['date'] = pd.to_datetime(frame['date'])
+
+    _SHOWS_INDEX_FRAMES[key] = frame
+
+    return frame
+
+
 def shows_per_date(date_index, iatv_corpus, by_network=False):
     '''
     Arguments:
@@ -151,69 +221,60 @@ def shows_per_date(date_index, iatv_corpus, by_network=False):
 
     Returns:
         (pandas.Series) if by_network is False, (pandas.DataFrame)
-            if by_network is true.
+            if by_network is true, with one column for each network in the
+            corpus in sorted order.
     '''
-    if type(iatv_corpus) is str:
-        iatv_corpus = IatvCorpus.objects(name=iatv_corpus)[0]
+    shows = corpus_shows_index(iatv_corpus)
 
-    docs = iatv_corpus.documents
+    if not date_index.is_monotonic_increasing:
+        date_index = date_index.sort_values()
 
     n_dates = len(date_index)
 
+    # Integer codes for each show's position in date_index (-1 if it aired
+    # outside of it), network, and program name.
+    date_codes = date_index.get_indexer(shows.date)
+    network_codes, networks = pd.factorize(shows.network, sort=True)
+    program_codes = pd.factorize(shows.program_name)[0]
+
     if not by_network:
 
-        # get all date/show name tuples & remove show re-runs from same date
-        prog_dates = set(
-            [
-                (d.program_name, d.start_localtime.date())
-                for d in docs
-            ]
+        # count each program once per date, even if it aired on more than
+        # one network
+        in_range = date_codes >= 0
+        prog_dates = _unique_rows(
+            np.column_stack([date_codes, program_codes])[in_range]
         )
 
-        # count total number of shows on each date
-        # note we count the second entry of the tuples, which is just the
-        # date, excluding program name
-        shows_per_date = Counter(el[1] for el in prog_dates)
+        counts = np.bincount(prog_dates[:, 0], minlength=n_dates)
 
-        spd_series = pd.Series(
-            index=date_index,
-            data={'counts': np.zeros(n_dates)}
-        ).sort_index()
+        return pd.Series(index=date_index, data=counts.astype(np.float64))
 
-        for date in shows_per_date:
-            spd_series.loc[date] = shows_per_date[date]
+    else:
 
-        return spd_series
+        in_range = (date_codes >= 0) & (network_codes >= 0)
+        prog_network_dates = _unique_rows(
+            np.column_stack(
+                [date_codes, network_codes, program_codes]
+            )[in_range]
+        )
 
-    else:
-        # get all date/network/show name tuples
-        # & remove show re-runs from same date
-        prog_dates = set(
-            [
-                (d.program_name, d.network, d.start_localtime.date())
-                for d in docs
-            ]
+        counts = np.zeros((n_dates, len(networks)))
+        np.add.at(
+            counts, (prog_network_dates[:, 0], prog_network_dates[:, 1]), 1
         )
 
-        # count total number of shows on each date for each network
-        # note we count the second entry of the tuples, which is just the
-        # date, excluding program name
-        shows_per_network_per_date = Counter(el[1:] for el in prog_dates)
-
-        n_dates = len(date_index)
-        spd_frame = pd.DataFrame(
-            index=date_index,
-            data={
-                'MSNBCW': np.zeros(n_dates),
-                'CNNW': np.zeros(n_dates),
-                'FOXNEWSW': np.zeros(n_dates)
-            }
+        return pd.DataFrame(
+            index=date_index, data=counts, columns=list(networks)
         )
 
-        for tup in shows_per_network_per_date:
-            spd_frame.loc[tup[1]][tup[0]] = shows_per_network_per_date[tup]
 
-        return spd_frame
+def _unique_rows(codes):
+
+    if len(codes) == 0:
+        return codes
+
+    return np.unique(codes, axis=0)
 
 
 def daily_metaphor_counts(df, date_index, by=None):
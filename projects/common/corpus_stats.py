@@ -0,0 +1,157 @@
+'''
+Corpus statistics computed with MongoDB aggregation pipelines over
+IatvDocument metadata (start_localtime, network, program_name, and
+runtime_seconds). Counting and deduplication happen on the server, so no
+transcript text is sent over the wire. The pipelines only use operators
+that mongomock also implements, so they can be tested without a mongod.
+
+Every function takes the same optional filters:
+
+    document_ids (list): restrict to these IatvDocument ids, e.g. the
+        documents of an IatvCorpus
+    start_datetime, stop_datetime (datetime.datetime): inclusive bounds
+        on start_localtime
+    program_names, networks (list): restrict to these values
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import pandas as pd
+
+from datetime import datetime
+
+from app.models import IatvDocument
+
+
+# Aggregation expression for the airing day of a document.
+_DAY = {
+    'year': {'$year': '$start_localtime'},
+    'month': {'$month': '$start_localtime'},
+    'day': {'$dayOfMonth': '$start_localtime'},
+}
+
+
+def documents(document_ids=None, start_datetime=None, stop_datetime=None,
+              program_names=None, networks=None):
+    '''
+    IatvDocument queryset for the given filters. Documents without a
+    start_localtime are excluded since they can't be assigned to a day.
+    '''
+    query = dict(start_localtime__ne=None)
+
+    if document_ids is not None:
+        query['pk__in'] = list(document_ids)
+    if start_datetime is not None:
+        query['start_localtime__gte'] = start_datetime
+    if stop_datetime is not None:
+        query['start_localtime__lte'] = stop_datetime
+    if program_names is not None:
+        query['program_name__in'] = list(program_names)
+    if networks is not None:
+        query['network__in'] = list(networks)
+
+    return IatvDocument.objects(**query)
+
+
+def distinct_shows(**filters):
+    '''
+    Deduplicated shows: re-runs of a program on the same network and day
+    are counted once.
+
+    Returns:
+        (pandas.DataFrame) with columns date, network, and program_name
+    '''
+    group_id = dict(_DAY, network='$network', program_name='$program_name')
+
+    rows = documents(**filters).aggregate({'$group': {'_id': group_id}})
+
+    return _frame(
+        [row['_id'] for row in rows], ['network', 'program_name']
+    ).sort_values(
+        ['date', 'network', 'program_name']
+    ).reset_index(drop=True)
+
+
+def daily_counts(by=('network',), distinct=True, **filters):
+    '''
+    Number of shows per day and each combination of the fields in by.
+
+    Arguments:
+        by (tuple): any of 'network' and 'program_name'
+        distinct (bool): count distinct shows, see distinct_shows, rather
+            than documents
+
+    Returns:
+        (pandas.DataFrame) with columns date, the fields in by, and counts
+    '''
+    by = list(by)
+    pipeline = []
+
+    if distinct:
+        first_id = dict(
+            _DAY, network='$network', program_name='$program_name'
+        )
+        pipeline.append({'$group': {'_id': first_id}})
+        fields = dict(
+            (key, '$_id.' + key) for key in list(_DAY) + by
+        )
+    else:
+        fields = dict(_DAY, **dict((key, '$' + key) for key in by))
+
+    pipeline.append(
+        {'$group': {'_id': fields, 'counts': {'$sum': 1}}}
+    )
+
+    return _grouped_frame(documents(**filters).aggregate(*pipeline), by)
+
+
+def runtime_totals(by=('network',), **filters):
+    '''
+    Total runtime_seconds of the documents aired each day, grouped by the
+    fields in by.
+
+    Returns:
+        (pandas.DataFrame) with columns date, the fields in by, and
+            runtime_seconds
+    '''
+    by = list(by)
+    group_id = dict(_DAY, **dict((key, '$' + key) for key in by))
+
+    rows = documents(**filters).aggregate(
+        {'$group': {
+            '_id': group_id,
+            'runtime_seconds': {'$sum': '$runtime_seconds'}
+        }}
+    )
+
+    return _grouped_frame(rows, by, value='runtime_seconds')
+
+
+def _grouped_frame(rows, by, value='counts'):
+
+    records = []
+    for row in rows:
+        record = dict(row['_id'])
+        record[value] = row[value]
+        records.append(record)
+
+    frame = _frame(records, by + [value])
+
+    return frame.sort_values(['date'] + by).reset_index(drop=True)
+
+
+def _frame(records, columns):
+    '''
+    DataFrame from aggregation records, turning the year, month, and day
+    fields into a single date column.
+    '''
+    frame = pd.DataFrame(
+        [
+            [datetime(r['year'], r['month'], r['day'])] +
+            [r.get(column) for column in columns]
+            for r in records
+        ],
+        columns=['date'] + columns
+    )
+    frame['date'] = pd.to_datetime(frame['date'])
+
+    return frame
@@ -0,0 +1,258 @@
+'''
+On-disk cache for data frames parsed from CSV snapshots, such as the
+viomet-{year}-snapshot-project-df.csv files served from metacorps.io.
+
+Parsed frames are pickled under the SHA-256 hash of the raw CSV bytes (and
+the parsing options), so the same content is parsed at most once no matter
+which URL or path it came from. For each URL the cache remembers the ETag
+and content hash; within `ttl` seconds of the last check the pickled frame
+is used without touching the network, after that the URL is revalidated
+with a conditional request. Least recently used frames are evicted once
+the cache grows past `max_bytes`.
+
+Author: Matthew Turner <maturner01@gmail.com>
+'''
+import hashlib
+import io
+import json
+import os
+import time
+
+import pandas as pd
+import requests
+
+from urllib.parse import urlparse
+
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'METACORPS_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'metacorps')
+)
+
+# Seconds a cached URL is used before it is revalidated with the server.
+DEFAULT_TTL = 24 * 60 * 60
+
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+
+def is_url(source):
+    return urlparse(source).hostname is not None
+
+
+class DataFrameCache:
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL,
+                 max_bytes=DEFAULT_MAX_BYTES, session=None):
+        '''
+        Arguments:
+            cache_dir (str): directory for cached frames and source entries
+            ttl (float): seconds before a cached URL is revalidated
+            max_bytes (int): total size of cached frames kept on disk
+            session (requests.Session): session used for downloads
+        '''
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.session = session if session is not None else requests.Session()
+
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.sources_dir = os.path.join(cache_dir, 'sources')
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.sources_dir, exist_ok=True)
+
+    def read_csv(self, source, **read_csv_kwargs):
+        '''
+        Cached equivalent of pandas.read_csv(source, **read_csv_kwargs) for
+        a URL or a local path.
+        '''
+        if is_url(source):
+            return self._read_url(source, read_csv_kwargs)
+        else:
+            return self._read_path(source, read_csv_kwargs)
+
+    def evict(self, max_age=None):
+        '''
+        Remove least recently used frames until the cache fits in
+        max_bytes, and any frame not used in the last max_age seconds.
+        '''
+        now = time.time()
+
+        objects = []
+        for name in os.listdir(self.objects_dir):
+            path = os.path.join(self.objects_dir, name)
+            stat = os.stat(path)
+            objects.append((stat.st_mtime, stat.st_size, path))
+
+        # Oldest access time first.
+        objects.sort()
+
+        total = sum(size for _, size, _ in objects)
+        for mtime, size, path in objects:
+            too_old = max_age is not None and now - mtime > max_age
+            if total > self.max_bytes or too_old:
+                _remove(path)
+                total -= size
+
+    def clear(self):
+
+        for directory in (self.objects_dir, self.sources_dir):
+            for name in os.listdir(directory):
+                _remove(os.path.join(directory, name))
+
+    def _read_url(self, url, read_csv_kwargs):
+
+        entry = self._load_entry(url)
+        if entry is not None:
+            object_path = self._object_path(
+                entry['content_hash'], read_csv_kwargs
+            )
+            if not os.path.exists(object_path):
+                entry = None
+
+        if entry is not None and time.time() - entry['checked'] < self.ttl:
+            return self._load_object(object_path)
+
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+
+        res = self.session.get(url, headers=headers)
+
+        if res.status_code == 304 and entry is not None:
+            entry['checked'] = time.time()
+            self._save_entry(url, entry)
+
+            return self._load_object(object_path)
+
+        res.raise_for_status()
+
+        content = res.content
+        content_hash = hashlib.sha256(content).hexdigest()
+
+        df = self._parse(content, content_hash, read_csv_kwargs)
+
+        self._save_entry(url, {
+            'source': url,
+            'etag': res.headers.get('ETag'),
+            'content_hash': content_hash,
+            'checked': time.time()
+        })
+
+        return df
+
+    def _read_path(self, path, read_csv_kwargs):
+
+        stat = os.stat(path)
+        source = os.path.abspath(path)
+
+        # Only rehash the file if it changed since it was last read.
+        entry = self._load_entry(source)
+        if (entry is not None and entry['mtime'] == stat.st_mtime
+                and entry['size'] == stat.st_size):
+            object_path = self._object_path(
+                entry['content_hash'], read_csv_kwargs
+            )
+            if os.path.exists(object_path):
+                return self._load_object(object_path)
+
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        content_hash = hashlib.sha256(content).hexdigest()
+
+        df = self._parse(content, content_hash, read_csv_kwargs)
+
+        self._save_entry(source, {
+            'source': source,
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'content_hash': content_hash,
+            'checked': time.time()
+        })
+
+        return df
+
+    def _parse(self, content, content_hash, read_csv_kwargs):
+        '''
+        Parse content unless a frame for the same content and options is
+        already cached.
+        '''
+        object_path = self._object_path(content_hash, read_csv_kwargs)
+
+        if os.path.exists(object_path):
+            return self._load_object(object_path)
+
+        df = pd.read_csv(io.BytesIO(content), **read_csv_kwargs)
+
+        tmp_path = object_path + '.tmp'
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, object_path)
+
+        self.evict()
+
+        return df
+
+    def _object_path(self, content_hash, read_csv_kwargs):
+
+        # Different parsing options give different frames for the same bytes.
+        options = json.dumps(read_csv_kwargs, sort_keys=True, default=str)
+        key = hashlib.sha256(
+            (content_hash + options).encode('utf-8')
+        ).hexdigest()
+
+        return os.path.join(self.objects_dir, key + '.pickle')
+
+    def _load_object(self, object_path):
+
+        # Bump the access time used for least-recently-used eviction.
+        os.utime(object_path, None)
+
+        return pd.read_pickle(object_path)
+
+    def _entry_path(self, source):
+
+        key = hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.sources_dir, key + '.json')
+
+    def _load_entry(self, source):
+
+        try:
+            with open(self._entry_path(source)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save_entry(self, source, entry):
+
+        entry_path = self._entry_path(source)
+        tmp_path = entry_path + '.tmp'
+
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+
+        os.replace(tmp_path, entry_path)
+
+
+_default_cache = None
+
+
+def default_cache():
+    '''
+    Shared DataFrameCache in DEFAULT_CACHE_DIR, created on first use.
+    '''
+    global _default_cache
+
+    if _default_cache is None:
+        _default_cache = DataFrameCache()
+
+    return _default_cache
+
+
+def _remove(path):
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,8 +1,9 @@
 #! venv/bin/python
 '''
-export_project_csv.py
+export_project.py
 
-Convert `project` collections in MongoDB to a CSV for downstream analysis.
+Convert `project` collections in MongoDB to a CSV, Parquet, or Feather file,
+or a pandas DataFrame, for downstream analysis.
 
 By default includes all the columns as listed in the global DEFAULT_COLUMNS
 variable.
@@ -10,10 +11,17 @@ variable.
 Author: Matthew Turner
 Date: February 27, 2017
 '''
-import csv
+import numpy as np
+import os
 import pandas as pd
+import pickle
+import sys
 
-from app.models import Project, IatvDocument
+from collections import OrderedDict
+from datetime import datetime
+from itertools import islice
+
+from app.models import Project, Facet, IatvDocument
 
 
 IATV_DOCUMENT_COLUMNS = [
@@ -38,82 +46,493 @@ INSTANCE_COLUMNS = [
     'repeat_index'
 ]
 
+DATETIME_COLUMNS = ['start_localtime', 'start_time', 'stop_time']
+
+FLOAT_COLUMNS = ['runtime_seconds', 'repeat_index']
+
+BOOLEAN_COLUMNS = ['repeat']
+
+# Low-cardinality columns stored as pandas categoricals by export_dataframe
+# when asked for. Off by default: grouping on categoricals also makes groups
+# for unobserved category combinations, and the pandas this project pins
+# has no observed=True to turn that off.
+CATEGORICAL_COLUMNS = [
+    'network',
+    'program_name',
+    'facet_word',
+    'conceptual_metaphor',
+    'spoken_by',
+    'active_passive',
+    'tense',
+]
+
+
+# Number of instances whose source documents are fetched per $in query.
+DEFAULT_BATCH_SIZE = 1000
+
+# Extra columns kept in incremental export snapshots to locate each row.
+SNAPSHOT_KEY_COLUMNS = ['_facet_id', '_instance_idx', '_source_id']
+
 
 class ProjectExporter:
 
-    def __init__(self, project_name):
+    def __init__(self, project_name, batch_size=DEFAULT_BATCH_SIZE):
         """
         Initialize a new project exporter
         """
 
         self.project = Project.objects.get(name=project_name)
+        self.batch_size = batch_size
 
-        self.keyed_instances = (
-            (facet.word, instance)
-            for facet in self.project.facets
-            for instance in facet.instances
-            if instance.include
-        )
         self.column_names =\
             IATV_DOCUMENT_COLUMNS + \
             ['facet_word'] + \
             INSTANCE_COLUMNS
 
     def _keyed_instances(self):
+        '''
+        Generate (facet word, instance) pairs for included instances, loading
+        one facet at a time rather than dereferencing them all at once.
+        '''
+        for facet_id in self.project.facet_ids():
+
+            facet = Facet.objects.get(pk=facet_id)
+
+            for instance in facet.iter_instances():
+                if instance.include:
+                    yield (facet.word, instance)
+
+    def _row_batches(self):
+        '''
+        Generate lists of at most batch_size formatted rows. The source
+        documents for each batch of instances are fetched together and
+        joined in memory instead of with one query per instance.
+        '''
+        keyed_instances = self._keyed_instances()
+
+        while True:
+            batch = list(islice(keyed_instances, self.batch_size))
+            if not batch:
+                break
+
+            iatv_docs = _lookup_iatv_docs(
+                instance.source_id for _, instance in batch
+            )
 
-        return self.keyed_instances
-
-    def export_csv(self, export_path):
+            rows = []
+            for keyed_instance in batch:
+                source_id = keyed_instance[1].source_id
+                if source_id not in iatv_docs:
+                    raise IatvDocument.DoesNotExist(
+                        'No IatvDocument with id {}'.format(source_id)
+                    )
+
+                rows.append(_format_row(keyed_instance, iatv_docs[source_id]))
+
+            yield rows
+
+    def _rows(self):
+
+        for rows in self._row_batches():
+            for row in rows:
+                yield row
+
+    def export_incremental(self, snapshot_path, categorical=False):
+        '''
+        Like export_dataframe, but keep a snapshot of the exported rows at
+        snapshot_path. Later calls only re-read the facets that were saved
+        or had instances edited (see Facet.touch) since the snapshot, that
+        were added since, or that have rows from a source document saved
+        since, reuse the other cached source document columns, and merge
+        the result into the cached rows.
+
+        Arguments:
+            snapshot_path (str): pickle file holding the snapshot; created
+                if it does not exist
+            categorical (bool): see export_dataframe
+        '''
+        # Taken before reading so edits made during the export are picked
+        # up by the next one.
+        snapshot_time = datetime.now()
+        facet_ids = self.project.facet_ids()
+
+        snapshot = _load_snapshot(snapshot_path)
+
+        if snapshot is None or snapshot['project_id'] != self.project.pk:
+            cached_blocks = {}
+            known_docs = {}
+            changed = set(facet_ids)
+        else:
+            cached = snapshot['frame']
+            cached_blocks = dict(
+                list(cached.groupby('_facet_id', sort=False))
+            )
+            # Stored times are truncated to the millisecond, so anything
+            # from the snapshot's millisecond on may be newer.
+            since = _to_mongo_precision(snapshot['snapshot_time'])
+            changed = set(
+                Facet.objects(
+                    id__in=facet_ids, last_modified__gte=since
+                ).scalar('id')
+            )
+            changed.update(set(facet_ids) - set(snapshot['facet_ids']))
 
-        with open(export_path, 'w') as f:
+            # Rows of source documents saved since are rebuilt along with
+            # the rest of their facets.
+            changed_docs = set(
+                IatvDocument.objects(last_modified__gte=since).scalar('id')
+            )
+            stale = cached['_source_id'].isin(changed_docs)
+            changed.update(cached.loc[stale, '_facet_id'])
+
+            first_rows = cached[~stale].drop_duplicates('_source_id')
+            known_docs = dict(zip(
+                first_rows['_source_id'],
+                first_rows[IATV_DOCUMENT_COLUMNS].to_dict('records')
+            ))
+
+            if not changed and facet_ids == snapshot['facet_ids']:
+                return _from_snapshot_frame(cached, categorical)
+
+        blocks = []
+        for facet_id in facet_ids:
+            if facet_id in changed:
+                blocks.append(self._snapshot_block(facet_id, known_docs))
+            elif facet_id in cached_blocks:
+                blocks.append(cached_blocks[facet_id])
+
+        if blocks:
+            frame = pd.concat(blocks, ignore_index=True)
+        else:
+            frame = _build_frame(
+                OrderedDict(
+                    (name, [])
+                    for name in self.column_names + SNAPSHOT_KEY_COLUMNS
+                ),
+                categorical=False
+            )
 
-            csvwriter = csv.writer(f)
+        _save_snapshot(snapshot_path, {
+            'project_id': self.project.pk,
+            'snapshot_time': snapshot_time,
+            'facet_ids': facet_ids,
+            'frame': frame
+        })
+
+        return _from_snapshot_frame(frame, categorical)
+
+    def _snapshot_block(self, facet_id, known_docs):
+        '''
+        Rows, with SNAPSHOT_KEY_COLUMNS, for one facet's included instances.
+        Only source documents missing from known_docs are looked up.
+        '''
+        facet = Facet.objects.get(pk=facet_id)
+
+        included = [
+            (idx, instance)
+            for idx, instance in enumerate(facet.iter_instances())
+            if instance.include
+        ]
+
+        missing = list(set(
+            instance.source_id for _, instance in included
+            if instance.source_id not in known_docs
+        ))
+        for start in range(0, len(missing), self.batch_size):
+            known_docs.update(
+                _lookup_iatv_docs(missing[start:start + self.batch_size])
+            )
 
-            csvwriter.writerow(
-                self.colunm_names
+        column_names = self.column_names + SNAPSHOT_KEY_COLUMNS
+        columns = OrderedDict((name, []) for name in column_names)
+        appends = [column.append for column in columns.values()]
+
+        for idx, instance in included:
+            source_id = instance.source_id
+            if source_id not in known_docs:
+                raise IatvDocument.DoesNotExist(
+                    'No IatvDocument with id {}'.format(source_id)
+                )
+
+            row = _format_row((facet.word, instance), known_docs[source_id])
+            row += [facet_id, idx, source_id]
+            for append, value in zip(appends, row):
+                append(value)
+
+        return _build_frame(columns, categorical=False)
+
+    def export(self, export_path, export_format=None, progress=None):
+        '''
+        Stream the included instances to export_path in chunks of
+        batch_size rows, so only one chunk is held in memory at a time.
+
+        Arguments:
+            export_path (str): file to write
+            export_format (str): one of EXPORT_FORMATS; inferred from the
+                export_path extension if None. Parquet and Feather require
+                pyarrow.
+            progress (callable): called with the total number of rows
+                written after each chunk
+
+        Returns:
+            (int) number of rows written
+        '''
+        if export_format is None:
+            export_format = _format_from_path(export_path)
+
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(
+                'export_format must be one of {}, not {}'.format(
+                    EXPORT_FORMATS, export_format
+                )
             )
 
-            for inst in self._keyed_instances():
-                csvwriter.writerow(_format_row(inst))
+        writer = _CHUNK_WRITERS[export_format](export_path, self.column_names)
+
+        n_rows = 0
+        try:
+            for rows in self._row_batches():
+
+                columns = OrderedDict(
+                    zip(self.column_names, map(list, zip(*rows)))
+                )
+                writer.write(_build_frame(columns, categorical=False))
+
+                n_rows += len(rows)
+                if progress is not None:
+                    progress(n_rows)
+        finally:
+            writer.close()
+
+        return n_rows
+
+    def export_csv(self, export_path, progress=None):
+
+        return self.export(export_path, 'csv', progress=progress)
+
+    def export_dataframe(self, categorical=False):
+        '''
+        Build the project DataFrame in a single pass over the rows, gathering
+        one list of values per column and creating the frame once.
+
+        Arguments:
+            categorical (bool): store CATEGORICAL_COLUMNS as pandas
+                categoricals instead of object columns. Group on them with
+                observed=True, which needs pandas 0.23 or later.
+        '''
+        columns = OrderedDict((name, []) for name in self.column_names)
+        appends = [column.append for column in columns.values()]
+
+        for row in self._rows():
+            for append, value in zip(appends, row):
+                append(value)
+
+        return _build_frame(columns, categorical=categorical)
+
+
+def _to_mongo_precision(time):
+    '''
+    time truncated to the milliseconds MongoDB stores.
+    '''
+    return time.replace(microsecond=time.microsecond // 1000 * 1000)
+
+
+def _lookup_iatv_docs(source_ids):
+    '''
+    Fetch only the IATV_DOCUMENT_COLUMNS of the given documents in a single
+    $in query, skipping the transcripts.
+
+    Returns:
+        (dict) raw documents keyed by id
+    '''
+    iatv_docs = IatvDocument.objects(
+        pk__in=list(set(source_ids))
+    ).only('id', *IATV_DOCUMENT_COLUMNS).as_pymongo()
+
+    return {iatv_doc['_id']: iatv_doc for iatv_doc in iatv_docs}
+
+
+def _load_snapshot(snapshot_path):
+
+    if not os.path.exists(snapshot_path):
+        return None
+
+    with open(snapshot_path, 'rb') as f:
+        return pickle.load(f)
 
-    def export_dataframe(self):
 
-        df = pd.DataFrame(columns=self.column_names)
+def _save_snapshot(snapshot_path, snapshot):
 
-        for idx, inst in enumerate(self._keyed_instances()):
-            df.loc[idx] = _format_row(inst)
+    # Write then rename so an interrupted save never leaves a partial file.
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
 
-        return df
+    os.replace(tmp_path, snapshot_path)
 
 
-def _lookup_iatv_doc(instance):
-    return IatvDocument.objects.get(pk=instance.source_id)
+def _from_snapshot_frame(frame, categorical=False):
 
+    df = frame.drop(SNAPSHOT_KEY_COLUMNS, axis=1).reset_index(drop=True)
 
-def _format_row(instance):
-    iatv_doc = _lookup_iatv_doc(instance[1])
+    if categorical:
+        for name in CATEGORICAL_COLUMNS:
+            df[name] = df[name].astype('category')
+
+    return df
+
+
+def _build_frame(columns, categorical=False):
+    '''
+    Create a DataFrame from an ordered mapping of column name to list of
+    values, converting each column to its typed array first.
+    '''
+    data = OrderedDict()
+
+    for name, values in columns.items():
+
+        if name in DATETIME_COLUMNS:
+            data[name] = pd.to_datetime(values)
+        elif name in FLOAT_COLUMNS:
+            data[name] = np.array(values, dtype=np.float64)
+        elif name in BOOLEAN_COLUMNS:
+            data[name] = np.array(values, dtype=bool)
+        elif categorical and name in CATEGORICAL_COLUMNS:
+            data[name] = pd.Categorical(values)
+        else:
+            data[name] = values
+
+    return pd.DataFrame(data, columns=list(columns))
+
+
+def _format_row(instance, iatv_doc):
     facet_word = instance[0]
-    return [iatv_doc[field] for field in IATV_DOCUMENT_COLUMNS] +\
+    return [iatv_doc.get(field) for field in IATV_DOCUMENT_COLUMNS] +\
         [facet_word] + [instance[1][field] for field in INSTANCE_COLUMNS]
 
 
-def main(project_name, export_path):
+class _CsvChunkWriter:
+
+    def __init__(self, export_path, column_names):
+        self.column_names = column_names
+        self.f = open(export_path, 'w')
+        self.header = True
+
+    def write(self, chunk):
+        chunk.to_csv(self.f, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        # Always leave a header, even when there were no rows to write.
+        if self.header:
+            self.write(pd.DataFrame(columns=self.column_names))
+        self.f.close()
+
+
+class _ArrowChunkWriter:
+    '''
+    Base for the pyarrow-backed writers. Chunks are converted with a fixed
+    schema so that columns that happen to be all null in one chunk have the
+    same type as in every other chunk.
+    '''
+
+    def __init__(self, export_path, column_names):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(
+                'pyarrow is required to export Parquet or Feather files'
+            )
+
+        self.pa = pyarrow
+        self.schema = pyarrow.schema(
+            [(name, _arrow_type(pyarrow, name)) for name in column_names]
+        )
+        self.writer = self._open(export_path)
+
+    def write(self, chunk):
+        table = self.pa.Table.from_pandas(
+            chunk, schema=self.schema, preserve_index=False
+        )
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+class _ParquetChunkWriter(_ArrowChunkWriter):
+
+    def _open(self, export_path):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.ParquetWriter(export_path, self.schema)
+
+
+class _FeatherChunkWriter(_ArrowChunkWriter):
+
+    def _open(self, export_path):
+        # Feather version 2 is the Arrow IPC file format.
+        return self.pa.ipc.new_file(export_path, self.schema)
+
+
+def _arrow_type(pyarrow, column_name):
+
+    if column_name in DATETIME_COLUMNS:
+        return pyarrow.timestamp('us')
+    elif column_name in FLOAT_COLUMNS:
+        return pyarrow.float64()
+    elif column_name in BOOLEAN_COLUMNS:
+        return pyarrow.bool_()
+    else:
+        return pyarrow.string()
+
+
+_CHUNK_WRITERS = {
+    'csv': _CsvChunkWriter,
+    'parquet': _ParquetChunkWriter,
+    'feather': _FeatherChunkWriter,
+}
+
+EXPORT_FORMATS = tuple(sorted(_CHUNK_WRITERS))
+
+
+def _format_from_path(export_path):
+
+    extension = os.path.splitext(export_path)[1].lower().lstrip('.')
+
+    return {'pq': 'parquet', 'arrow': 'feather'}.get(extension, extension)
+
+
+def main(project_name, export_path, batch_size=DEFAULT_BATCH_SIZE):
     """
-    Run the shit
+    Export project_name to export_path, reporting progress on stderr
     """
 
-    pe = ProjectExporter(project_name)
-    pe.export(export_path)
+    def progress(n_rows):
+        sys.stderr.write('\rexported {} rows'.format(n_rows))
+        sys.stderr.flush()
 
+    pe = ProjectExporter(project_name, batch_size=batch_size)
+    n_rows = pe.export(export_path, progress=progress)
+
+    sys.stderr.write('\rexported {} rows to {}\n'.format(n_rows, export_path))
 
-if __name__ == '__main__':
 
-    import sys
+if __name__ == '__main__':
 
     help_msg = '''
-./export_project_csv.py <project_name> <export_path>
+./export_project.py <project_name> <export_path> [batch_size]
+
+The export format, csv, parquet, or feather, is taken from the extension
+of export_path.
 
 Example:
-    ./export_project_csv.py 'Viomet Sep-Nov 2016' viomet-sep-nov-2016.csv
+    ./export_project.py 'Viomet Sep-Nov 2016' viomet-sep-nov-2016.csv
 '''
-    main(sys.argv[1], sys.argv[2])
+    if len(sys.argv) not in (3, 4):
+        sys.exit(help_msg)
+
+    if len(sys.argv) == 4:
+        main(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+    else:
+        main(sys.argv[1], sys.argv[2])
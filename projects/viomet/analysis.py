@@ -4,36 +4,56 @@ Author: Matthew Turner <maturner01@gmail.com>
 
 Date: April 01, 2017
 '''
+import multiprocessing
 import numpy as np
 import pandas as pd
 
-from collections import Counter
+from collections import Counter, OrderedDict, namedtuple
 from datetime import datetime
-from functools import reduce
-
-from rpy2.robjects.packages import importr
-from rpy2 import robjects as ro
-from rpy2.robjects import pandas2ri
+from functools import lru_cache, reduce
+from scipy import stats
 
 from app.models import IatvCorpus
 from projects.common import (
     daily_frequency, daily_metaphor_counts, get_project_data_frame
 )
 
-pandas2ri.activate()
-R = ro.r
 
+RBackend = namedtuple(
+    'RBackend', ['lm', 'lme', 'extractAIC', 'coef', 'summary']
+)
+
+
+@lru_cache(maxsize=None)
+def r_backend():
+    '''
+    Start embedded R and load the functions used by backend='r'. This takes
+    seconds, so it happens on first use rather than on import, and only
+    once per process.
+
+    Returns:
+        (RBackend) R's lm, lme4's lmer, and stats and base helpers
+    '''
+    from rpy2 import robjects as ro
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects.packages import importr
+
+    pandas2ri.activate()
 
-# glmer = importr('lme4').glmer
-lme = importr('lme4').lmer
-lm = R.lm
+    r_stats = importr('stats')
 
-extractAIC = importr('stats').extractAIC
-coef = importr('stats').coef
+    return RBackend(
+        lm=ro.r.lm,
+        # glmer = importr('lme4').glmer
+        lme=importr('lme4').lmer,
+        extractAIC=r_stats.extractAIC,
+        coef=r_stats.coef,
+        summary=importr('base').summary
+    )
 
 
 def get_pvalue(model):
-    return importr('base').summary(model).rx2('coefficients')[-1]
+    return r_backend().summary(model).rx2('coefficients')[-1]
 
 
 DEFAULT_FIRST_DATES = [
@@ -54,12 +74,40 @@ def partition_AICs(df,
                    candidate_excited_date_pairs=[()],
                    model_formula='count ~ phase + network + facet + (1|date)',
                    verbose=False,
-                   poisson=False
+                   poisson=False,
+                   backend='numpy'
                    ):
     '''
     Given a dataframe with columns "date", "network", "facet", and "count",
     generates a dataframe with the AIC of each partition date.
+
+    The default numpy backend only fits two-level step models of the form
+    '<response> ~ state', which have a closed-form least-squares solution,
+    so all candidate pairs are fit at once. It also fills a 'pvalue' column
+    and leaves 'model' empty. Use backend='r' to fit each pair with R's lm
+    as a reference or for any other model formula.
+    '''
+    if backend == 'numpy':
+        return _partition_AICs_numpy(
+            df, candidate_excited_date_pairs, model_formula, verbose, poisson
+        )
+    elif backend == 'r':
+        return _partition_AICs_r(
+            df, candidate_excited_date_pairs, model_formula, verbose, poisson
+        )
+    else:
+        raise ValueError(
+            'backend must be "numpy" or "r", not {}'.format(backend)
+        )
+
+
+def _partition_AICs_r(df, candidate_excited_date_pairs, model_formula,
+                      verbose, poisson):
     '''
+    Fit one R model per candidate pair; see partition_AICs.
+    '''
+    r = r_backend()
+
     d = {
         'first_date': [],
         'last_date': [],
@@ -94,25 +142,139 @@ def partition_AICs(df,
             # there are at most two shows on a day, so the fraction part
             # of frequency is 1/2 or 0.
             phase_df.freq *= 2
-            model = lm(
+            model = r.lm(
                 model_formula,
                 family='poisson',
                 data=phase_df
             )
-            d['coef'].append(list(coef(model)))
+            d['coef'].append(list(r.coef(model)))
         else:
-            model = lm(
+            model = r.lm(
                 model_formula,
                 data=phase_df
             )
-            d['coef'].append(list(coef(model)))
+            d['coef'].append(list(r.coef(model)))
 
-        d['AIC'].append(extractAIC(model)[1])
+        d['AIC'].append(r.extractAIC(model)[1])
         d['model'].append(model)
 
     return pd.DataFrame(d)
 
 
+def _partition_AICs_numpy(df, candidate_excited_date_pairs, model_formula,
+                          verbose, poisson):
+    '''
+    Closed-form fit of '<response> ~ state' for every candidate pair at
+    once using prefix sums over the date-sorted response. Coefficients,
+    AIC, and p-value follow R's lm, extractAIC, and summary conventions,
+    with the excited state as the reference level.
+    '''
+    response, _, terms = (s.strip() for s in model_formula.partition('~'))
+    if terms != 'state':
+        raise ValueError(
+            'numpy backend only fits "<response> ~ state" models, '
+            'use backend="r" for {}'.format(model_formula)
+        )
+
+    columns = ['first_date', 'last_date', 'AIC', 'coef', 'model', 'pvalue']
+
+    pairs = [pair for pair in candidate_excited_date_pairs if len(pair) == 2]
+    if len(pairs) == 0:
+        return pd.DataFrame(columns=columns)
+
+    y = df[response].values.astype(np.float64)
+    dates = _as_days(df.date)
+
+    # R's lm drops rows with a missing response.
+    observed = ~np.isnan(y)
+    y = y[observed]
+    dates = dates[observed]
+
+    order = np.argsort(dates, kind='mergesort')
+    dates = dates[order]
+    y = y[order]
+
+    # Mirror the R backend, which doubles frequencies for the poisson fit.
+    if poisson:
+        y = y * 2
+
+    n = len(y)
+
+    # Center first so the prefix sums of squares keep their precision.
+    y_mean = y.mean() if n else 0.0
+    y = y - y_mean
+    cumsum = np.concatenate([[0.0], np.cumsum(y)])
+    cumsum_sq = np.concatenate([[0.0], np.cumsum(y ** 2)])
+
+    first_dates = _as_days([pair[0] for pair in pairs])
+    last_dates = _as_days([pair[1] for pair in pairs])
+
+    lo = np.searchsorted(dates, first_dates, side='left')
+    hi = np.maximum(np.searchsorted(dates, last_dates, side='right'), lo)
+
+    n_excited = hi - lo
+    n_ground = n - n_excited
+
+    # Same exclusions as the R backend: need both states and at least ten
+    # excited-state observations.
+    fit_idx = np.flatnonzero((n_excited >= 10) & (n_ground > 0))
+
+    lo = lo[fit_idx]
+    hi = hi[fit_idx]
+    n_excited = n_excited[fit_idx]
+    n_ground = n_ground[fit_idx]
+
+    sum_excited = cumsum[hi] - cumsum[lo]
+    sum_ground = cumsum[n] - sum_excited
+    sq_excited = cumsum_sq[hi] - cumsum_sq[lo]
+    sq_ground = cumsum_sq[n] - sq_excited
+
+    mean_excited = sum_excited / n_excited
+    mean_ground = sum_ground / n_ground
+
+    rss = np.maximum(
+        (sq_excited - sum_excited * mean_excited) +
+        (sq_ground - sum_ground * mean_ground),
+        0.0
+    )
+
+    # The intercept is the excited-state mean, the state coefficient is the
+    # ground minus the excited mean, as in R with alphabetical levels.
+    intercept = mean_excited + y_mean
+    state_coef = mean_ground - mean_excited
+
+    df_residual = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aic = n * np.log(rss / n) + 2 * 2
+
+        std_err = np.sqrt(
+            (rss / df_residual) * (1.0 / n_excited + 1.0 / n_ground)
+        )
+        t_value = state_coef / std_err
+        pvalue = 2 * stats.t.sf(np.abs(t_value), df_residual)
+
+    if verbose:
+        print('Calculated {} of {} candidate date pairs'.format(
+            len(fit_idx), len(pairs)
+        ))
+
+    return pd.DataFrame(
+        {
+            'first_date': [pairs[i][0] for i in fit_idx],
+            'last_date': [pairs[i][1] for i in fit_idx],
+            'AIC': aic,
+            'coef': [list(c) for c in zip(intercept, state_coef)],
+            'model': [None] * len(fit_idx),
+            'pvalue': pvalue
+        },
+        columns=columns
+    )
+
+
+def _as_days(values):
+    return pd.to_datetime(list(values)).values.astype('datetime64[D]')
+
+
 def add_phases(df, date1=datetime(2016, 9, 26),
                date2=datetime(2016, 10, 20)):
     '''
@@ -207,6 +369,42 @@ def partition_info_table(viomet_df,
     return pd.DataFrame(data=data, index=index, columns=columns)
 
 
+def partition_sums(counts_df, partition_infos):
+    '''
+    Total counts in the ground and excited states of each network in
+    partition_infos. 'All', if there, is the sum over every network column
+    unless counts_df has its own 'All' column.
+
+    Arguments:
+        counts_df (pandas.DataFrame): daily counts with a column per
+            network, from daily_metaphor_counts(df, date_range,
+            by=['network'])
+        partition_infos (dict): PartitionInfo for each network
+
+    Returns:
+        (pandas.DataFrame) ground and excited columns indexed by network
+    '''
+    if 'All' in partition_infos and 'All' not in counts_df.columns:
+        counts_df = counts_df.assign(All=counts_df.sum(axis=1))
+
+    networks = list(partition_infos)
+
+    return pd.DataFrame(
+        index=networks,
+        data=OrderedDict([
+            ('ground', [
+                _get_ground(counts_df, network, partition_infos)[0]
+                for network in networks
+            ]),
+            ('excited', [
+                _get_excited(counts_df, network, partition_infos)[0]
+                for network in networks
+            ])
+        ]),
+        dtype=np.float64
+    )
+
+
 def by_network_word_table(viomet_df,
                           date_range,
                           partition_infos,
@@ -293,9 +491,12 @@ def model_fits_table(viomet_df, date_range, network_fits, top_n=10):
         network_df.drop_duplicates(subset='rl', inplace=True)
 
         network_df = network_df.iloc[:top_n]
-        network_df['pvalue'] = [
-            get_pvalue(model) for model in list(network_df.model)
-        ]
+
+        # The numpy backend computes p-values while fitting.
+        if 'pvalue' not in network_df:
+            network_df['pvalue'] = [
+                get_pvalue(model) for model in list(network_df.model)
+            ]
 
         # Multiply by -1.0 b/c excited
         # treated as "less" than ground due to alpha ordering in R.
@@ -469,8 +670,19 @@ def viomet_analysis_setup(year=2012):
 
 
 def fit_all_networks(df, date_range, iatv_corpus_name,
-                     by_network=True, poisson=False, verbose=False):
+                     by_network=True, poisson=False, verbose=False,
+                     backend='numpy', n_jobs=1, chunk_size=None):
+    '''
+    Fit the step model to every candidate pair of excited-state dates for
+    each network, or for all networks together if by_network is False.
 
+    Arguments:
+        n_jobs (int): number of worker processes. With n_jobs > 1 the
+            (network, chunk of candidate pairs) work units are spread over
+            a process pool; each worker runs its own R session.
+        chunk_size (int): number of candidate pairs per work unit; by
+            default the pairs are split into about four chunks per worker.
+    '''
     ic = IatvCorpus.objects(name=iatv_corpus_name)[0]
 
     # The first date of date_range can't be the last excited state date.
@@ -482,6 +694,11 @@ def fit_all_networks(df, date_range, iatv_corpus_name,
         for fd in date_range[date_range < ld]
     ]
 
+    fit_kwargs = dict(
+        model_formula='freq ~ state', poisson=poisson, verbose=verbose,
+        backend=backend
+    )
+
     if by_network:
 
         if iatv_corpus_name is None:
@@ -491,8 +708,9 @@ def fit_all_networks(df, date_range, iatv_corpus_name,
 
         network_freq = daily_frequency(df, date_range, ic, by=['network'])
 
-        results = {}
-        for network in ['MSNBCW', 'CNNW', 'FOXNEWSW']:
+        networks = ['MSNBCW', 'CNNW', 'FOXNEWSW']
+        network_frames = OrderedDict()
+        for network in networks:
 
             single_network = \
                 network_freq[network].to_frame().reset_index().dropna()
@@ -500,11 +718,17 @@ def fit_all_networks(df, date_range, iatv_corpus_name,
             # this is ugly but required to match partition_AICs at this time
             single_network.columns = ['date', 'freq']
 
-            all_fits = partition_AICs(single_network,
-                                      candidate_excited_date_pairs,
-                                      model_formula='freq ~ state',
-                                      poisson=poisson,
-                                      verbose=verbose)
+            network_frames[network] = single_network
+
+        network_fits = _sharded_partition_AICs(
+            network_frames, candidate_excited_date_pairs, n_jobs, chunk_size,
+            **fit_kwargs
+        )
+
+        results = {}
+        for network in networks:
+
+            all_fits = network_fits[network]
 
             # The first date of the second level state cannot be the first
             # date in the dataset.
@@ -530,10 +754,77 @@ def fit_all_networks(df, date_range, iatv_corpus_name,
 
         all_freq.columns = ['date', 'freq']
 
-        all_fits = partition_AICs(all_freq,
-                                  candidate_excited_date_pairs,
-                                  model_formula='freq ~ state')
+        all_fits = _sharded_partition_AICs(
+            OrderedDict([('All', all_freq)]), candidate_excited_date_pairs,
+            n_jobs, chunk_size, **fit_kwargs
+        )['All']
 
         best_fit = all_fits.iloc[all_fits['AIC'].idxmin()]
 
         return best_fit
+
+
+def _sharded_partition_AICs(frames, candidate_excited_date_pairs,
+                            n_jobs=1, chunk_size=None, **kwargs):
+    '''
+    Run partition_AICs over (key, chunk of candidate pairs) shards, in a
+    process pool if n_jobs > 1. Shards are merged back in key and candidate
+    pair order regardless of the order in which workers finish, so results
+    do not depend on n_jobs.
+
+    Arguments:
+        frames (OrderedDict): date/freq frames keyed by, e.g., network
+        kwargs: passed through to partition_AICs
+
+    Returns:
+        (dict) AIC frames keyed like frames
+    '''
+    pairs = list(candidate_excited_date_pairs)
+
+    if chunk_size is None:
+        chunk_size = int(np.ceil(len(pairs) / float(max(n_jobs, 1) * 4)))
+    chunk_size = max(chunk_size, 1)
+
+    chunks = [
+        pairs[start:start + chunk_size]
+        for start in range(0, len(pairs), chunk_size)
+    ]
+
+    shards = [
+        (key, chunk_idx, frame, chunk, kwargs)
+        for key, frame in frames.items()
+        for chunk_idx, chunk in enumerate(chunks)
+    ]
+
+    if n_jobs > 1:
+        # Spawn rather than fork so no worker inherits the parent's
+        # embedded R; each one starts its own on first use.
+        # (ProcessPoolExecutor only takes a start method from Python 3.7.)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=n_jobs) as pool:
+            shard_fits = pool.map(_fit_partition_shard, shards)
+    else:
+        shard_fits = [_fit_partition_shard(shard) for shard in shards]
+
+    fits_by_shard = {
+        (key, chunk_idx): fits for key, chunk_idx, fits in shard_fits
+    }
+
+    return {
+        key: pd.concat(
+            [fits_by_shard[(key, chunk_idx)]
+             for chunk_idx in range(len(chunks))],
+            ignore_index=True
+        ) if chunks else partition_AICs(frame, [], **kwargs)
+        for key, frame in frames.items()
+    }
+
+
+def _fit_partition_shard(shard):
+    '''
+    Work unit for _sharded_partition_AICs. Module-level so the process pool
+    can pickle it.
+    '''
+    key, chunk_idx, frame, pairs, kwargs = shard
+
+    return key, chunk_idx, partition_AICs(frame, pairs, **kwargs)
@@ -5,10 +5,7 @@ Author: Matthew Turner <maturner01@gmail.com>
 
 Date: April 01, 2017
 '''
-import matplotlib.pyplot as plt
-import matplotlib.dates as pltdates
 import pandas as pd
-import seaborn as sns
 
 from datetime import date, datetime, timedelta
 
@@ -18,9 +15,8 @@ from projects.common.analysis import (
     daily_frequency, daily_metaphor_counts
 )
 
-
-CUR_PAL = sns.color_palette()
-
+# matplotlib and seaborn take most of a second to import, so each plotting
+# function imports them itself and importing this module stays cheap.
 
 # for 8.5x11 paper
 DEFAULT_FIGSIZE = (7.5, 5)
@@ -36,6 +32,9 @@ def by_network_frequency_figure(
             partition_infos=None,
             font_scale=1.15,
             save_path=None):
+    import matplotlib.dates as pltdates
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     sns.axes_style("darkgrid")
     sns.set(font_scale=font_scale)
@@ -137,6 +136,9 @@ def plot_daily_usage(df, ma_period=7, lw=3, marker='o', ms=10, xlab='Date',
     Plot daily and `ma_period`-day moving average from dataframe with index
     of every date in observation period (currently Sep 1 - Nov 30)
     '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     sns.set(font_scale=1.75)
 
     # calculate the moving average over ma_period
@@ -144,7 +146,7 @@ def plot_daily_usage(df, ma_period=7, lw=3, marker='o', ms=10, xlab='Date',
 
     ax = ma.plot(lw=lw, figsize=(15, 12))
 
-    df.plot(marker='o', ms=ms, lw=0, ax=ax, color=CUR_PAL)
+    df.plot(marker='o', ms=ms, lw=0, ax=ax, color=sns.color_palette())
 
     p, _ = ax.get_legend_handles_labels()
     leg = ax.legend(p, ['attack ({}-day MA)'.format(ma_period), 'beat', 'hit',
@@ -176,6 +178,10 @@ def plot_total_daily_usage(series, ma_period=5, lw=3, marker='o', ms=6,
                            show_means=False,
                            save_path=None,
                            title='Figurative violence usage during debate season'):
+    import matplotlib.dates as pltdates
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     sns.set(font_scale=1.5)
 
     fig = plt.figure(figsize=(16, 9))
@@ -258,6 +264,9 @@ def aic_heatmap(df, relative=False, lw=2, annot=True, lim_ticklabels=False,
     Returns:
         (matplotlib.pyplot.Axes): Axes plotted to
     '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     sns.set(font_scale=1.2)
 
     cbar_kws = dict(label='Relative Likelihood, $\mathcal{L}_i$', size=16)
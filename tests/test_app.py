@@ -0,0 +1,203 @@
+import json
+import re
+
+from bson import ObjectId
+from nose.tools import ok_
+from unittest import mock
+
+import app.app as app_module
+
+from app.app import FACET_PAGE_SIZE, MAX_FACET_PAGE_SIZE
+from app.cache import MemoryBackend, ResponseCache
+from app.extensions import get_app
+from app.models import Facet, Instance, Project
+
+
+def _setup_project(n_instances=5):
+
+    facet = Facet(
+        word='attack',
+        instances=[
+            Instance(text='ATTACK {}'.format(idx), source_id=ObjectId())
+            for idx in range(n_instances)
+        ],
+        total_count=n_instances
+    )
+    facet.save()
+
+    project = Project(name='Test app {}'.format(ObjectId()), facets=[facet])
+    project.save()
+
+    return project
+
+
+def _teardown_project(project):
+
+    Facet.objects(pk__in=project.facet_ids()).delete()
+    project.delete()
+
+
+def _view(endpoint, url, view_args, **request):
+    '''
+    Response of the view for endpoint to a request for url, skipping the
+    login check. request is passed on to test_request_context, e.g. method
+    and data.
+    '''
+    app = get_app()
+
+    with app.test_request_context(url, **request):
+        return app.view_functions['metacorps.' + endpoint].__wrapped__(
+            **view_args
+        )
+
+
+def _facet_page(project, query):
+    '''
+    (page, number of pages, instance numbers shown) of the facet view with
+    the query string query.
+    '''
+    html = _view(
+        'facet',
+        '/projects/{}/facets/attack?{}'.format(project.pk, query),
+        dict(project_id=str(project.pk), facet_word='attack')
+    )
+
+    pages = re.search(r'Page (\d+) of (\d+)', html)
+    page, n_pages = map(int, pages.groups()) if pages else (1, 1)
+
+    shown = [int(idx) for idx in re.findall(r'<h5>Instance (\d+)', html)]
+
+    return page, n_pages, shown
+
+
+def test_facet_view_page_bounds():
+
+    project = _setup_project()
+
+    try:
+        ok_(_facet_page(project, 'per_page=2') == (1, 3, [1, 2]))
+        ok_(_facet_page(project, 'page=2&per_page=2') == (2, 3, [3, 4]))
+
+        # pages before the first are the first page
+        ok_(_facet_page(project, 'page=0&per_page=2') == (1, 3, [1, 2]))
+        ok_(_facet_page(project, 'page=-1&per_page=2') == (1, 3, [1, 2]))
+
+        # pages past the end are the last page
+        ok_(_facet_page(project, 'page=3&per_page=2') == (3, 3, [5]))
+        ok_(_facet_page(project, 'page=99&per_page=2') == (3, 3, [5]))
+
+        # non-integer values are the defaults
+        ok_(_facet_page(project, 'page=two&per_page=2') == (1, 3, [1, 2]))
+        ok_(_facet_page(project, 'per_page=two') ==
+            (1, 1, [1, 2, 3, 4, 5]))
+        ok_(_facet_page(project, 'per_page=2.5') ==
+            (1, 1, [1, 2, 3, 4, 5]))
+
+        # at least one instance per page
+        ok_(_facet_page(project, 'per_page=0') == (1, 5, [1]))
+        ok_(_facet_page(project, 'page=5&per_page=-2') == (5, 5, [5]))
+
+        ok_(_facet_page(project, 'per_page={}'.format(
+            MAX_FACET_PAGE_SIZE + 1
+        )) == (1, 1, [1, 2, 3, 4, 5]))
+
+    finally:
+        _teardown_project(project)
+
+
+def test_facet_view_per_page_limit():
+
+    n_instances = MAX_FACET_PAGE_SIZE + 1
+    project = _setup_project(n_instances)
+
+    try:
+        ok_(_facet_page(project, '') ==
+            (1, 11, list(range(1, FACET_PAGE_SIZE + 1))))
+
+        # at most MAX_FACET_PAGE_SIZE per page
+        page, n_pages, shown = _facet_page(
+            project, 'page=2&per_page={}'.format(n_instances)
+        )
+        ok_((page, n_pages, shown) == (2, 2, [n_instances]))
+
+    finally:
+        _teardown_project(project)
+
+
+def _total_count(project):
+    '''
+    Total instances column of the project view.
+    '''
+    html = _view(
+        'project', '/projects/{}'.format(project.pk),
+        dict(project_id=str(project.pk))
+    )
+
+    return int(re.search(r'<td>(\d+)</td>', html).group(1))
+
+
+def test_facet_view_cache():
+
+    project = _setup_project()
+    facet_id = str(project.facet_ids()[0])
+
+    # as stored before Facet.last_modified existed
+    Facet._get_collection().update_one(
+        {'_id': project.facet_ids()[0]}, {'$unset': {'last_modified': ''}}
+    )
+
+    app = get_app()
+    response_cache = app.extensions['response_cache']
+    # whatever backend the config names, use one that caches
+    app.extensions['response_cache'] = ResponseCache(MemoryBackend())
+
+    def facet_page():
+        return _view(
+            'facet', '/projects/{}/facets/attack'.format(project.pk),
+            dict(project_id=str(project.pk), facet_word='attack')
+        )
+
+    try:
+        with mock.patch.object(app_module, '_render_facet',
+                               wraps=app_module._render_facet) as rendered:
+
+            facet_page()
+            facet_page()
+            ok_(rendered.call_count == 1)
+
+            ok_(_total_count(project) == 5)
+
+            response = _view(
+                'api_facet_instance',
+                '/api/facets/{}/instances/0'.format(facet_id),
+                dict(facet_id=facet_id, instance_idx=0),
+                method='POST', data={'subjects': 'media'}
+            )
+            ok_(response.status_code == 200)
+
+            ok_('<b>Subject(s):</b> media' in facet_page())
+            facet_page()
+            ok_(rendered.call_count == 2)
+
+            response = _view(
+                'api_bulk_update_instances', '/api/instances/bulk', {},
+                method='POST', content_type='application/json',
+                data=json.dumps([{
+                    'facet': facet_id, 'index': 1,
+                    'fields': {'tense': 'past'}
+                }])
+            )
+            ok_(json.loads(response.get_data(as_text=True))['n_updated'] ==
+                1)
+
+            ok_('<b>Tense:</b> past' in facet_page())
+            facet_page()
+            ok_(rendered.call_count == 3)
+
+        # instance edits don't change project pages, so they stay cached
+        Facet.objects(pk=facet_id).update(set__total_count=6)
+        ok_(_total_count(project) == 5)
+
+    finally:
+        app.extensions['response_cache'] = response_cache
+        _teardown_project(project)
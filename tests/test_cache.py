@@ -0,0 +1,71 @@
+import time
+
+from nose.tools import ok_
+
+from app.cache import MemoryBackend, NullBackend, ResponseCache
+
+
+def test_memory_backend():
+
+    backend = MemoryBackend(max_entries=2)
+
+    backend.set('a', 1)
+    backend.set('b', 2, timeout=0.01)
+    ok_(backend.get('a') == 1 and backend.get('b') == 2)
+
+    time.sleep(0.02)
+    ok_(backend.get('b') is None)
+
+    # least recently used first
+    backend.set('b', 2)
+    backend.get('a')
+    backend.set('c', 3)
+    ok_(backend.get('a') == 1 and backend.get('b') is None)
+
+    ok_(backend.delete('a') and backend.get('a') is None)
+
+
+def test_response_cache():
+
+    cache = ResponseCache(MemoryBackend())
+    calls = []
+
+    def make(value):
+        def _make():
+            calls.append(value)
+            return value
+        return _make
+
+    ok_(cache.get_or_set('facet:1', ('page', 1), make('one')) == 'one')
+    ok_(cache.get_or_set('facet:1', ('page', 1), make('new')) == 'one')
+    ok_(cache.get_or_set('facet:1', ('page', 2), make('two')) == 'two')
+    ok_(cache.get_or_set('facet:2', ('page', 1), make('other')) == 'other')
+
+    cache.invalidate('facet:1')
+
+    ok_(cache.get_or_set('facet:1', ('page', 1), make('new')) == 'new')
+    ok_(cache.get_or_set('facet:2', ('page', 1), make('x')) == 'other')
+    ok_(calls == ['one', 'two', 'other', 'new'])
+
+    # None is not cached
+    ok_(cache.get_or_set('log', (), lambda: None) is None)
+    ok_(cache.get_or_set('log', (), lambda: []) == [])
+
+
+def test_response_cache_from_config():
+
+    cache = ResponseCache.from_config({
+        'RESPONSE_CACHE_BACKEND': 'app.cache.NullBackend',
+        'RESPONSE_CACHE_TIMEOUT': 10
+    })
+    ok_(isinstance(cache.backend, NullBackend) and cache.timeout == 10)
+
+    calls = []
+    cache.get_or_set('log', (), lambda: calls.append(1) or 'a')
+    cache.get_or_set('log', (), lambda: calls.append(1) or 'a')
+    ok_(len(calls) == 2)
+
+    cache = ResponseCache.from_config(
+        {'RESPONSE_CACHE_OPTIONS': {'max_entries': 5}}
+    )
+    ok_(cache.backend.max_entries == 5)
@@ -0,0 +1,38 @@
+from nose.tools import ok_, raises
+
+from app.compression import (
+    codec_of, compress_text, decompress_text, is_compressed
+)
+
+
+SRT = '''1
+00:00:01,000 --> 00:00:04,000
+>> THEY ARE GOING TO HIT HIM HARD.
+
+2
+00:00:04,000 --> 00:00:07,500
+>> A KNOCKOUT PUNCH — OR NOT?
+'''
+
+
+def test_zlib_round_trip():
+
+    compressed = compress_text(SRT * 50, 'zlib')
+
+    ok_(is_compressed(compressed))
+    ok_(codec_of(compressed) == 'zlib')
+    ok_(len(compressed) < len((SRT * 50).encode('utf-8')))
+    ok_(decompress_text(compressed) == SRT * 50)
+
+
+def test_plain_text_is_not_compressed():
+
+    ok_(not is_compressed(SRT))
+    ok_(not is_compressed(SRT.encode('utf-8')))
+    ok_(codec_of(SRT) is None)
+
+
+@raises(ValueError)
+def test_unknown_codec():
+
+    compress_text(SRT, 'lzma')
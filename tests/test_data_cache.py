@@ -0,0 +1,133 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from nose.tools import ok_
+
+from projects.common.data_cache import DataFrameCache
+
+
+CSV = b'''start_localtime,network,facet_word
+2016-09-01 06:00:00,FOXNEWSW,hit
+2016-09-02 20:00:00,MSNBCW,attack
+'''
+
+
+class _CsvHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the class attribute `content` with a strong ETag and answers
+    matching If-None-Match requests with 304. Counts full downloads.
+    '''
+    content = CSV
+    downloads = 0
+    revalidations = 0
+
+    def do_GET(self):
+        cls = type(self)
+        etag = '"' + hashlib.md5(cls.content).hexdigest() + '"'
+
+        if self.headers.get('If-None-Match') == etag:
+            cls.revalidations += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        cls.downloads += 1
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(cls.content)))
+        self.end_headers()
+        self.wfile.write(cls.content)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve():
+
+    handler = type('Handler', (_CsvHandler,), {})
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = 'http://127.0.0.1:{}/snapshot.csv'.format(server.server_port)
+
+    return server, handler, url
+
+
+def test_url_cache():
+
+    server, handler, url = _serve()
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        cache = DataFrameCache(cache_dir, ttl=60)
+
+        df = cache.read_csv(url, parse_dates=['start_localtime'])
+        ok_(handler.downloads == 1)
+        ok_(df.start_localtime[0] == datetime(2016, 9, 1, 6))
+
+        # Fresh entry: served from disk without contacting the server.
+        cached = DataFrameCache(cache_dir, ttl=60).read_csv(
+            url, parse_dates=['start_localtime']
+        )
+        pd.testing.assert_frame_equal(df, cached)
+        ok_(handler.downloads == 1 and handler.revalidations == 0)
+
+        # Expired entry: revalidated with the ETag, content not resent.
+        stale = DataFrameCache(cache_dir, ttl=0)
+        pd.testing.assert_frame_equal(
+            df, stale.read_csv(url, parse_dates=['start_localtime'])
+        )
+        ok_(handler.downloads == 1 and handler.revalidations == 1)
+
+        # Changed content is downloaded and parsed again.
+        handler.content = CSV + b'2016-09-03 20:00:00,CNNW,beat\n'
+        ok_(len(stale.read_csv(url, parse_dates=['start_localtime'])) == 3)
+        ok_(handler.downloads == 2)
+
+    finally:
+        server.shutdown()
+        shutil.rmtree(cache_dir)
+
+
+def test_path_cache_and_eviction():
+
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        csv_path = os.path.join(cache_dir, 'snapshot.csv')
+        with open(csv_path, 'wb') as f:
+            f.write(CSV)
+
+        cache = DataFrameCache(os.path.join(cache_dir, 'cache'))
+
+        df = cache.read_csv(csv_path)
+        pd.testing.assert_frame_equal(df, cache.read_csv(csv_path))
+        ok_(len(os.listdir(cache.objects_dir)) == 1)
+
+        # Different parsing options are cached separately.
+        cache.read_csv(csv_path, parse_dates=['start_localtime'])
+        ok_(len(os.listdir(cache.objects_dir)) == 2)
+
+        # Unused frames are evicted by age, then by total size.
+        cache.evict(max_age=3600)
+        ok_(len(os.listdir(cache.objects_dir)) == 2)
+
+        time.sleep(0.01)
+        cache.read_csv(csv_path)
+        cache.max_bytes = 1
+        cache.evict()
+        ok_(len(os.listdir(cache.objects_dir)) == 0)
+
+        # Evicted frames are parsed again from the file.
+        pd.testing.assert_frame_equal(df, cache.read_csv(csv_path))
+
+    finally:
+        shutil.rmtree(cache_dir)
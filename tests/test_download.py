@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from nose.tools import ok_, raises
+from requests import HTTPError
+
+from app.download import download_file, download_files
+
+
+class _SegmentHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the path repeated as the body. Paths containing "flaky" fail
+    with 503 the first time, and paths containing "missing" are 404s.
+    '''
+    requests = []
+
+    def do_GET(self):
+
+        self.requests.append(self.path)
+
+        if 'missing' in self.path or \
+                ('flaky' in self.path and self.requests.count(self.path) == 1):
+            self.send_response(404 if 'missing' in self.path else 503)
+            self.end_headers()
+            return
+
+        body = self.path.encode('utf-8') * 10000
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve():
+
+    _SegmentHandler.requests = []
+
+    server = HTTPServer(('127.0.0.1', 0), _SegmentHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def test_download_files():
+
+    server, url = _serve()
+    download_dir = tempfile.mkdtemp()
+
+    try:
+        jobs = [
+            (url + '/segment-{}'.format(i),
+             os.path.join(download_dir, '{}.mp4'.format(i)))
+            for i in range(10)
+        ] + [(url + '/flaky', os.path.join(download_dir, 'flaky.mp4'))]
+
+        ok_(download_files(jobs, n_workers=4, backoff=0.01) == [True] * 11)
+
+        for job_url, path in jobs:
+            with open(path, 'rb') as f:
+                ok_(f.read() == job_url[len(url):].encode('utf-8') * 10000)
+
+        ok_(_SegmentHandler.requests.count('/flaky') == 2)
+        ok_(not any(name.endswith('.part')
+                    for name in os.listdir(download_dir)))
+
+        # resuming only fetches what is missing
+        os.remove(jobs[3][1])
+        n_requests = len(_SegmentHandler.requests)
+
+        ok_(download_files(jobs, n_workers=4) ==
+            [False] * 3 + [True] + [False] * 7)
+        ok_(len(_SegmentHandler.requests) == n_requests + 1)
+
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(download_dir)
+
+
+@raises(HTTPError)
+def test_download_client_error():
+
+    server, url = _serve()
+    download_dir = tempfile.mkdtemp()
+
+    try:
+        download_file(url + '/missing', os.path.join(download_dir, 'x.mp4'),
+                      backoff=0.01)
+    finally:
+        # not retried, and nothing left behind
+        ok_(_SegmentHandler.requests == ['/missing'])
+        ok_(os.listdir(download_dir) == [])
+
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(download_dir)
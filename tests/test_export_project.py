@@ -0,0 +1,394 @@
+import os
+import pandas as pd
+import tempfile
+import time
+
+from bson import ObjectId
+from datetime import datetime
+from nose.tools import ok_, raises
+from unittest import SkipTest
+
+from app.models import (
+    Facet, IatvDocument, Instance, InstanceRecord, Project
+)
+from projects.common import (
+    daily_metaphor_counts, facet_word_count, get_project_data_frame
+)
+from projects.common.export_project import (
+    CATEGORICAL_COLUMNS, DATETIME_COLUMNS, IATV_DOCUMENT_COLUMNS,
+    INSTANCE_COLUMNS, ProjectExporter, _load_snapshot
+)
+
+
+# (network, program_name, start_localtime) of each fixture document
+SHOWS = [
+    ('MSNBCW', 'Dingbat Alley', datetime(2016, 9, 1, 20)),
+    ('MSNBCW', 'iCry Sad News Time', datetime(2016, 9, 2, 18)),
+    ('CNNW', 'Tracy Morgans news hour', datetime(2016, 9, 2, 21)),
+    ('FOXNEWSW', 'Digging Turnips', datetime(2016, 9, 3, 20)),
+]
+
+# (facet word, index of source document in SHOWS, include, subjects)
+INSTANCES = [
+    ('attack', 0, True, 'trump'),
+    ('attack', 1, False, 'clinton'),
+    ('attack', 1, True, 'clinton'),
+    ('attack', 3, True, 'media'),
+    ('hit', 2, True, 'trump'),
+    ('hit', 0, True, 'obama'),
+    ('hit', 3, False, 'trump'),
+    ('hit', 3, True, 'clinton'),
+]
+
+
+def _setup_project():
+    '''
+    Project with an 'attack' and a 'hit' facet over the SHOWS documents;
+    some instances aren't included and some documents are used more than
+    once.
+    '''
+    name = 'Test export {}'.format(ObjectId())
+
+    docs = []
+    for idx, (network, program_name, start_localtime) in enumerate(SHOWS):
+        iatv_id = '{}-{}'.format(name.replace(' ', '-'), idx)
+        docs.append(IatvDocument(
+            document_data='this is a show',
+            iatv_id=iatv_id,
+            iatv_url='http://www.iatv.yo/' + iatv_id,
+            network=network,
+            program_name=program_name,
+            start_localtime=start_localtime,
+            start_time=start_localtime,
+            stop_time=start_localtime,
+            runtime_seconds=3600.0
+        ).upsert())
+
+    facets = []
+    for word in ('attack', 'hit'):
+        instances = [
+            Instance(
+                text='they {} them'.format(word),
+                source_id=docs[doc_idx].pk,
+                include=include,
+                subjects=subjects,
+                conceptual_metaphor='politics is war',
+                repeat_index=1 if subjects == 'media' else None
+            )
+            for facet_word, doc_idx, include, subjects in INSTANCES
+            if facet_word == word
+        ]
+        facet = Facet(word=word, instances=instances,
+                      total_count=len(instances))
+        facet.save()
+        facets.append(facet)
+
+    project = Project(name=name, facets=facets)
+    project.save()
+
+    return project
+
+
+def _teardown_project(project):
+
+    for facet_id in project.facet_ids():
+        InstanceRecord.objects(facet=facet_id).delete()
+        Facet.objects(pk=facet_id).delete()
+
+    IatvDocument.objects(
+        iatv_id__startswith=project.name.replace(' ', '-')
+    ).delete()
+
+    project.delete()
+
+
+def _export_row_by_row(project_name):
+    '''
+    The project DataFrame as ProjectExporter built it before batching: one
+    IatvDocument query and one DataFrame.loc assignment per row.
+    '''
+    column_names = IATV_DOCUMENT_COLUMNS + ['facet_word'] + INSTANCE_COLUMNS
+
+    df = pd.DataFrame(columns=column_names)
+
+    project = Project.objects.get(name=project_name)
+    keyed_instances = (
+        (facet.word, instance)
+        for facet in project.facets
+        for instance in facet.instances
+        if instance.include
+    )
+
+    for idx, (facet_word, instance) in enumerate(keyed_instances):
+        iatv_doc = IatvDocument.objects.get(pk=instance.source_id)
+        df.loc[idx] = (
+            [iatv_doc[field] for field in IATV_DOCUMENT_COLUMNS] +
+            [facet_word] + [instance[field] for field in INSTANCE_COLUMNS]
+        )
+
+    return df
+
+
+def _rows(df):
+    '''
+    Rows of df as lists of plain values, with None for missing values, so
+    frames with different column dtypes can be compared.
+    '''
+    columns = [
+        [None if pd.isnull(value) else value
+         for value in df[name].astype(object)]
+        for name in df.columns
+    ]
+
+    return [list(row) for row in zip(*columns)]
+
+
+def test_export_dataframe_matches_row_by_row_export():
+
+    project = _setup_project()
+
+    try:
+        expected = _export_row_by_row(project.name)
+        ok_(len(expected) == 6)
+
+        # batches smaller than the project, so documents used in more than
+        # one batch are looked up again
+        for batch_size in (1, 2, 1000):
+            df = ProjectExporter(
+                project.name, batch_size=batch_size
+            ).export_dataframe()
+
+            ok_(list(df.columns) == list(expected.columns))
+            ok_(_rows(df) == _rows(expected))
+
+    finally:
+        _teardown_project(project)
+
+
+@raises(IatvDocument.DoesNotExist)
+def test_export_missing_source_document():
+
+    project = _setup_project()
+
+    try:
+        IatvDocument.objects(iatv_id=project.name.replace(' ', '-') + '-3')\
+            .delete()
+
+        # the row-by-row export failed on the missing document too
+        try:
+            _export_row_by_row(project.name)
+            ok_(False)
+        except IatvDocument.DoesNotExist:
+            pass
+
+        ProjectExporter(project.name, batch_size=2).export_dataframe()
+
+    finally:
+        _teardown_project(project)
+
+
+def test_export_dataframe_analysis_unchanged():
+    '''
+    The analysis functions should give the same results on the exported
+    DataFrame as on the same rows read back from a CSV export, the form
+    the analyses have always been run on.
+    '''
+    project = _setup_project()
+
+    tmp_dir = tempfile.mkdtemp()
+    csv_path = os.path.join(tmp_dir, 'export.csv')
+
+    try:
+        df = get_project_data_frame(project.name)
+
+        ok_(not any(
+            pd.api.types.is_categorical_dtype(df[name])
+            for name in CATEGORICAL_COLUMNS
+        ))
+
+        ProjectExporter(project.name).export_csv(csv_path)
+        from_csv = get_project_data_frame(csv_path, cache=False)
+
+        date_index = pd.date_range('2016-9-1', '2016-9-4', freq='D')
+        for by in (None, ['network'], ['network', 'facet_word']):
+            pd.testing.assert_frame_equal(
+                daily_metaphor_counts(df, date_index, by=by),
+                daily_metaphor_counts(from_csv, date_index, by=by)
+            )
+
+        for by_network in (True, False):
+            counts = facet_word_count(
+                df, ['attack', 'hit'], by_network=by_network
+            )
+            expected = facet_word_count(
+                from_csv, ['attack', 'hit'], by_network=by_network
+            )
+            if by_network:
+                pd.testing.assert_frame_equal(counts, expected)
+            else:
+                pd.testing.assert_series_equal(counts, expected)
+
+        # categorical exports have the same values
+        categorical = ProjectExporter(project.name).export_dataframe(
+            categorical=True
+        )
+        ok_(_rows(categorical) == _rows(df))
+
+    finally:
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+        os.rmdir(tmp_dir)
+        _teardown_project(project)
+
+
+def _check_chunked_export(export_format, read):
+    '''
+    Export the fixture project to export_format in chunks of two rows and
+    check that read(path) gives back what export_dataframe returns.
+    '''
+    project = _setup_project()
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'export.' + export_format)
+
+    try:
+        exporter = ProjectExporter(project.name, batch_size=2)
+        expected = exporter.export_dataframe()
+
+        progress = []
+        n_rows = exporter.export(path, progress=progress.append)
+
+        # six included instances in three chunks
+        ok_(n_rows == 6 and progress == [2, 4, 6])
+
+        exported = read(path, expected)
+        ok_(list(exported.columns) == list(expected.columns))
+        ok_(_rows(exported) == _rows(expected))
+
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(tmp_dir)
+        _teardown_project(project)
+
+
+def test_chunked_csv_export():
+
+    def read(path, expected):
+        # the same as writing the whole frame at once
+        with open(path) as f:
+            ok_(f.read() == expected.to_csv(index=False))
+        exported = pd.read_csv(
+            path, parse_dates=DATETIME_COLUMNS, keep_default_na=False
+        )
+        exported['repeat_index'] = pd.to_numeric(
+            exported.repeat_index, errors='coerce'
+        )
+        return exported
+
+    _check_chunked_export('csv', read)
+
+
+def test_chunked_parquet_export():
+
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise SkipTest('pyarrow is not installed')
+
+    _check_chunked_export(
+        'parquet',
+        lambda path, expected: pyarrow.parquet.read_table(path).to_pandas()
+    )
+
+
+def test_chunked_feather_export():
+
+    try:
+        import pyarrow
+    except ImportError:
+        raise SkipTest('pyarrow is not installed')
+
+    _check_chunked_export(
+        'feather',
+        lambda path, expected:
+            pyarrow.ipc.open_file(path).read_all().to_pandas()
+    )
+
+
+def test_export_incremental():
+
+    project = _setup_project()
+
+    tmp_dir = tempfile.mkdtemp()
+    snapshot_path = os.path.join(tmp_dir, 'snapshot.pkl')
+
+    try:
+        exporter = ProjectExporter(project.name, batch_size=2)
+
+        df = exporter.export_incremental(snapshot_path)
+        ok_(os.path.exists(snapshot_path))
+        ok_(_rows(df) == _rows(exporter.export_dataframe()))
+
+        # nothing changed
+        ok_(_rows(exporter.export_incremental(snapshot_path)) == _rows(df))
+
+        # MongoDB stores times to the millisecond
+        time.sleep(0.01)
+
+        attack, hit = [Facet.objects.get(pk=facet_id)
+                       for facet_id in project.facet_ids()]
+
+        # an edit...
+        Facet.set_instance_fields(attack.pk, 0, {'subjects': 'media'})
+
+        # ...an instance added by a script saving the facet...
+        hit.instances.append(Instance(
+            text='they hit them again', source_id=hit.instances[0].source_id,
+            include=True, subjects='trump'
+        ))
+        hit.save()
+
+        df = exporter.export_incremental(snapshot_path)
+        expected = exporter.export_dataframe()
+
+        ok_(len(df) == 7)
+        ok_(_rows(df) == _rows(expected))
+        ok_(df.subjects[0] == 'media')
+
+        time.sleep(0.01)
+
+        # a source document changed by a new ingest, with none of the facets
+        # that use it modified
+        doc = IatvDocument.objects.get(pk=attack.instances[3].source_id)
+        doc.program_name = 'Digging Turnips Tonight'
+        doc.save()
+
+        df = exporter.export_incremental(snapshot_path)
+        expected = exporter.export_dataframe()
+
+        ok_(_rows(df) == _rows(expected))
+        ok_((df.program_name == 'Digging Turnips Tonight').sum() == 2)
+
+        # a new exporter starts from the saved snapshot
+        df = ProjectExporter(project.name).export_incremental(snapshot_path)
+        ok_(_rows(df) == _rows(expected))
+
+        # an edit in the same millisecond as the snapshot, which MongoDB
+        # stores as no later than it
+        snapshot_time = _load_snapshot(snapshot_path)['snapshot_time']
+        Facet.set_instance_fields(attack.pk, 2, {'subjects': 'obama'})
+        Facet.objects(pk=attack.pk).update_one(
+            set__last_modified=snapshot_time
+        )
+
+        df = exporter.export_incremental(snapshot_path)
+        ok_(_rows(df) == _rows(exporter.export_dataframe()))
+        ok_(df.subjects[1] == 'obama')
+
+    finally:
+        for path in (snapshot_path, snapshot_path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(tmp_dir)
+        _teardown_project(project)
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+from nose.tools import ok_
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_error(module):
+    '''
+    Last line of the traceback from importing module first thing in a fresh
+    interpreter with no config, or None if it imported.
+    '''
+    env = dict(os.environ)
+    env.pop('CONFIG_FILE', None)
+
+    process = subprocess.run(
+        [sys.executable, '-c', 'import ' + module], cwd=ROOT, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+
+    if process.returncode == 0:
+        return None
+
+    return process.stderr.strip().split('\n')[-1]
+
+
+def test_app_modules_import_on_their_own():
+
+    # each of these has been the first app module imported by some script
+    # or test, so each must work without the others already loaded
+    for module in ('app.instance_window', 'app.models', 'app.app',
+                   'app.extensions'):
+
+        error = _import_error(module)
+        ok_(error is None, '{}: {}'.format(module, error))
@@ -0,0 +1,324 @@
+import json
+import os
+import shutil
+import tempfile
+
+from bson import ObjectId
+from datetime import datetime
+from nose.tools import ok_
+from pymongo.errors import BulkWriteError
+from unittest import mock
+
+from app.models import Facet, IatvDocument
+from insert_iatv_docs import (
+    DEFAULT_MANIFEST_NAME, DEFAULT_VIOLENCE_LIST, insert_iatv_docs,
+    make_project
+)
+
+
+TRANSCRIPTS = [
+    # hits at the start of the transcript and of a line, and two patterns
+    # overlapping on one line
+    'ATTACK ON THE CAPITOL\n'
+    'WE WILL HIT THEM AND STRIKE BACK\n'
+    'nothing to see here\n'
+    '\n'
+    'THE STRIKES HIT HARDER THAN A PUNCH',
+
+    # same program and date as the first, so it is skipped
+    'THEY ATTACK AGAIN\n',
+
+    # several hits on one line, and a hit on the last line with no
+    # trailing newline
+    'FIRE FIRING FIRE\n'
+    'no hits\n'
+    'BLOOD IN THE RING, BLOOD EVERYWHERE',
+
+    'no hits at all\nnone here either',
+
+    # a hit that is the whole transcript
+    'SLAP',
+]
+
+SHOWS = [
+    ('Dingbat Alley', datetime(2016, 9, 1, 20)),
+    ('Dingbat Alley', datetime(2016, 9, 1, 23)),
+    ('Dingbat Alley', datetime(2016, 9, 2, 20)),
+    ('iCry Sad News Time', datetime(2016, 9, 2, 18)),
+    ('Tracy Morgans news hour', datetime(2016, 9, 2, 21)),
+]
+
+WORD_REGEX_PAIRS = DEFAULT_VIOLENCE_LIST + [
+    # patterns overlapping other patterns
+    ('strikes', 'STRIKES'), ('hit them', 'HIT THEM'), ('hi', 'HI'),
+    # a pattern used for two words
+    ('firing again', 'FIRING'),
+]
+
+
+def _scan_per_pattern(documents, word_regex_pairs):
+    '''
+    Instances as make_project found them before the single-pass scan: each
+    pattern checked against every line of every document, skipping shows
+    with a program and date already seen.
+    '''
+    instances = {}
+
+    for word, pattern in word_regex_pairs:
+
+        processed_prog_dates = []
+        found = instances.setdefault(word, [])
+
+        for doc in documents:
+
+            prog_date = (doc.program_name, doc.start_localtime.date())
+
+            if prog_date not in processed_prog_dates:
+
+                processed_prog_dates.append(prog_date)
+                for line in doc.document_data.split('\n'):
+
+                    if pattern in line:
+                        found.append((line, doc.id, doc.iatv_url))
+
+    return instances
+
+
+def test_make_project_matches_per_pattern_scan():
+
+    documents = [
+        IatvDocument(
+            id=ObjectId(), document_data=text, program_name=program_name,
+            start_localtime=start_localtime,
+            iatv_url='http://www.iatv.yo/{}'.format(idx)
+        )
+        for idx, (text, (program_name, start_localtime))
+        in enumerate(zip(TRANSCRIPTS, SHOWS))
+    ]
+
+    expected = _scan_per_pattern(documents, WORD_REGEX_PAIRS)
+
+    project = make_project('Test make project', documents, WORD_REGEX_PAIRS)
+
+    try:
+        ok_([facet.word for facet in project.facets] ==
+            [word for word, _ in WORD_REGEX_PAIRS])
+
+        for facet in project.facets:
+            instances = [
+                (instance.text, instance.source_id, instance.reference_url)
+                for instance in facet.instances
+            ]
+            ok_(instances == expected[facet.word], facet.word)
+            ok_(facet.total_count == len(instances))
+
+        # the fixture exercises what it says it does
+        ok_(expected['strike'] == [
+            ('WE WILL HIT THEM AND STRIKE BACK', documents[0].id,
+             documents[0].iatv_url),
+            ('THE STRIKES HIT HARDER THAN A PUNCH', documents[0].id,
+             documents[0].iatv_url)
+        ])
+        ok_(expected['blood'][0][0] == 'BLOOD IN THE RING, BLOOD EVERYWHERE')
+        ok_(expected['slap'][0][0] == 'SLAP')
+        ok_(len(expected['firing again']) == 1)
+        ok_(not any(
+            line == 'THEY ATTACK AGAIN'
+            for line, _, _ in expected['attack']
+        ))
+
+    finally:
+        Facet.objects(pk__in=[facet.pk for facet in project.facets]).delete()
+
+
+def _write_show(folder, iatv_id, transcript=True):
+    '''
+    Write a show directory like those downloaded from the Internet Archive,
+    without its transcript file if transcript is False.
+    '''
+    show_dir = os.path.join(folder, iatv_id)
+    os.mkdir(show_dir)
+
+    metadata = {
+        'identifier': iatv_id,
+        'identifier-access': ['https://archive.org/details/' + iatv_id],
+        'start_localtime': ['2016-09-01 20:00:00'],
+        'start_time': ['2016-09-02 00:00:00'],
+        'stop_time': ['2016-09-02 01:00:00'],
+        'utc_offset': ['-0400'],
+        'title': 'Dingbat Alley : MSNBCW : September 1, 2016 8:00pm-9:00pm'
+    }
+    with open(os.path.join(show_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    if transcript:
+        with open(os.path.join(show_dir, 'transcript.txt'), 'w') as f:
+            f.write('THEY ATTACK AGAIN')
+
+    with open(os.path.join(show_dir, iatv_id + '.cc5.srt'), 'w') as f:
+        f.write('1\n00:00:01,000 --> 00:00:02,000\nTHEY ATTACK AGAIN\n')
+
+    return show_dir
+
+
+def _manifest(folder, manifest_path=None):
+    '''
+    Sorted manifest entries of folder, as paths in folder.
+    '''
+    if manifest_path is None:
+        manifest_path = os.path.join(folder, DEFAULT_MANIFEST_NAME)
+
+    with open(manifest_path) as f:
+        return sorted(os.path.join(folder, name) for name in f.read().split())
+
+
+def test_insert_iatv_docs_resume():
+
+    prefix = 'Test-ingest-{}'.format(ObjectId())
+    folder = tempfile.mkdtemp()
+
+    try:
+        dirs = [
+            _write_show(folder, '{}-{}'.format(prefix, idx),
+                        transcript=(idx != 2))
+            for idx in range(5)
+        ]
+
+        reports = []
+        report = insert_iatv_docs(
+            folder, n_workers=2, batch_size=2, progress=reports.append
+        )
+
+        # the directory missing its transcript fails in a worker, and the
+        # others are written in two batches
+        ok_(report.n_pending == 5 and report.n_resumed == 0)
+        ok_(report.n_inserted == 4 and report.n_existing == 0)
+        ok_(len(report.failures) == 1)
+        ok_(report.failures[0][0] == dirs[2])
+        ok_('FileNotFoundError' in report.failures[0][1])
+        ok_(reports == [report, report])
+
+        ok_(_manifest(folder) == dirs[:2] + dirs[3:])
+        ok_(IatvDocument.objects(iatv_id__startswith=prefix).count() == 4)
+
+        # fix the failed directory, and act as if the first run was
+        # interrupted after writing the last directory but before recording
+        # it in the manifest, which has full paths as manifests used to
+        with open(os.path.join(dirs[2], 'transcript.txt'), 'w') as f:
+            f.write('THEY ATTACK AGAIN')
+
+        with open(os.path.join(folder, DEFAULT_MANIFEST_NAME), 'w') as f:
+            f.write(''.join(_dir + '\n' for _dir in dirs[:2] + dirs[3:4]))
+
+        report = insert_iatv_docs(folder, n_workers=2, batch_size=2)
+
+        ok_(report.n_pending == 2 and report.n_resumed == 3)
+        ok_(report.n_inserted == 1 and report.n_existing == 1)
+        ok_(report.failures == [])
+
+        ok_(_manifest(folder) == dirs)
+        ok_(IatvDocument.objects(iatv_id__startswith=prefix).count() == 5)
+
+        # nothing left to do
+        report = insert_iatv_docs(folder, n_workers=2)
+
+        ok_(report.n_pending == 0 and report.n_resumed == 5)
+        ok_(report.n_processed == 0)
+
+    finally:
+        IatvDocument.objects(iatv_id__startswith=prefix).delete()
+        shutil.rmtree(folder)
+
+
+def test_insert_iatv_docs_write_errors():
+
+    prefix = 'Test-ingest-{}'.format(ObjectId())
+    folder = tempfile.mkdtemp()
+
+    upsert_many = IatvDocument.upsert_many
+    rejected = []
+
+    def upsert_all_but_second(documents, ordered=False):
+        '''
+        Write all but the second document, then raise the BulkWriteError an
+        unordered bulk write gives when one of its writes fails.
+        '''
+        rejected.append(documents[1].iatv_id)
+        result = upsert_many(documents[:1] + documents[2:], ordered=ordered)
+
+        raise BulkWriteError({
+            'writeErrors': [{
+                'index': 1, 'code': 11000, 'errmsg': 'E11000 duplicate key'
+            }],
+            'nUpserted': result.upserted_count,
+            'nMatched': result.matched_count
+        })
+
+    try:
+        dirs = [
+            _write_show(folder, '{}-{}'.format(prefix, idx))
+            for idx in range(3)
+        ]
+
+        with mock.patch.object(IatvDocument, 'upsert_many',
+                               upsert_all_but_second):
+            report = insert_iatv_docs(folder, n_workers=2)
+
+        failed_dir = os.path.join(folder, rejected[0])
+
+        ok_(report.n_inserted == 2 and report.n_existing == 0)
+        ok_(report.failures == [(failed_dir, 'E11000 duplicate key')])
+
+        ok_(_manifest(folder) == sorted(set(dirs) - set([failed_dir])))
+        ok_(IatvDocument.objects(iatv_id__startswith=prefix).count() == 2)
+
+        # the rejected directory is retried on the next run
+        report = insert_iatv_docs(folder, n_workers=2)
+
+        ok_(report.n_pending == 1 and report.n_resumed == 2)
+        ok_(report.n_inserted == 1 and report.failures == [])
+        ok_(_manifest(folder) == dirs)
+
+    finally:
+        IatvDocument.objects(iatv_id__startswith=prefix).delete()
+        shutil.rmtree(folder)
+
+
+def test_insert_iatv_docs_manifest_paths():
+
+    prefix = 'Test-ingest-{}'.format(ObjectId())
+    tmp_dir = tempfile.mkdtemp()
+    folder = os.path.join(tmp_dir, 'shows')
+    os.mkdir(folder)
+
+    # outside the ingested folder
+    manifest_path = os.path.join(tmp_dir, 'manifest')
+
+    try:
+        dirs = [
+            _write_show(folder, '{}-{}'.format(prefix, idx))
+            for idx in range(3)
+        ]
+
+        report = insert_iatv_docs(
+            folder + os.sep, n_workers=2, manifest_path=manifest_path
+        )
+        ok_(report.n_inserted == 3)
+        ok_(_manifest(folder, manifest_path) == dirs)
+        ok_(not os.path.exists(os.path.join(folder, DEFAULT_MANIFEST_NAME)))
+
+        # the same folder spelled differently, or moved
+        moved = os.path.join(tmp_dir, 'moved')
+        shutil.move(folder, moved)
+
+        for spelling in (moved, os.path.relpath(moved),
+                         os.path.join(moved, '.', '')):
+
+            report = insert_iatv_docs(
+                spelling, n_workers=2, manifest_path=manifest_path
+            )
+            ok_(report.n_pending == 0 and report.n_resumed == 3, spelling)
+
+    finally:
+        IatvDocument.objects(iatv_id__startswith=prefix).delete()
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,155 @@
+from bson import ObjectId
+from datetime import datetime
+from nose.tools import ok_
+from unittest import mock
+
+from app import instance_window
+from app.instance_window import InstanceWindowCache
+from app.models import (
+    COLLECTION_STORAGE, EMBEDDED_STORAGE, Facet, Instance, InstanceRecord
+)
+
+
+def _setup_facet(storage, n_instances=20):
+
+    facet = Facet(
+        word='attack',
+        instances=[
+            Instance(text='ATTACK {}'.format(idx), source_id=ObjectId())
+            for idx in range(n_instances)
+        ],
+        total_count=n_instances
+    )
+    facet.save()
+    facet.move_instances(storage)
+
+    return facet.pk
+
+
+def _teardown_facet(facet_id):
+
+    InstanceRecord.objects(facet=facet_id).delete()
+    Facet.objects(pk=facet_id).delete()
+
+
+def _append_instance(facet_id):
+
+    instance = Instance(text='ATTACK again', source_id=ObjectId())
+    facet = _load(facet_id)
+
+    if facet.instance_storage == COLLECTION_STORAGE:
+        InstanceRecord(
+            facet=facet_id, index=facet.count_instances(), instance=instance
+        ).save()
+        Facet.objects(pk=facet_id).update_one(
+            set__last_modified=datetime.now()
+        )
+    else:
+        Facet.objects(pk=facet_id).update_one(
+            push__instances=instance, set__last_modified=datetime.now()
+        )
+
+
+def _load(facet_id):
+    '''
+    The facet as edit_instance loads it on every request.
+    '''
+    return Facet.objects.exclude('instances').get(pk=facet_id)
+
+
+def _save(cache, session_key, facet_id, idx, fields):
+    '''
+    Save fields to instance idx as the session, as edit_instance does.
+    '''
+    updated = Facet.set_instance_fields(facet_id, idx, fields)
+    cache.record_edit(session_key, facet_id, idx, fields, updated['version'])
+
+
+def _check_window_reuse(storage):
+
+    facet_id = _setup_facet(storage)
+    cache = InstanceWindowCache(window_size=10)
+
+    try:
+        with mock.patch.object(instance_window, 'InstanceWindow',
+                               wraps=instance_window.InstanceWindow) as built:
+
+            # browsing
+            for idx in range(5):
+                instance, _, total = cache.get('coder', _load(facet_id), idx)
+                ok_(instance.text == 'ATTACK {}'.format(idx) and total == 20)
+            ok_(built.call_count == 1)
+
+            # save and next
+            for idx in range(6, 10):
+                cache.get('coder', _load(facet_id), idx)
+                _save(cache, 'coder', facet_id, idx, {'subjects': 'media'})
+
+            ok_(built.call_count == 1)
+
+            instance, _, _ = cache.get('coder', _load(facet_id), 8)
+            ok_(instance.subjects == 'media' and instance.version == 1)
+            ok_(built.call_count == 1)
+
+            # another coder's edit outside the window doesn't matter...
+            _save(cache, 'other', facet_id, 15, {'subjects': 'trump'})
+            cache.get('coder', _load(facet_id), 9)
+            ok_(built.call_count == 1)
+
+            # ...but one inside it does
+            _save(cache, 'other', facet_id, 3, {'subjects': 'clinton'})
+            instance, _, _ = cache.get('coder', _load(facet_id), 3)
+            ok_(instance.subjects == 'clinton')
+            ok_(built.call_count == 2)
+
+            # as does an edit made between loading a page and saving it
+            cache.get('coder', _load(facet_id), 4)
+            Facet.set_instance_fields(facet_id, 4, {'tense': 'past'})
+            _save(cache, 'coder', facet_id, 4, {'subjects': 'media'})
+
+            instance, _, _ = cache.get('coder', _load(facet_id), 4)
+            ok_(instance.tense == 'past' and instance.subjects == 'media')
+            ok_(built.call_count == 3)
+
+            # and an added instance
+            _append_instance(facet_id)
+            _, _, total = cache.get('coder', _load(facet_id), 5)
+            ok_(total == 21 and built.call_count == 4)
+
+    finally:
+        _teardown_facet(facet_id)
+
+
+def test_window_reuse_embedded():
+    _check_window_reuse(EMBEDDED_STORAGE)
+
+
+def test_window_reuse_collection():
+    _check_window_reuse(COLLECTION_STORAGE)
+
+
+def test_window_reuse_facet_without_last_modified():
+    '''
+    Facets stored before Facet.last_modified existed load the same every
+    time, so their windows are used
+    '''
+    facet_id = _setup_facet(EMBEDDED_STORAGE)
+    Facet._get_collection().update_one(
+        {'_id': facet_id}, {'$unset': {'last_modified': ''}}
+    )
+
+    cache = InstanceWindowCache(window_size=10)
+
+    try:
+        ok_(_load(facet_id).last_modified is None)
+        ok_(_load(facet_id).last_modified == _load(facet_id).last_modified)
+
+        with mock.patch.object(instance_window, 'InstanceWindow',
+                               wraps=instance_window.InstanceWindow) as built:
+            cache.get('coder', _load(facet_id), 0)
+            cache.get('coder', _load(facet_id), 1)
+
+            ok_(built.call_count == 1)
+
+    finally:
+        _teardown_facet(facet_id)
@@ -0,0 +1,308 @@
+import time
+
+from bson import ObjectId
+from datetime import timedelta
+from nose.tools import ok_, raises
+
+from app.instance_window import InstanceWindowCache
+from app.models import (
+    ConceptualMetaphor, Facet, IatvDocument, Instance, InstanceRecord,
+    InstanceVersionConflict, TranscriptIndex
+)
+
+
+def _make_facet(n_instances=5):
+
+    source_id = ObjectId()
+
+    facet = Facet(
+        word='test-hit',
+        instances=[
+            Instance(text='HIT number {}'.format(idx), source_id=source_id)
+            for idx in range(n_instances)
+        ]
+    )
+    facet.save()
+
+    return facet
+
+
+def _check_instances(facet):
+
+    ok_(facet.count_instances() == 5)
+    ok_([i.text for i in facet.get_instances(1, 3)] ==
+        ['HIT number 1', 'HIT number 2'])
+    ok_(facet.get_instance(4).text == 'HIT number 4')
+
+    # single-instance edits are written without touching the others
+    instance = facet.get_instance(2)
+    instance.figurative = not instance.figurative
+    facet.update_instance(2, instance)
+
+    reloaded = Facet.objects.exclude('instances').get(pk=facet.pk)
+    ok_(reloaded.get_instance(2).figurative == instance.figurative)
+    ok_(reloaded.get_instance(2).last_modified is not None)
+    ok_(reloaded.get_instance(1).last_modified is None)
+    # MongoDB stores datetimes to the millisecond
+    ok_(abs(reloaded.last_modified - instance.last_modified) <
+        timedelta(milliseconds=1))
+
+
+def test_instance_storage_modes():
+
+    facet = _make_facet()
+
+    try:
+        _check_instances(facet)
+
+        facet.move_instances('collection')
+
+        ok_(InstanceRecord.objects(facet=facet.pk).count() == 5)
+        raw = Facet._get_collection().find_one({'_id': facet.pk})
+        ok_('instances' not in raw)
+        _check_instances(Facet.objects.get(pk=facet.pk))
+
+        facet.move_instances('embedded')
+
+        ok_(InstanceRecord.objects(facet=facet.pk).count() == 0)
+        facet = Facet.objects.get(pk=facet.pk)
+        ok_(len(facet.instances) == 5)
+        _check_instances(facet)
+
+    finally:
+        InstanceRecord.objects(facet=facet.pk).delete()
+        facet.delete()
+
+
+@raises(IndexError)
+def test_missing_instance():
+
+    facet = _make_facet(2)
+
+    try:
+        facet.get_instance(2)
+    finally:
+        facet.delete()
+
+
+def test_set_instance_fields():
+
+    facet = _make_facet(3)
+
+    try:
+        for storage in ('embedded', 'collection'):
+
+            facet.move_instances(storage)
+
+            updated = Facet.set_instance_fields(
+                facet.pk, 1, {'figurative': True, 'spoken_by': 'Anchor'}
+            )
+            ok_(updated['figurative'] and updated['spoken_by'] == 'Anchor')
+            version = updated['version']
+
+            # a second coder saving against the version they read succeeds
+            updated = Facet.set_instance_fields(
+                facet.pk, 1, {'tense': 'past'}, expected_version=version
+            )
+            ok_(updated['version'] == version + 1)
+
+            # the first coder's stale version is rejected
+            try:
+                Facet.set_instance_fields(
+                    facet.pk, 1, {'tense': 'present'},
+                    expected_version=version
+                )
+                ok_(False)
+            except InstanceVersionConflict as e:
+                ok_(e.current.tense == 'past')
+
+            instance = facet.get_instance(1)
+            ok_(instance.figurative and instance.tense == 'past')
+            ok_(not facet.get_instance(0).figurative)
+
+    finally:
+        InstanceRecord.objects(facet=facet.pk).delete()
+        facet.delete()
+
+
+def _cm_prefix():
+    '''
+    Prefix making the conceptual metaphors a test records its own, so it
+    never touches the rest of the vocabulary.
+    '''
+    return 'test {} '.format(ObjectId())
+
+
+def test_conceptual_metaphor_vocabulary():
+
+    prefix = _cm_prefix()
+
+    try:
+        ConceptualMetaphor.record_change(None, prefix + 'Politics is war')
+        ConceptualMetaphor.record_change('', prefix + 'politics is war')
+        ConceptualMetaphor.record_change(None, prefix + 'politics is sport')
+        ok_(ConceptualMetaphor.vocabulary(prefix) ==
+            [prefix + 'politics is war', prefix + 'politics is sport'])
+
+        etag = ConceptualMetaphor.etag(prefix)
+        ok_(etag == ConceptualMetaphor.etag(prefix))
+        ok_(etag != ConceptualMetaphor.etag(prefix + 'politics is s'))
+
+        # recoding both war uses drops war from the vocabulary
+        for _ in range(2):
+            ConceptualMetaphor.record_change(
+                prefix + 'politics is war', prefix + 'argument is war'
+            )
+        ok_(ConceptualMetaphor.vocabulary(prefix.upper() + 'POLITICS') ==
+            [prefix + 'politics is sport'])
+        ok_(ConceptualMetaphor.vocabulary(prefix)[0] ==
+            prefix + 'argument is war')
+        ok_(etag != ConceptualMetaphor.etag(prefix))
+
+    finally:
+        ConceptualMetaphor.objects(name__startswith=prefix).delete()
+
+
+def test_instance_window_cache():
+
+    facet = _make_facet()
+    cache = InstanceWindowCache(window_size=3)
+
+    try:
+        facet = Facet.objects.exclude('instances').get(pk=facet.pk)
+
+        instance, document, total = cache.get('coder', facet, 0)
+        ok_(instance.text == 'HIT number 0' and total == 5)
+        # no IatvDocument was made for the test instances
+        ok_(document is None)
+
+        window = cache._windows[('coder', facet.pk)]
+
+        # the next instances come from the same window...
+        ok_(cache.get('coder', facet, 2)[0].text == 'HIT number 2')
+        ok_(cache._windows[('coder', facet.pk)] is window)
+
+        # ...until past its end
+        ok_(cache.get('coder', facet, 3)[0].text == 'HIT number 3')
+        ok_(cache._windows[('coder', facet.pk)] is not window)
+
+        # other sessions have their own windows
+        cache.get('other coder', facet, 0)
+        ok_(len(cache._windows) == 2)
+
+        # writes from this process drop the facet's windows
+        Facet.set_instance_fields(facet.pk, 4, {'figurative': True})
+        cache.invalidate(facet.pk)
+        ok_(len(cache._windows) == 0)
+
+        facet = Facet.objects.exclude('instances').get(pk=facet.pk)
+        ok_(cache.get('coder', facet, 4)[0].figurative)
+
+        # writes from elsewhere are caught by the facet's last_modified
+        # (stored to the millisecond)
+        time.sleep(0.01)
+        Facet.set_instance_fields(facet.pk, 4, {'figurative': False})
+        facet = Facet.objects.exclude('instances').get(pk=facet.pk)
+        ok_(not cache.get('coder', facet, 4)[0].figurative)
+
+    finally:
+        InstanceRecord.objects(facet=facet.pk).delete()
+        facet.delete()
+
+
+@raises(IndexError)
+def test_instance_window_past_end():
+
+    facet = _make_facet(2)
+
+    try:
+        InstanceWindowCache().get('coder', facet, 2)
+    finally:
+        facet.delete()
+
+
+def test_transcript_context():
+
+    doc = IatvDocument(
+        document_data='\n'.join('Line {}'.format(i) for i in range(20)),
+        raw_srt='1\n00:00:05,000 --> 00:00:07,000\nLINE 10\n',
+        iatv_id='test-transcript-context',
+        iatv_url='https://archive.org/details/test-transcript-context'
+    ).upsert()
+
+    try:
+        # The first request builds the index from the whole transcript; the
+        # next, with the index stored, only reads the lines it returns.
+        for _ in range(2):
+
+            doc = IatvDocument.objects.get(pk=doc.pk)
+            context = doc.transcript_context('line 10', n_lines=2)
+
+            ok_(context['line'] == 10)
+            ok_([line['text'] for line in context['lines']] ==
+                ['Line 8', 'Line 9', 'Line 10', 'Line 11', 'Line 12'])
+            ok_([line['time'] for line in context['lines']] ==
+                [None, None, 5.0, 5.0, 5.0])
+
+            ok_(TranscriptIndex.objects(iatv_id=doc.iatv_id).count() == 1)
+
+        # clipped at the ends, and text spanning lines is found too
+        context = doc.transcript_context('Line 0\nLine 1', n_lines=2)
+        ok_([line['line'] for line in context['lines']] == [0, 1, 2])
+
+        ok_(doc.transcript_context('not said')['lines'] == [])
+
+        # upserting the document again drops the stale index
+        doc.upsert()
+        ok_(TranscriptIndex.objects(iatv_id=doc.iatv_id).count() == 0)
+
+    finally:
+        TranscriptIndex.objects(iatv_id=doc.iatv_id).delete()
+        doc.delete()
+
+
+def test_set_many_instance_fields():
+
+    embedded = _make_facet(3)
+    records = _make_facet(3)
+    records.move_instances('collection')
+
+    prefix = _cm_prefix()
+
+    try:
+        results = Facet.set_many_instance_fields([
+            {'facet': embedded.pk, 'index': 0,
+             'fields': {'include': False}},
+            {'facet': records.pk, 'index': 2,
+             'fields': {'conceptual_metaphor': prefix + 'politics is war'}},
+            # builds on the change before it
+            {'facet': str(records.pk), 'index': 2, 'version': 1,
+             'fields': {'spoken_by': 'Anchor'}},
+            {'facet': embedded.pk, 'index': 1, 'version': 3,
+             'fields': {'figurative': True}},
+            {'facet': embedded.pk, 'index': 3, 'fields': {'rerun': True}},
+            {'facet': embedded.pk, 'index': 2, 'fields': {'color': 'red'}},
+            {'facet': 'not an id', 'index': 2, 'fields': {}},
+            {'index': 2, 'fields': {}},
+        ])
+
+        ok_([result['ok'] for result in results] ==
+            [True, True, True, False, False, False, False, False])
+        ok_(results[2]['version'] == 2)
+        ok_(results[3]['conflict'] and results[3]['version'] == 0)
+
+        ok_(not embedded.get_instance(0).include)
+        ok_(not embedded.get_instance(1).figurative)
+
+        instance = records.get_instance(2)
+        ok_(instance.conceptual_metaphor == prefix + 'politics is war' and
+            instance.spoken_by == 'Anchor' and instance.version == 2)
+
+        ok_(ConceptualMetaphor.vocabulary(prefix) ==
+            [prefix + 'politics is war'])
+
+    finally:
+        ConceptualMetaphor.objects(name__startswith=prefix).delete()
+        InstanceRecord.objects(facet=records.pk).delete()
+        embedded.delete()
+        records.delete()
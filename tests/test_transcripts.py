@@ -0,0 +1,72 @@
+from nose.tools import ok_
+
+from app.transcripts import (
+    line_hash, line_offsets, line_times, normalize, parse_srt
+)
+
+
+RAW_SRT = '''1
+00:00:01,000 --> 00:00:03,500
+GOOD EVENING.
+
+2
+00:00:03,500 --> 00:00:06,000
+THE CANDIDATES ARE READY
+TO HIT EACH OTHER.
+
+3
+00:01:10,250 --> 00:01:12,000
+WE'LL BE RIGHT BACK.
+'''
+
+TRANSCRIPT = '''Good evening.
+The candidates are ready to hit each other.
+>> Applause.
+We'll be right back.
+'''
+
+
+def test_parse_srt():
+
+    cues = parse_srt(RAW_SRT)
+
+    ok_(len(cues) == 3)
+    ok_(cues[0] == (1.0, 3.5, 'GOOD EVENING.'))
+    ok_(cues[1][2] == 'THE CANDIDATES ARE READY TO HIT EACH OTHER.')
+    ok_(cues[2][:2] == (70.25, 72.0))
+
+    ok_(parse_srt(RAW_SRT.replace('\n', '\r\n')) == cues)
+
+
+def test_line_offsets():
+
+    offsets = line_offsets(TRANSCRIPT)
+    lines = [TRANSCRIPT[a:b] for a, b in zip(offsets, offsets[1:])]
+
+    ok_(len(lines) == 4)
+    ok_(''.join(lines) == TRANSCRIPT)
+    ok_(lines[1] == 'The candidates are ready to hit each other.\n')
+
+    ok_(line_offsets('no newline') == [0, 10])
+
+
+def test_line_times():
+
+    offsets = line_offsets(TRANSCRIPT)
+    lines = [TRANSCRIPT[a:b] for a, b in zip(offsets, offsets[1:])]
+
+    # unmatched lines take the time of the line before
+    ok_(line_times(lines, parse_srt(RAW_SRT)) == [1.0, 3.5, 3.5, 70.25])
+    ok_(line_times(lines, []) == [None] * 4)
+
+    # lines only match cues word for word
+    ok_(line_times(['Line 1', 'Line 10'], [(5.0, 7.0, 'LINE 10')]) ==
+        [None, 5.0])
+
+
+def test_line_hash():
+
+    ok_(normalize('  We\'ll  be right\nback. ') == 'WE\'LL BE RIGHT BACK.')
+    ok_(line_hash('We\'ll be right back.\n') ==
+        line_hash('WE\'LL BE  RIGHT BACK.'))
+    ok_(line_hash('Good evening.') != line_hash('Good morning.'))
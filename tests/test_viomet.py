@@ -1,16 +1,25 @@
 import pandas as pd
 import numpy as np
 
+from collections import OrderedDict
 from datetime import datetime, date
 from nose.tools import ok_
+from scipy import stats
+from unittest import mock
 
-from app.models import IatvCorpus, IatvDocument
+from app.compression import compress_text, is_compressed
+from app.models import IatvCorpus, IatvDocument, TranscriptIndex
 from projects.common.analysis import (
     _count_by_start_localtime, daily_metaphor_counts, shows_per_date,
     daily_frequency, SubjectObjectData
 )
 from projects.common import facet_word_count
-from projects.viomet.analysis import PartitionInfo, partition_sums
+from projects.common.corpus_stats import (
+    daily_counts, distinct_shows, runtime_totals
+)
+from projects.viomet.analysis import (
+    PartitionInfo, partition_sums, partition_AICs, _sharded_partition_AICs
+)
 
 
 def _gen_test_input(pn, n, fw, so):
@@ -351,7 +360,9 @@ def _setup_iatv_corpus(iatv_corpus_name):
         )
     ]
 
-    for doc in docs:
+    # iatv_id is unique
+    for idx, doc in enumerate(docs):
+        doc.iatv_id = '{}-{}'.format(fake_id, idx)
         doc.save()
 
     return docs
@@ -413,13 +424,219 @@ def test_shows_per_day():
         },
         dtype=np.float64
     )
-    spd_by_network = shows_per_date(date_index, ic, by_network=True)
+    # networks are taken from the corpus, so put them in the expected order
+    spd_by_network = shows_per_date(
+        date_index, ic, by_network=True
+    )[['MSNBCW', 'CNNW', 'FOXNEWSW']]
 
     pd.testing.assert_frame_equal(expected_spd_by_network, spd_by_network)
 
     _teardown_mongo(test_corpus_name)
 
 
+def test_corpus_stats():
+    '''
+    Aggregation-backed counts should agree with shows_per_date
+    '''
+    test_corpus_name = _setup_mongo()
+
+    ic = IatvCorpus.objects(name=test_corpus_name)[0]
+    doc_ids = [doc.pk for doc in ic.documents]
+
+    date_index = pd.date_range('2016-9-1', '2016-9-4', freq='D')
+
+    counts = daily_counts(document_ids=doc_ids).pivot(
+        index='date', columns='network', values='counts'
+    ).reindex(date_index).fillna(0.0)
+    counts.columns.name = None
+
+    expected = shows_per_date(date_index, ic, by_network=True)
+    pd.testing.assert_frame_equal(
+        expected, counts[expected.columns].astype(np.float64)
+    )
+
+    ok_(len(distinct_shows(document_ids=doc_ids)) == expected.values.sum())
+
+    all_docs = daily_counts(by=(), distinct=False, document_ids=doc_ids)
+    ok_(all_docs.counts.sum() == len(doc_ids))
+
+    fox = runtime_totals(document_ids=doc_ids, networks=['FOXNEWSW'])
+    ok_(set(fox.network) == {'FOXNEWSW'})
+    ok_(len(fox) == (expected.FOXNEWSW > 0).sum())
+
+    _teardown_mongo(test_corpus_name)
+
+
+def test_iatv_document_upsert():
+    '''
+    Upserting the same iatv_id twice should update one document in place
+    '''
+    iatv_id = 'UPSERT_' + datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+    def _doc(document_data):
+        return IatvDocument(
+            document_data=document_data,
+            iatv_id=iatv_id,
+            iatv_url='http://www.iatv.yo/' + iatv_id,
+            network='CNNW',
+            program_name='Tracy Morgans news hour',
+            start_localtime=datetime(2016, 9, 1, 21)
+        )
+
+    first = _doc('first version').upsert()
+    second = _doc('second version').upsert()
+
+    ok_(first.pk == second.pk)
+    ok_(first.datetime_added == second.datetime_added)
+
+    result = IatvDocument.upsert_many([_doc('third version')])
+    ok_(result.upserted_count == 0 and result.matched_count == 1)
+
+    stored = IatvDocument.objects(iatv_id=iatv_id)
+    ok_(stored.count() == 1)
+    ok_(stored[0].document_data == 'third version')
+
+    stored.delete()
+
+
+def test_iatv_document_upsert_replaces():
+    '''
+    Upserting an ingested document again should replace everything but its
+    id and datetime_added, including a compressed transcript and its index,
+    unless overwrite is False
+    '''
+    iatv_id = 'UPSERT_' + datetime.now().strftime('%Y%m%d%H%M%S%f')
+    collection = IatvDocument._get_collection()
+
+    first = IatvDocument(
+        document_data='first version\nline 2',
+        raw_srt='1\n00:00:01,000 --> 00:00:02,000\nfirst version\n',
+        iatv_id=iatv_id,
+        iatv_url='http://www.iatv.yo/' + iatv_id,
+        network='CNNW',
+        utc_offset='-0400'
+    ).upsert()
+
+    # as stored with TRANSCRIPT_COMPRESSION set, and indexed
+    collection.update_one(
+        {'iatv_id': iatv_id},
+        {'$set': {'document_data':
+                  compress_text('first version\nline 2', 'zlib')}}
+    )
+    ok_(is_compressed(collection.find_one({'iatv_id': iatv_id})
+                      ['document_data']))
+    TranscriptIndex.for_document(
+        IatvDocument.with_transcripts.get(iatv_id=iatv_id)
+    )
+    ok_(TranscriptIndex.objects(iatv_id=iatv_id).count() == 1)
+
+    try:
+        second = IatvDocument(
+            document_data='second version',
+            iatv_id=iatv_id,
+            iatv_url='http://www.iatv.yo/' + iatv_id,
+            network='MSNBCW'
+        )
+        IatvDocument.upsert_many([second])
+
+        stored = collection.find_one({'iatv_id': iatv_id})
+        ok_(stored['_id'] == first.pk)
+        ok_(stored['datetime_added'] == first.datetime_added)
+        ok_(stored['document_data'] == 'second version')
+        ok_(stored['network'] == 'MSNBCW')
+        ok_('raw_srt' not in stored and 'utc_offset' not in stored)
+        ok_(TranscriptIndex.objects(iatv_id=iatv_id).count() == 0)
+
+        # e.g. a search result snippet for an ingested show
+        snippet = IatvDocument(
+            document_data='snippet',
+            iatv_id=iatv_id,
+            iatv_url='http://www.iatv.yo/' + iatv_id
+        ).upsert(overwrite=False)
+
+        ok_(snippet.pk == first.pk)
+        stored = collection.find_one({'iatv_id': iatv_id})
+        ok_(stored['document_data'] == 'second version')
+        ok_(stored['network'] == 'MSNBCW')
+
+    finally:
+        IatvDocument.objects(iatv_id=iatv_id).delete()
+        TranscriptIndex.objects(iatv_id=iatv_id).delete()
+
+    # nothing stored to keep, so it is inserted
+    inserted = IatvDocument(
+        document_data='snippet',
+        iatv_id=iatv_id,
+        iatv_url='http://www.iatv.yo/' + iatv_id
+    ).upsert(overwrite=False)
+
+    stored = IatvDocument.with_transcripts.get(iatv_id=iatv_id)
+    ok_(stored.pk == inserted.pk and stored.document_data == 'snippet')
+    ok_(stored.datetime_added is not None)
+
+    stored.delete()
+
+
+def test_iatv_document_deferred_transcripts():
+    '''
+    IatvDocument.objects should leave transcripts on the server until read
+    '''
+    test_corpus_name = _setup_mongo()
+
+    pk = IatvCorpus.objects(name=test_corpus_name)[0].documents[0].pk
+
+    doc = IatvDocument.objects.get(pk=pk)
+    ok_('document_data' not in doc.to_mongo())
+    ok_(doc.document_data == 'this is a show')
+
+    # saving a metadata-only document keeps its transcript
+    doc = IatvDocument.objects.get(pk=pk)
+    doc.utc_offset = '-400'
+    doc.save()
+
+    full = IatvDocument.with_transcripts.get(pk=pk).to_mongo()
+    ok_(full['document_data'] == 'this is a show')
+    ok_(full['utc_offset'] == '-400')
+
+    _teardown_mongo(test_corpus_name)
+
+
+def test_iatv_document_loaded_fields_not_deferred():
+    '''
+    Transcript fields a query loaded should be read without another query,
+    even if the stored document doesn't have them
+    '''
+    test_corpus_name = _setup_mongo()
+
+    pk = IatvCorpus.objects(name=test_corpus_name)[0].documents[0].pk
+    ok_('raw_srt' not in IatvDocument._get_collection().find_one({'_id': pk}))
+
+    # any further query fails
+    no_queries = mock.patch.object(
+        IatvDocument, '_get_collection', side_effect=AssertionError
+    )
+
+    for doc in (IatvDocument.with_transcripts.get(pk=pk),
+                IatvDocument.with_transcripts(pk=pk).first(),
+                list(IatvDocument.with_transcripts(pk=pk))[0],
+                IatvDocument.objects(pk=pk).exclude('raw_srt')
+                .only('document_data')[0]):
+        with no_queries:
+            ok_(doc.raw_srt is None)
+            ok_(doc.document_data == 'this is a show')
+
+    # fields left out are still fetched when read
+    doc = IatvDocument.with_transcripts(pk=pk).exclude('document_data').get()
+    with no_queries:
+        ok_(doc.raw_srt is None)
+    ok_(doc.document_data == 'this is a show')
+
+    doc = IatvDocument.with_transcripts(pk=pk).only('iatv_id').first()
+    ok_(doc.document_data == 'this is a show')
+
+    _teardown_mongo(test_corpus_name)
+
+
 def test_daily_frequency():
 
     test_corpus_name = _setup_mongo()
@@ -620,3 +837,95 @@ def test_facet_word_counts():
     pd.testing.assert_series_equal(
         expected_facet_word_counts_total, facet_word_count_total
     )
+
+
+def test_partition_AICs_numpy():
+    '''
+    Closed-form step model fits should match an explicit least-squares fit
+    of freq ~ state with excited as the reference level
+    '''
+    date_range = pd.date_range('2016-9-1', '2016-10-15', freq='D')
+    freq = np.where(
+        (date_range >= datetime(2016, 9, 20)) &
+        (date_range <= datetime(2016, 10, 5)),
+        2.0, 1.0
+    ) + np.linspace(0, 0.5, len(date_range)) ** 2
+
+    df = pd.DataFrame({'date': date_range, 'freq': freq})
+
+    pairs = [
+        (datetime(2016, 9, 20), datetime(2016, 10, 5)),
+        (datetime(2016, 9, 10), datetime(2016, 9, 30)),
+        # Too few excited-state dates, should be skipped.
+        (datetime(2016, 9, 10), datetime(2016, 9, 12)),
+        # No ground-state dates, should be skipped.
+        (datetime(2016, 9, 1), datetime(2016, 10, 15)),
+    ]
+
+    fits = partition_AICs(df, pairs, model_formula='freq ~ state')
+
+    ok_(len(fits) == 2)
+    ok_(list(fits.first_date) == [pairs[0][0], pairs[1][0]])
+
+    n = len(df)
+    for row in fits.itertuples():
+        excited = (
+            (date_range >= row.first_date) & (date_range <= row.last_date)
+        )
+        X = np.column_stack([np.ones(n), ~excited]).astype(np.float64)
+        beta = np.linalg.lstsq(X, freq, rcond=None)[0]
+        rss = np.sum((freq - X.dot(beta)) ** 2)
+
+        np.testing.assert_allclose(row.coef, beta)
+        np.testing.assert_allclose(row.AIC, n * np.log(rss / n) + 4)
+
+        # the intercept is the excited mean and the state coefficient the
+        # difference of means, whose p-value is the pooled-variance t-test's
+        ground_freq = freq[~excited]
+        excited_freq = freq[excited]
+        np.testing.assert_allclose(row.coef, [
+            excited_freq.mean(), ground_freq.mean() - excited_freq.mean()
+        ])
+        np.testing.assert_allclose(
+            row.pvalue, stats.ttest_ind(ground_freq, excited_freq).pvalue
+        )
+
+    # the fixture gives p-values a wrong formula wouldn't get near
+    ok_(fits.pvalue[0] < 1e-6 and 0.01 < fits.pvalue[1] < 0.99)
+
+
+def test_sharded_partition_AICs_parallel():
+    '''
+    Fitting in a process pool should give the same AIC tables, in the same
+    order, as fitting serially
+    '''
+    date_range = pd.date_range('2016-9-1', '2016-9-20', freq='D')
+    rng = np.random.RandomState(42)
+
+    frames = OrderedDict(
+        (network, pd.DataFrame({
+            'date': date_range,
+            'freq': rng.poisson(3.0, len(date_range)).astype(np.float64)
+        }))
+        for network in ['MSNBCW', 'CNNW', 'FOXNEWSW']
+    )
+
+    pairs = [
+        (fd, ld)
+        for ld in date_range[1:]
+        for fd in date_range[date_range < ld]
+    ]
+
+    kwargs = dict(model_formula='freq ~ state', backend='numpy')
+
+    serial = _sharded_partition_AICs(frames, pairs, n_jobs=1, **kwargs)
+
+    # uneven chunks, so some workers finish out of order
+    parallel = _sharded_partition_AICs(
+        frames, pairs, n_jobs=2, chunk_size=37, **kwargs
+    )
+
+    ok_(list(parallel) == list(frames))
+    for network in frames:
+        ok_(len(serial[network]) > 0)
+        pd.testing.assert_frame_equal(parallel[network], serial[network])